@@ -0,0 +1,31 @@
+"""Per-request cost of decoding a bearer token, with and without the verified-token cache.
+
+Run from the api_signup_login_payment directory:
+    ENV_PATH=.env python -m benchmarks.bench_token_cache
+"""
+import timeit
+
+from user.cache import token_cache
+from user.dependencies import decode_token
+from user.keys import keyring
+from user.utils import create_access_token
+
+ROUNDS = 50000
+
+
+def main():
+    token = create_access_token({'username': "Mart", 'jti': "Hp3VbDkJmEw2qT0c8yLxZg", 'token_type': 'otp'})
+
+    uncached = min(timeit.repeat(lambda: keyring.decode(token),
+                                 number=ROUNDS, repeat=5)) / ROUNDS
+    token_cache.clear()
+    decode_token(token)
+    cached = min(timeit.repeat(lambda: decode_token(token), number=ROUNDS, repeat=5)) / ROUNDS
+
+    print(f"keyring.decode       : {uncached * 1e6:8.2f} us/token")
+    print(f"decode_token (cached): {cached * 1e6:8.2f} us/token")
+    print(f"saving               : {(uncached - cached) * 1e6:8.2f} us/token ({uncached / cached:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
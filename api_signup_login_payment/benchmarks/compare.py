@@ -0,0 +1,40 @@
+"""Compares two JSON result files of the same benchmark, e.g. measured on two commits.
+
+    python -m benchmarks.compare benchmarks/results/load-<old>.json benchmarks/results/load-<new>.json
+"""
+import argparse
+import json
+
+METRICS = ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms')
+
+
+def change(old: float, new: float) -> str:
+    return f"{(new - old) / old * 100:+7.1f}%" if old else f"{'n/a':>8}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    if baseline['benchmark'] != candidate['benchmark']:
+        parser.error(f"Cannot compare a {baseline['benchmark']} run with a {candidate['benchmark']} run")
+
+    print(f"{baseline['benchmark']}: {baseline['commit']} -> {candidate['commit']}")
+    for name, new in candidate['results'].items():
+        old = baseline['results'].get(name)
+        if old is None:
+            continue
+        print(f"\n{name}")
+        for metric in METRICS:
+            if metric in old and metric in new:
+                print(f"  {metric:16}{old[metric]:12.3f}{new[metric]:12.3f}{change(old[metric], new[metric])}")
+
+
+if __name__ == '__main__':
+    main()
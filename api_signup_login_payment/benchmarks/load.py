@@ -0,0 +1,152 @@
+"""Load test of the auth flows: registration, email verification, token and OTP login.
+
+Every simulated user registers, follows its verification link, asks for a token, exchanges it with the
+OTP for a session token, then calls the protected /login route `--logins` times with the session token.
+`--concurrency` users run at the same time. By default the app runs in-process (httpx ASGI transport,
+with its lifespan: outbox worker, hashing pool) against the database of the env file. A local SMTP sink is
+started on MAIL_SERVER:MAIL_PORT, where the OTPs are read from the emails. With `--url` a running server is
+targeted instead, which must send its emails to that sink.
+
+Fully offline run, from the api_signup_login_payment directory (SQLite database, local SMTP sink):
+    ENV_PATH=benchmarks/bench.env python -m benchmarks.load [--users 200] [--concurrency 20] [--logins 10]
+
+Throughput and p50/p95/p99 per endpoint are written to benchmarks/results/ (or --output).
+"""
+import argparse
+import asyncio
+import time
+import uuid
+from collections import defaultdict
+import httpx
+
+from benchmarks.results import summarize, save_results, print_table
+from benchmarks.smtp_sink import SMTPSink
+
+
+class FlowError(Exception):
+    pass
+
+
+class LoadTest:
+    def __init__(self, client: httpx.AsyncClient, sink: SMTPSink, logins: int):
+        self.client = client
+        self.sink = sink
+        self.logins = logins
+        self.run_id = uuid.uuid4().hex[:8]
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, int] = defaultdict(int)
+
+    async def request(self, name: str, expected_status: int, method: str, url: str, **kwargs) -> httpx.Response:
+        started = time.perf_counter()
+        response = await self.client.request(method, url, **kwargs)
+        self.latencies[name].append(time.perf_counter() - started)
+        if response.status_code != expected_status:
+            self.errors[name] += 1
+            raise FlowError(f"{method} {url}: {response.status_code} {response.text[:200]}")
+        return response
+
+    async def user_flow(self, number: int):
+        username = f"bench-{self.run_id}-{number}"
+        password = "Stringst12@"
+        registration = await self.request('POST /user_registration', 200, 'POST', '/user_registration', json={
+            "username": username,
+            "email": f"{username}@example.com",
+            "password": password,
+            "name": "Bench",
+            "firstname": "Mark",
+            "date_of_birth": "2000-01-01",
+            "phone_number": "+237699245729",
+            "address": "string"
+        })
+        await self.request('GET /verification', 200, 'GET', '/verification',
+                           params={'token': registration.json()['token']})
+
+        token = (await self.request('POST /token', 200, 'POST', '/token',
+                                    data={'username': username, 'password': password})).json()['access_token']
+        # The OTP is read from its email, alone on its line in the text part
+        otp_code = (await self.sink.wait_for(f"{username}@example.com", rb'^(\d{6})\r?$')).group(1).decode()
+        session = (await self.request('POST /otp', 200, 'POST', '/otp', params={'otp_code': otp_code},
+                                      headers={'Authorization': f"Bearer {token}"})).json()['access_token']
+        for _ in range(self.logins):
+            await self.request('GET /login', 200, 'GET', '/login', headers={'Authorization': f"Bearer {session}"})
+
+    async def run(self, users: int, concurrency: int) -> tuple[dict, int]:
+        semaphore = asyncio.Semaphore(concurrency)
+        failed_flows = 0
+
+        async def limited(number: int):
+            nonlocal failed_flows
+            async with semaphore:
+                try:
+                    await self.user_flow(number)
+                except (FlowError, httpx.HTTPError, TimeoutError):
+                    failed_flows += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(limited(number) for number in range(users)))
+        elapsed = time.perf_counter() - started
+
+        results = {name: summarize(latencies, elapsed, self.errors[name]) for name, latencies in self.latencies.items()}
+        results['all requests'] = summarize([latency for latencies in self.latencies.values() for latency in latencies],
+                                            elapsed, sum(self.errors.values()))
+        return results, failed_flows
+
+
+async def run_in_process(users: int, concurrency: int, logins: int) -> tuple[dict, dict]:
+    import config
+    from database import engine
+    from main import app
+    from migrate import migrate
+
+    sink = SMTPSink(config.conf.MAIL_SERVER, config.conf.MAIL_PORT)
+    await sink.start()
+    try:
+        await migrate(engine)
+        async with app.router.lifespan_context(app):
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=60) as client:
+                results, failed_flows = await LoadTest(client, sink, logins).run(users, concurrency)
+            # Lets the outbox worker deliver what the last flows queued
+            await asyncio.sleep(config.OUTBOX_POLL_INTERVAL * 2)
+        return results, {'failed_flows': failed_flows, 'emails_delivered': sink.messages_received,
+                          'database': config.DATABASE_URL.split('://')[0]}
+    finally:
+        await sink.stop()
+
+
+async def run_against_server(url: str, users: int, concurrency: int, logins: int) -> tuple[dict, dict]:
+    import config
+
+    sink = SMTPSink(config.conf.MAIL_SERVER, config.conf.MAIL_PORT)
+    await sink.start()
+    try:
+        async with httpx.AsyncClient(base_url=url, timeout=60) as client:
+            results, failed_flows = await LoadTest(client, sink, logins).run(users, concurrency)
+        return results, {'failed_flows': failed_flows, 'emails_delivered': sink.messages_received}
+    finally:
+        await sink.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200, help="number of simulated users")
+    parser.add_argument('--concurrency', type=int, default=20, help="users running at the same time")
+    parser.add_argument('--logins', type=int, default=10, help="authenticated /login calls per user")
+    parser.add_argument('--url', help="base URL of a running server (default: the app in-process)")
+    parser.add_argument('--output', help="JSON result file (default: a new file in benchmarks/results/)")
+    args = parser.parse_args()
+
+    if args.url:
+        results, info = asyncio.run(run_against_server(args.url, args.users, args.concurrency, args.logins))
+    else:
+        results, info = asyncio.run(run_in_process(args.users, args.concurrency, args.logins))
+    print_table(results)
+    print(', '.join(f"{key}: {value}" for key, value in info.items()))
+    parameters = {'users': args.users, 'concurrency': args.concurrency, 'logins': args.logins,
+                  'target': args.url or 'in-process', **info}
+    path = save_results('load', parameters, results, args.output)
+    print(f"\nResults saved to {path}")
+
+
+if __name__ == '__main__':
+    main()
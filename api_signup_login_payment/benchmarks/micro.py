@@ -0,0 +1,112 @@
+"""Microbenchmarks of the CPU bound steps of the auth flows.
+
+Run from the api_signup_login_payment directory:
+    ENV_PATH=benchmarks/bench.env python -m benchmarks.micro [--iterations 20000] [--hash-iterations 20]
+
+Every call is timed on its own, the p50/p95/p99 are written to benchmarks/results/ (or --output).
+"""
+import argparse
+import asyncio
+import json
+import time
+from dataclasses import asdict
+from datetime import date
+import orjson
+import pyotp
+from fastapi.encoders import jsonable_encoder
+
+from benchmarks.results import summarize, save_results, print_table
+from user.cache import UserSnapshot
+from user.dependencies import otp_checker
+from user.hashing import pwd_context, hashing_executor
+from user.utils import create_access_token
+from user.validators import UserValidation, UserPublic
+
+USER = {
+    "username": "Mart",
+    "email": "user@example.com",
+    "password": "Stringst12@",
+    "name": "string",
+    "firstname": "string",
+    "date_of_birth": "2025-01-29",
+    "phone_number": "+237699245729",
+    "address": "string"
+}
+
+
+# The /login response: the old path validated the user again through UserValidation, then encoded it with
+# jsonable_encoder and json; the new one builds UserPublic without validation and encodes it with orjson
+def login_response_validated(user: UserSnapshot) -> bytes:
+    return json.dumps(jsonable_encoder(UserValidation(**asdict(user))), separators=(',', ':')).encode()
+
+
+def login_response_constructed(user: UserSnapshot) -> bytes:
+    return orjson.dumps(UserPublic.from_row(user).model_dump())
+
+
+def time_calls(func, iterations: int) -> list[float]:
+    latencies = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+async def time_async_calls(func, iterations: int) -> list[float]:
+    latencies = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        await func()
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def run(iterations: int, hash_iterations: int) -> dict:
+    otp_secret = pyotp.random_base32()
+    otp_code = pyotp.TOTP(otp_secret, interval=300).now()
+    hashed_password = pwd_context.hash(USER['password'])
+    snapshot = UserSnapshot(**{**USER, 'password': hashed_password, 'date_of_birth': date(2025, 1, 29),
+                               'is_verified': True})
+
+    results = {
+        'user_validation': summarize(time_calls(lambda: UserValidation(**USER), iterations)),
+        'login_response_validated': summarize(time_calls(lambda: login_response_validated(snapshot), iterations)),
+        'login_response_constructed': summarize(time_calls(lambda: login_response_constructed(snapshot),
+                                                           iterations)),
+        'create_access_token': summarize(time_calls(
+            lambda: create_access_token({'username': "Mart", 'jti': "Hp3VbDkJmEw2qT0c8yLxZg", 'token_type': 'otp'}), iterations)),
+        'otp_checker': summarize(time_calls(lambda: otp_checker(otp_code, otp_secret), iterations)),
+        'bcrypt_hash': summarize(time_calls(lambda: pwd_context.hash(USER['password']), hash_iterations)),
+        'bcrypt_verify': summarize(time_calls(lambda: pwd_context.verify(USER['password'], hashed_password),
+                                              hash_iterations)),
+    }
+
+    # The same hash through the worker processes, as the routes run it: adds the inter-process round trip
+    async def executor_hash() -> list[float]:
+        try:
+            await hashing_executor.hash(USER['password'])  # Starts the worker processes
+            return await time_async_calls(lambda: hashing_executor.hash(USER['password']), hash_iterations)
+        finally:
+            hashing_executor.shutdown()
+
+    results['hashing_executor_hash'] = summarize(asyncio.run(executor_hash()))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=20000, help="calls of the fast operations")
+    parser.add_argument('--hash-iterations', type=int, default=20, help="calls of the bcrypt operations")
+    parser.add_argument('--output', help="JSON result file (default: a new file in benchmarks/results/)")
+    args = parser.parse_args()
+
+    results = run(args.iterations, args.hash_iterations)
+    print_table(results)
+    path = save_results('micro', {'iterations': args.iterations, 'hash_iterations': args.hash_iterations},
+                        results, args.output)
+    print(f"\nResults saved to {path}")
+
+
+if __name__ == '__main__':
+    main()
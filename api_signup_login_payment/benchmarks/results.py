@@ -0,0 +1,72 @@
+"""Latency statistics and JSON result files shared by the benchmarks."""
+import json
+import platform
+import statistics
+import subprocess
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+RESULTS_DIRECTORY = Path(__file__).parent / 'results'
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, round(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def summarize(latencies: list[float], elapsed: float | None = None, errors: int = 0) -> dict:
+    """Summary of latencies in seconds: count, throughput (when `elapsed` is given) and percentiles in ms."""
+    values = sorted(latencies)
+    summary = {
+        'count': len(values),
+        'errors': errors,
+        'mean_ms': statistics.fmean(values) * 1e3 if values else 0.0,
+        'p50_ms': percentile(values, 50) * 1e3,
+        'p95_ms': percentile(values, 95) * 1e3,
+        'p99_ms': percentile(values, 99) * 1e3,
+        'max_ms': values[-1] * 1e3 if values else 0.0,
+    }
+    if elapsed is not None:
+        summary['throughput_rps'] = len(values) / elapsed if elapsed else 0.0
+    return summary
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(name: str, parameters: dict, results: dict, output: str | None = None) -> Path:
+    """Writes the results with the commit and environment they were measured on, returns the file path."""
+    commit = _git_commit()
+    document = {
+        'benchmark': name,
+        'commit': commit,
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': parameters,
+        'results': results,
+    }
+    if output is None:
+        RESULTS_DIRECTORY.mkdir(exist_ok=True)
+        path = RESULTS_DIRECTORY / f"{name}-{commit or 'nocommit'}-{int(time.time())}.json"
+    else:
+        path = Path(output)
+    path.write_text(json.dumps(document, indent=2))
+    return path
+
+
+def print_table(results: dict):
+    print(f"{'':28}{'count':>8}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for name, summary in results.items():
+        rps = f"{summary['throughput_rps']:10.1f}" if 'throughput_rps' in summary else f"{'':10}"
+        print(f"{name:28}{summary['count']:8d}{rps}{summary['p50_ms']:10.3f}{summary['p95_ms']:10.3f}"
+              f"{summary['p99_ms']:10.3f}{summary['errors']:8d}")
@@ -0,0 +1,75 @@
+"""Minimal local SMTP server accepting every message, so that emails can be sent offline."""
+import asyncio
+import re
+from collections import defaultdict
+
+
+class SMTPSink:
+    """Speaks just enough SMTP (EHLO, AUTH PLAIN, MAIL, RCPT, DATA, RSET, NOOP, QUIT) for aiosmtplib.
+
+    The messages are kept by recipient until taken by wait_for() (the load test reads the emailed OTPs).
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 8025):
+        self.host = host
+        self.port = port
+        self.messages_received = 0
+        self.connections = 0
+        self.messages: dict[str, list[bytes]] = defaultdict(list)
+        self._server: asyncio.Server | None = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def wait_for(self, recipient: str, pattern: bytes, timeout: float = 30) -> re.Match:
+        """Takes the first message to `recipient` matching `pattern`, waiting for its delivery."""
+        async with asyncio.timeout(timeout):
+            while True:
+                for index, message in enumerate(self.messages[recipient]):
+                    match = re.search(pattern, message, re.MULTILINE)
+                    if match:
+                        del self.messages[recipient][index]
+                        return match
+                await asyncio.sleep(0.05)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        writer.write(b'220 localhost SMTP sink\r\n')
+        recipients = []
+        try:
+            while line := await reader.readline():
+                command = line[:4].upper()
+                if command == b'EHLO':
+                    writer.write(b'250-localhost\r\n250-AUTH PLAIN\r\n250 8BITMIME\r\n')
+                elif command == b'HELO':
+                    writer.write(b'250 localhost\r\n')
+                elif command == b'AUTH':
+                    writer.write(b'235 Authentication successful\r\n')
+                elif command == b'RCPT':
+                    recipients.append(line[line.index(b'<') + 1:line.index(b'>')].decode())
+                    writer.write(b'250 OK\r\n')
+                elif command == b'DATA':
+                    writer.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+                    await writer.drain()
+                    message = await reader.readuntil(b'\r\n.\r\n')
+                    for recipient in recipients:
+                        self.messages[recipient].append(message)
+                    recipients = []
+                    self.messages_received += 1
+                    writer.write(b'250 OK\r\n')
+                elif command == b'QUIT':
+                    writer.write(b'221 Bye\r\n')
+                    break
+                else:
+                    writer.write(b'250 OK\r\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
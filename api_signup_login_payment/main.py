@@ -1,9 +1,85 @@
+import time
+
+# Measured for the startup report: importing the app is a good part of a worker boot
+IMPORTS_STARTED = time.perf_counter()
+
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
+
+from database import dispose_engines, warm_up_pool, PrimarySessionLocal
+from metrics import setup_metrics, stats_collector
+from routers import users, subscriptions
+from startup import StartupReport
+from user.entitlements import entitlement_index
+from user.cache import user_cache, auth_cache, token_cache
+from user.hashing import hashing_executor
+from user.keys import keyring
+from user.mail_templates import warm_up_templates
+from user.outbox import create_outbox_worker
+from user.smtp_pool import smtp_pool
+from user.usernames import username_index
+import config
+
+IMPORTS_ENDED = time.perf_counter()
+
+
+async def warm_up(report: StartupReport):
+    async def timed(name: str, coroutine):
+        with report.optional_step(name):
+            await asyncio.wait_for(coroutine, config.STARTUP_WARMUP_TIMEOUT)
+
+    with report.optional_step('templates'):
+        warm_up_templates()
+    # Independent: the database round trips and the worker processes boot at the same time
+    await asyncio.gather(timed('db_pool', warm_up_pool(config.DB_WARMUP_CONNECTIONS)),
+                         timed('hashing_workers', hashing_executor.warm_up()))
+
+
+# No schema change here: run migrate.py before starting the workers
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    report = StartupReport(started=IMPORTS_STARTED)
+    report.record('imports', IMPORTS_STARTED, IMPORTS_ENDED)
+    with report.step('signing_keys'):
+        keyring.start(config.SIGNING_KEYS_RELOAD_INTERVAL)
+    await warm_up(report)
+    with report.step('entitlement_index'):
+        await entitlement_index.start(config.STARTUP_WARMUP_TIMEOUT)
+    # Built in the background: the users table is streamed while the worker already serves
+    username_index.start()
+    outbox_worker = create_outbox_worker(PrimarySessionLocal)
+    outbox_worker.start()
+    app.state.startup_report = report
+    report.log()
+    yield
+    await username_index.stop()
+    await entitlement_index.stop()
+    await outbox_worker.stop()
+    await keyring.stop()
+    await smtp_pool.close()
+    hashing_executor.shutdown()
+    await dispose_engines()
+
+
+def create_app() -> FastAPI:
+    """Builds the app: connections, worker processes and templates are set up by the lifespan.
 
-from database import engine, Base
-from routers import users
+    The settings (read from ENV_PATH) and the engines (which connect on first use) are not created here but
+    when config and the database module are imported, with the rest of the modules: the app below is built
+    at import too. Served with `uvicorn main:create_app --factory` (or `uvicorn main:app`).
+    """
+    app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+    setup_metrics(app)
+    stats_collector.register('user_cache', user_cache.stats)
+    stats_collector.register('auth_cache', auth_cache.stats)
+    stats_collector.register('token_cache', token_cache.stats)
+    stats_collector.register('smtp_pool', smtp_pool.stats)
+    stats_collector.register('username_filter', username_index.stats)
+    app.include_router(users.router)
+    app.include_router(subscriptions.router)
+    return app
 
-app = FastAPI()
-Base.metadata.create_all(bind=engine)
 
-app.include_router(users.router)
+app = create_app()
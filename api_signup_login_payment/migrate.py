@@ -0,0 +1,70 @@
+"""Database schema migrations, run once per deployment before the workers start (which no longer touch the schema).
+
+From the api_signup_login_payment directory:
+    ENV_PATH=.env python migrate.py
+
+Missing tables and their indexes are created from the models. The changes to existing tables are listed in
+MIGRATIONS, applied in order and recorded in the schema_migration table, in the same transaction. A new database
+is created at the latest version: its migrations are only recorded.
+"""
+import asyncio
+from datetime import datetime
+from sqlalchemy import Column, DateTime, MetaData, String, Table, inspect, insert, select, text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from database import Base, engine, dispose_engines
+from user.models import User
+
+migration_metadata = MetaData()
+schema_migration = Table(
+    'schema_migration', migration_metadata,
+    Column('name', String, primary_key=True),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+# (name, statements), never edited once released: a change is a new entry
+MIGRATIONS: list[tuple[str, list[str]]] = [
+    ('0001_subscription_entitlement_index', [
+        "ALTER TABLE subscription ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITHOUT TIME ZONE NOT NULL "
+        "DEFAULT (now() AT TIME ZONE 'utc')",
+        "CREATE INDEX IF NOT EXISTS ix_subscription_updated_at ON subscription (updated_at)",
+        'CREATE INDEX IF NOT EXISTS ix_subscription_username_begin_end ON subscription (username, "begin", "end")',
+    ]),
+    ('0002_subscription_renewal', [
+        "ALTER TABLE subscription ADD COLUMN IF NOT EXISTS auto_renew BOOLEAN NOT NULL DEFAULT false",
+        "ALTER TABLE subscription ADD COLUMN IF NOT EXISTS notified_end DATE",
+        "ALTER TABLE subscription_type ADD COLUMN IF NOT EXISTS duration_days INTEGER NOT NULL DEFAULT 30",
+    ]),
+    # Fails while several users share an address (whatever its case): they must be merged or changed first
+    ('0003_users_email_lower', [
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_users_email_lower ON users (lower(email))",
+    ]),
+]
+
+
+async def migrate(engine: AsyncEngine) -> list[str]:
+    """Brings the schema up to date; returns the names of the migrations applied."""
+    async with engine.begin() as conn:
+        new_database = not await conn.run_sync(lambda sync_conn: inspect(sync_conn).has_table(User.__tablename__))
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(migration_metadata.create_all)
+        applied = set(await conn.scalars(select(schema_migration.c.name)))
+        pending = [(name, statements) for name, statements in MIGRATIONS if name not in applied]
+        for name, statements in pending:
+            if not new_database:
+                for statement in statements:
+                    await conn.execute(text(statement))
+            await conn.execute(insert(schema_migration).values(name=name, applied_at=datetime.utcnow()))
+    return [name for name, _ in pending]
+
+
+async def main():
+    try:
+        applied = await migrate(engine)
+    finally:
+        await dispose_engines()
+    print(f"Applied: {', '.join(applied)}" if applied else "The schema is up to date")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
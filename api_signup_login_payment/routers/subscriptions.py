@@ -0,0 +1,19 @@
+from dataclasses import asdict
+from typing import Annotated
+from fastapi import APIRouter, Depends
+
+from user.dependencies import get_session
+from user.entitlements import entitlement_index
+
+router = APIRouter()
+
+
+# Answered from the entitlement index: no database access
+@router.get('/me/subscription')
+async def my_subscription(session: Annotated[dict, Depends(get_session)]):
+    entitlement = entitlement_index.active_subscription(session['username'])
+    return {
+        'username': session['username'],
+        'active': entitlement is not None,
+        'subscription': asdict(entitlement) if entitlement is not None else None
+    }
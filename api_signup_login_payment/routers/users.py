@@ -1,74 +1,128 @@
 from typing import Annotated
 from fastapi import APIRouter, HTTPException, status, Depends, Request
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse, ORJSONResponse
 from fastapi.security import OAuth2PasswordRequestForm
-from fastapi.templating import Jinja2Templates
 
-from sqlalchemy.orm import Session
-import pyotp
-
-from user.validators import UserValidation, Credentials
-from user.models import User
-from database import get_db
-from user.dependencies import verify_token_email, get_user, authenticate_user, get_current_user
-from user.utils import send_email, create_access_token
-from config import VERIFICATION_EMAIL_SUBJECT, VERIFICATION_MSG, OTP_MSG, OTP_EMAIL_SUBJECT
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from user.validators import UserValidation, Credentials, UserPublic, RegistrationResponse
+from user.models import User, email_matches
+from user.cache import UserSnapshot, AuthRecord, user_cache, auth_cache
+from database import get_db, get_primary_db, release_connection, PrimarySessionLocal
+from user.dependencies import verify_email, verify_user_credentials, get_current_user, verify_otp_token, \
+    verify_refresh_token, get_admin_session
+from user.utils import create_access_token, create_session_tokens, create_otp_challenge
+from user.outbox import queue_email
+from user.mail_templates import VERIFICATION_EMAIL, OTP_EMAIL, render_page
+from user.bulk_import import import_users, prepend, NDJSON, CSV
+from user.rate_limit import limit_client_ip, limit_username, shed_load, TOKEN_IP_LIMIT, TOKEN_USERNAME_LIMIT, \
+    REGISTRATION_IP_LIMIT, REGISTRATION_USERNAME_LIMIT, USERNAME_CHECK_IP_LIMIT, IMPORT_IP_LIMIT
+from user.usernames import is_username_taken, mark_username_registered
 
 router = APIRouter()
-template = Jinja2Templates(directory="templates")
 
 
 #############################################################################
 #                    ENDPOINTS(ROUTES) FUNCTIONS                            #
 #############################################################################
 
-@router.post('/user_registration')
-async def create_user(user: UserValidation, db: Annotated[Session, Depends(get_db)]):
-    # Here we check if the user is already in the database
-    if await get_user(db, user.username):
+@router.post('/user_registration', response_model=RegistrationResponse,
+             dependencies=[Depends(limit_client_ip('registration', REGISTRATION_IP_LIMIT)), Depends(shed_load)])
+async def create_user(user: UserValidation, db: Annotated[AsyncSession, Depends(get_db)]):
+    await limit_username('registration', user.username, REGISTRATION_USERNAME_LIMIT)
+    # Usernames known to the cache are rejected before paying for a bcrypt hash
+    if user_cache.get(user.username) or auth_cache.get(user.username):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Username already registered"
         )
+    # So are the emails already registered, whatever their case: a single probe of the unique index
+    if await db.scalar(select(User.username).where(email_matches(user.email))) is not None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Email already registered"
+        )
+    await release_connection(db)
+
+    # Creation of an unverified user in the database, in a single statement: no row is returned when the
+    # username or the email is already taken, even when two registrations for them race each other
+    created = (await db.execute(
+        insert(User)
+        .values(
+            username=user.username,
+            email=user.email,
+            password=await user.hashed_pwd(),
+            name=user.name,
+            firstname=user.firstname,
+            date_of_birth=user.date_of_birth,
+            phone_number=user.phone_number,
+            address=user.address,
+            is_verified=False
+        )
+        .on_conflict_do_nothing()
+        .returning(*(User.__table__.c[name] for name in UserPublic.model_fields))
+    )).first()
+    if created is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Username or email already registered"
+        )
+
+    # The confirmation email goes to the outbox in the same transaction as the user
+    token = create_access_token(data={'username': created.username})
+    queue_email(db, [created.email], VERIFICATION_EMAIL, token)
+    mark_username_registered(db, created.username)
+    await db.commit()
+
+    # Returned as is: the response model is only documented, not validated again
+    return ORJSONResponse(RegistrationResponse.model_construct(token=token, user=UserPublic.from_row(created))
+                          .model_dump())
 
-    # Creation of an unverified user in the database
-    user_obj = User(
-        username=user.username,
-        email=user.email,
-        password=user.hashed_pwd(),
-        name=user.name,
-        firstname=user.firstname,
-        date_of_birth=user.date_of_birth,
-        phone_number=user.phone_number,
-        address=user.address,
-        is_verified=user.is_verified
-    )
-    db.add(user_obj)
-    db.commit()
-    db.refresh(user_obj)
-
-    # Send confirmation email
-    token = create_access_token(data={'username': user_obj.username})
-    await send_email([user_obj.email], VERIFICATION_MSG, token, VERIFICATION_EMAIL_SUBJECT)
-
-    return {'token': token, 'user': UserValidation(**user_obj.__dict__)}
+
+# Checked on every keystroke of the signup form: most usernames are answered by the Bloom filter alone
+@router.get('/username_available',
+            dependencies=[Depends(limit_client_ip('username_check', USERNAME_CHECK_IP_LIMIT))])
+async def username_available(username: str, taken: Annotated[bool, Depends(is_username_taken)]):
+    return {'username': username, 'available': not taken}
+
+
+# Bulk registration from a NDJSON or CSV upload, answered with one NDJSON result line per uploaded row. Reserved
+# to the administrators, and limited and shed like the registration: each row costs a bcrypt hash.
+@router.post('/user_import',
+             dependencies=[Depends(get_admin_session), Depends(limit_client_ip('import', IMPORT_IP_LIMIT)),
+                           Depends(shed_load)])
+async def bulk_import_users(request: Request):
+    content_type = request.headers.get('content-type', NDJSON).split(';')[0].strip()
+    if content_type not in (NDJSON, CSV):
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail=f"Upload users as {NDJSON} or {CSV}"
+        )
+    # The import opens its own sessions: the response is streamed after the request dependencies are closed. Its
+    # first chunk is imported before answering, so that a file rejected from its first lines gets an error status.
+    results = import_users(PrimarySessionLocal, request.stream(), content_type)
+    first = await anext(results, None)
+    return StreamingResponse(prepend(first, results), media_type=NDJSON)
 
 
 @router.get('/verification', response_class=HTMLResponse)
-async def email_verification(request: Request, token: str, db: Annotated[Session, Depends(get_db)]):
-    result = await verify_token_email(token, db)
+async def email_verification(token: str, db: Annotated[AsyncSession, Depends(get_primary_db)]):
+    username = await verify_email(token, db)
 
-    if result['user'] and not result['user'].is_verified:
-        result['user'].is_verified = True
-        result['session'].commit()
-        return template.TemplateResponse("email_verification.html",
-                                         {"request": request, "username": result['user'].username})
+    if username is not None:
+        await db.commit()
+        return render_page("email_verification.html", username=username)
 
 
-@router.post('/token')
-async def login_for_access_token(db: Annotated[Session, Depends(get_db)],
+@router.post('/token', dependencies=[Depends(limit_client_ip('token', TOKEN_IP_LIMIT)), Depends(shed_load)])
+async def login_for_access_token(db: Annotated[AsyncSession, Depends(get_db)],
                                  form_data: Annotated[OAuth2PasswordRequestForm, Depends()]):
-    user = await authenticate_user(Credentials(username=form_data.username, password=form_data.password), db)
+    # Logins by email share their bucket whatever their case
+    login = form_data.username.lower() if '@' in form_data.username else form_data.username
+    await limit_username('token', login, TOKEN_USERNAME_LIMIT)
+    user = await verify_user_credentials(Credentials(username=form_data.username, password=form_data.password), db)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -76,16 +130,26 @@ async def login_for_access_token(db: Annotated[Session, Depends(get_db)],
             headers={"WWW-Authenticate": "Bearer"}
         )
 
-    curr_otp_secret = pyotp.random_base32()
-    payload = {'username': user.username, 'otp_secret': curr_otp_secret}
-    token = create_access_token(payload)
-
-    otp = pyotp.TOTP(curr_otp_secret, interval=300)
-    otp_code = otp.now()
-    await send_email([user.email], OTP_MSG, otp_code, OTP_EMAIL_SUBJECT)
+    token, otp_code = await create_otp_challenge(db, user.username)
+    queue_email(db, [user.email], OTP_EMAIL, otp_code)
+    await db.commit()
     return {'access_token': token, 'token_type': 'bearer'}
 
 
-@router.get('/login', response_model=UserValidation)
-async def read_user(user: Annotated[User, Depends(get_current_user)]):
-    return user
+# The emailed OTP is checked once, here, in exchange for a short-lived session token and a refresh token
+@router.post('/otp', dependencies=[Depends(limit_client_ip('otp', TOKEN_IP_LIMIT))])
+async def exchange_otp(user: Annotated[AuthRecord, Depends(verify_otp_token)],
+                       db: Annotated[AsyncSession, Depends(get_primary_db)]):
+    # Commits the deletion of the OTP challenge
+    await db.commit()
+    return create_session_tokens(user.username)
+
+
+@router.post('/refresh')
+async def refresh_session(user: Annotated[AuthRecord, Depends(verify_refresh_token)]):
+    return create_session_tokens(user.username)
+
+
+@router.get('/login', response_model=UserPublic)
+async def read_user(user: Annotated[UserSnapshot, Depends(get_current_user)]):
+    return ORJSONResponse(UserPublic.from_row(user).model_dump())
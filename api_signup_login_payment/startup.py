@@ -0,0 +1,44 @@
+import logging
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class StartupReport:
+    """Time spent in each startup step, logged once the worker is ready to serve."""
+
+    def __init__(self, started: float | None = None):
+        self.started = time.perf_counter() if started is None else started
+        self.steps: dict[str, float] = {}
+        self.failed: list[str] = []
+
+    @contextmanager
+    def step(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps[name] = time.perf_counter() - started
+
+    def record(self, name: str, started: float, ended: float | None = None):
+        self.steps[name] = (time.perf_counter() if ended is None else ended) - started
+
+    @contextmanager
+    def optional_step(self, name: str):
+        """A step the worker can start without (a warm-up): its failure is logged instead of raised."""
+        try:
+            with self.step(name):
+                yield
+        except Exception:
+            self.failed.append(name)
+            logger.exception("Startup step %s failed, continuing without it", name)
+
+    @property
+    def total(self) -> float:
+        return time.perf_counter() - self.started
+
+    def log(self):
+        steps = ', '.join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in self.steps.items())
+        failed = f" (failed: {', '.join(self.failed)})" if self.failed else ""
+        logger.info("Worker ready in %.0f ms: %s%s", self.total * 1000, steps, failed)
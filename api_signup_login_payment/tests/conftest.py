@@ -0,0 +1,27 @@
+import pytest_asyncio
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine
+from database import Base
+
+
+@pytest_asyncio.fixture
+async def create_database(tmp_path):
+    """Creates SQLite databases in the test directory, with the schema, disposed after the test."""
+    engines = []
+
+    async def create(name: str, wal: bool = False) -> AsyncEngine:
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / name}")
+        engines.append(engine)
+        if wal:
+            # WAL lets a connection keep reading while another one commits, as PostgreSQL does
+            @event.listens_for(engine.sync_engine, 'connect')
+            def journal_mode(dbapi_connection, connection_record):
+                dbapi_connection.execute("PRAGMA journal_mode=WAL")
+
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        return engine
+
+    yield create
+    for engine in engines:
+        await engine.dispose()
@@ -0,0 +1,8 @@
+from datetime import date
+
+
+# Row of the users table, for Core inserts or User(**user(...)): each username gets its own email
+def user(username: str, **columns) -> dict:
+    return {"username": username, "email": f"{username}@example.com", "password": "hashed", "name": "string",
+            "firstname": "string", "date_of_birth": date(2000, 1, 1), "phone_number": "+237699245729",
+            "address": "string", "is_verified": True, **columns}
@@ -0,0 +1,186 @@
+import json
+import pytest
+from unittest.mock import MagicMock, patch
+from fastapi import HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+from user.bulk_import import iter_records, import_chunk, import_users, NDJSON, CSV
+
+USER = {
+    "username": "Mart",
+    "email": "user@example.com",
+    "password": "Stringst12@",
+    "name": "string",
+    "firstname": "string",
+    "date_of_birth": "2025-01-29",
+    "phone_number": "+237699245729",
+    "address": "string"
+}
+
+
+async def as_stream(*chunks: bytes):
+    for chunk in chunks:
+        yield chunk
+
+
+async def collect(iterator) -> list:
+    return [item async for item in iterator]
+
+
+@pytest.fixture
+def db_session():
+    session = MagicMock(spec=AsyncSession)
+    yield session
+
+
+@pytest.fixture
+def session_factory(db_session):
+    factory = MagicMock()
+    factory.return_value.__aenter__.return_value = db_session
+    return factory
+
+
+@pytest.fixture(autouse=True)
+def fake_hashing():
+    async def hash_many(passwords):
+        return [f"hashed-{password}" for password in passwords]
+
+    with patch("user.bulk_import.hashing_executor.hash_many", side_effect=hash_many):
+        yield
+
+
+@pytest.mark.asyncio
+async def test_iter_records_ndjson_split_across_chunks():
+    body = json.dumps(USER).encode() + b'\n\n' + b'not json\n[1]'
+    records = await collect(iter_records(as_stream(body[:10], body[10:]), NDJSON))
+
+    assert records[0] == (1, USER)
+    assert records[1][0] == 3 and records[1][1].startswith("Invalid JSON")
+    assert records[2] == (4, "Expected a JSON object")
+
+
+@pytest.mark.asyncio
+async def test_iter_records_csv():
+    body = (",".join(USER) + "\r\n" + ",".join(USER.values()) + "\r\nMart,only-two\r\n").encode()
+    records = await collect(iter_records(as_stream(body), CSV))
+
+    assert records == [(2, USER), (3, "Expected 8 columns, got 2")]
+
+
+@pytest.mark.asyncio
+async def test_iter_records_csv_quoted_newlines():
+    address = 'Rue 1, "Bastos"\nYaounde'
+    values = [*list(USER.values())[:-1], '"' + address.replace('"', '""') + '"']
+    body = (",".join(USER) + "\n" + ",".join(values) + "\n" + ",".join(USER.values()) + "\n").encode()
+    records = await collect(iter_records(as_stream(body[:90], body[90:150], body[150:]), CSV))
+
+    assert records == [(2, {**USER, "address": address}), (4, USER)]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("content_type, line", [
+    (NDJSON, b'{"username": "' + b'x' * 100 + b'"}\n'),
+    # An unterminated quoted field is not buffered past the limit either
+    (CSV, b'"' + b'x\n' * 60),
+])
+async def test_iter_records_rejects_long_lines(content_type, line):
+    with patch("user.bulk_import.config.IMPORT_MAX_LINE_BYTES", 64):
+        with pytest.raises(HTTPException) as exc_info:
+            await collect(iter_records(as_stream(b'username\n', line[:50], line[50:]), content_type))
+
+    assert exc_info.value.status_code == 413
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("content_type", [NDJSON, CSV])
+async def test_iter_records_rejects_invalid_utf8(content_type):
+    with pytest.raises(HTTPException) as exc_info:
+        await collect(iter_records(as_stream(b'username\n', b'\xff\xfe\n'), content_type))
+
+    assert exc_info.value.status_code == 400
+    assert exc_info.value.detail == "Line 2 is not valid UTF-8"
+
+
+@pytest.mark.asyncio
+async def test_import_chunk(session_factory, db_session):
+    db_session.execute.return_value = MagicMock()
+    db_session.execute.return_value.all.return_value = [("Mart", "user@example.com")]
+    chunk = [
+        (1, USER),
+        (2, {**USER, "username": "Germinal", "email": "germinal@example.com"}),
+        (3, {**USER, "password": "weak"}),
+        (4, USER),
+        (5, "Invalid JSON"),
+        (6, {**USER, "username": "Forest", "email": "User@Example.com"}),
+    ]
+
+    results = [json.loads(line) for line in await import_chunk(session_factory, chunk)]
+
+    assert [(r['line'], r['username'], r['status']) for r in results] == [
+        (1, "Mart", "created"),
+        (2, "Germinal", "rejected"),
+        (3, "Mart", "rejected"),
+        (4, "Mart", "rejected"),
+        (5, None, "rejected"),
+        (6, "Forest", "rejected"),
+    ]
+    assert results[1]['detail'] == "Username or email already registered"
+    assert results[3]['detail'] == "Duplicated username in the file"
+    assert results[5]['detail'] == "Duplicated email in the file"
+    db_session.execute.assert_awaited_once()
+    # One verification email queued for the created user, committed with the insert
+    db_session.add.assert_called_once()
+    db_session.commit.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_import_users_in_chunks(session_factory, db_session):
+    db_session.execute.return_value = MagicMock()
+    db_session.execute.return_value.all.return_value = []
+    body = b''.join(json.dumps({**USER, "username": f"user{i}"}).encode() + b'\n' for i in range(5))
+
+    with patch("user.bulk_import.config.IMPORT_CHUNK_SIZE", 2):
+        results = await collect(import_users(session_factory, as_stream(body), NDJSON))
+
+    assert len(results) == 5
+    assert db_session.execute.await_count == 3
+
+
+@pytest.mark.asyncio
+async def test_import_chunk_rejected_when_hashing_is_busy(session_factory, db_session):
+    with patch("user.bulk_import.hashing_executor.hash_many", side_effect=HTTPException(503, "Server is busy")):
+        results = [json.loads(line) for line in await import_chunk(session_factory, [(1, USER), (2, "Invalid")])]
+
+    assert [(r['line'], r['status'], r['detail']) for r in results] == [
+        (1, 'rejected', "Server is busy"), (2, 'rejected', "Invalid")]
+    db_session.execute.assert_not_awaited()
+
+
+@pytest.mark.asyncio
+async def test_import_users_long_line(session_factory, db_session):
+    db_session.execute.return_value = MagicMock()
+    db_session.execute.return_value.all.return_value = []
+    long_line = b'x' * 600 + b'\n'
+
+    with patch("user.bulk_import.config.IMPORT_CHUNK_SIZE", 1), \
+            patch("user.bulk_import.config.IMPORT_MAX_LINE_BYTES", 500):
+        # Before the first result, the whole upload is rejected
+        with pytest.raises(HTTPException):
+            await collect(import_users(session_factory, as_stream(long_line), NDJSON))
+        # Afterwards, the import ends with an aborted result
+        body = json.dumps(USER).encode() + b'\n' + long_line
+        results = [json.loads(line) for line in await collect(import_users(session_factory, as_stream(body), NDJSON))]
+
+    assert [r['status'] for r in results] == ['rejected', 'aborted']
+    assert results[1]['detail'] == "Line 2 is longer than 500 bytes"
+
+
+@pytest.mark.asyncio
+async def test_import_users_invalid_utf8_after_streaming(session_factory, db_session):
+    db_session.execute.return_value = MagicMock()
+    db_session.execute.return_value.all.return_value = []
+    body = json.dumps(USER).encode() + b'\n' + '{"username": "Mart"}'.encode('utf-16')
+
+    with patch("user.bulk_import.config.IMPORT_CHUNK_SIZE", 1):
+        results = [json.loads(line) for line in await collect(import_users(session_factory, as_stream(body), NDJSON))]
+
+    assert [(r['status'], r['detail']) for r in results][1] == ('aborted', "Line 2 is not valid UTF-8")
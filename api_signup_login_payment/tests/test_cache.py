@@ -0,0 +1,135 @@
+import pytest
+from datetime import date, datetime, timedelta
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from database import Base
+from user.cache import TTLCache, VerifiedTokenCache, UserSnapshot, AuthRecord, user_cache, auth_cache
+from user.models import User
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def cache(clock):
+    return TTLCache(maxsize=2, ttl=10, clock=clock)
+
+
+def test_get_and_set(cache):
+    assert cache.get("Mart") is None
+    cache.set("Mart", 1)
+
+    assert cache.get("Mart") == 1
+    assert cache.stats() == {'size': 1, 'maxsize': 2, 'hits': 1, 'misses': 1, 'evictions': 0}
+
+
+def test_entries_expire(cache, clock):
+    cache.set("Mart", 1)
+    clock.now = 9.9
+    assert cache.get("Mart") == 1
+
+    clock.now = 10
+    assert cache.get("Mart") is None
+    assert len(cache) == 0
+
+
+def test_least_recently_used_is_evicted(cache):
+    cache.set("Mart", 1)
+    cache.set("Germinal", 2)
+    cache.get("Mart")
+    cache.set("Forest", 3)
+
+    assert cache.get("Germinal") is None
+    assert cache.get("Mart") == 1
+    assert cache.get("Forest") == 3
+    assert cache.stats()['evictions'] == 1
+
+
+def test_invalidate(cache):
+    cache.set("Mart", 1)
+    cache.invalidate("Mart")
+    cache.invalidate("Unknown")
+
+    assert cache.get("Mart") is None
+
+
+def claims_expiring_in(seconds: float) -> dict:
+    return {'username': "Mart", 'exp_time_token': (datetime.utcnow() + timedelta(seconds=seconds)).isoformat()}
+
+
+def test_verified_token_expires_with_token(clock):
+    tokens = VerifiedTokenCache(maxsize=2, clock=clock)
+    claims = claims_expiring_in(60)
+    tokens.set("token", claims, "key")
+
+    assert tokens.get("token", "key") is claims
+    clock.now = 61
+    assert tokens.get("token", "key") is None
+
+
+def test_verified_token_without_expiry_not_cached(clock):
+    tokens = VerifiedTokenCache(maxsize=2, clock=clock)
+    tokens.set("token", {'username': "Mart"}, "key")
+    tokens.set("expired", claims_expiring_in(-1), "key")
+
+    assert tokens.get("token", "key") is None
+    assert tokens.get("expired", "key") is None
+
+
+def test_verified_tokens_dropped_when_key_changes(clock):
+    tokens = VerifiedTokenCache(maxsize=2, clock=clock)
+    tokens.set("token", claims_expiring_in(60), "key")
+
+    assert tokens.get("token", "new-key") is None
+    assert tokens.get("token", "key") is None
+
+
+@pytest.fixture
+def db_session():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    with Session(engine) as session:
+        yield session
+    user_cache.clear()
+    auth_cache.clear()
+
+
+def test_committed_user_changes_invalidate_cache(db_session):
+    user = User(username="Mart", email="user@example.com", password="hashed", name="string", firstname="string",
+                date_of_birth=date(2025, 1, 29), phone_number="+237699245729", address="string", is_verified=False)
+    user_cache.set("Mart", "stale")
+    db_session.add(user)
+    db_session.flush()
+    assert user_cache.get("Mart") == "stale"
+
+    db_session.commit()
+    assert user_cache.get("Mart") is None
+
+    user_cache.set("Mart", UserSnapshot.from_orm(user))
+    auth_cache.set("Mart", AuthRecord("Mart", "user@example.com", "hashed", False))
+    user.is_verified = True
+    db_session.commit()
+    assert user_cache.get("Mart") is None
+    assert auth_cache.get("Mart") is None
+
+
+def test_rolled_back_changes_keep_cache(db_session):
+    user_cache.set("Mart", "cached")
+    db_session.add(User(username="Mart", email="user@example.com", password="hashed", name="string",
+                        firstname="string", date_of_birth=date(2025, 1, 29), phone_number="+237699245729",
+                        address="string", is_verified=False))
+    db_session.flush()
+    db_session.rollback()
+    db_session.commit()
+
+    assert user_cache.get("Mart") == "cached"
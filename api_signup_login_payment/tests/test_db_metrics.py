@@ -0,0 +1,58 @@
+import logging
+from prometheus_client import REGISTRY
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from db_metrics import PoolMetrics, CheckoutTimingSession, current_route
+
+
+def sample(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+@pytest.mark.asyncio
+async def test_pool_events_are_counted():
+    engine = create_async_engine("sqlite+aiosqlite://")
+    PoolMetrics(hold_warning=1.0).instrument(engine, pool='test_events')
+
+    async with engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+        assert sample('db_pool_checked_out_connections', pool='test_events') == 1
+    await engine.dispose()
+
+    assert sample('db_pool_checkouts_total', pool='test_events') == 1
+    assert sample('db_pool_checked_out_connections', pool='test_events') == 0
+    assert sample('db_pool_open_connections', pool='test_events') == 0
+    assert sample('db_connection_lifetime_seconds_count', pool='test_events') == 1
+
+
+@pytest.mark.asyncio
+async def test_session_checks_out_on_first_statement():
+    engine = create_async_engine("sqlite+aiosqlite://")
+    PoolMetrics(hold_warning=1.0).instrument(engine, pool='test_lazy')
+    session_factory = async_sessionmaker(engine, class_=AsyncSession, sync_session_class=CheckoutTimingSession)
+    current_route.set('/lazy')
+
+    async with session_factory() as db:
+        assert sample('db_pool_checkouts_total', pool='test_lazy') == 0
+        await db.execute(text("SELECT 1"))
+        await db.execute(text("SELECT 2"))
+        assert sample('db_pool_checkouts_total', pool='test_lazy') == 1
+        assert sample('db_pool_checkout_wait_seconds_count', pool='test_lazy') == 1
+        await db.commit()
+        assert sample('db_connection_hold_seconds_count', route='/lazy') == 1
+    await engine.dispose()
+    current_route.set(None)
+
+
+def test_long_held_connection_warns(caplog):
+    metrics = PoolMetrics(hold_warning=0.5)
+
+    with caplog.at_level(logging.WARNING, logger="db_metrics"):
+        metrics.observe_connection_hold(0.1, "/login")
+        metrics.observe_connection_hold(2.0, "/token")
+
+    assert sample('db_long_held_connections_total', route='/token') == 1
+    assert sample('db_long_held_connections_total', route='/login') == 0
+    assert "/token" in caplog.text
+    assert sample('db_connection_hold_seconds_count', route='/login') == 1
@@ -1,18 +1,41 @@
+from datetime import datetime, timedelta
 import pytest
+import pytest_asyncio
 import pyotp
 import jwt
 from unittest.mock import MagicMock, patch, ANY
 from fastapi import HTTPException, status
-from sqlalchemy.orm import Session
-from user.models import User
-from user.validators import Credentials
-from user.dependencies import verify_token_email, get_user, authenticate_user, otp_checker, get_current_user
+from sqlalchemy import insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from user.models import User, OtpChallenge
+from user.cache import user_cache, auth_cache, token_cache, UserSnapshot, AuthRecord
+from user.validators import Credentials, RefreshToken
+from user.utils import create_access_token, create_session_tokens, create_otp_challenge, OTP_TOKEN, SESSION_TOKEN, \
+    REFRESH_TOKEN
+from user.keys import KeyRing, generate_key, keyring
+from user.dependencies import verify_email, get_user, get_auth_record, get_auth_record_by_login, \
+    verify_user_credentials, otp_checker, get_current_user, decode_token, verify_otp_token, get_session, \
+    verify_refresh_token, get_admin_session
+import config
+from tests.factories import user as seed_user
+
+
+@pytest.fixture(autouse=True)
+def empty_caches():
+    user_cache.clear()
+    auth_cache.clear()
+    token_cache.clear()
+    yield
+    user_cache.clear()
+    auth_cache.clear()
+    token_cache.clear()
 
 
 @pytest.fixture
 def db_session():
     # Set up a test database session
-    session = MagicMock(spec=Session)
+    session = MagicMock(spec=AsyncSession)
     yield session
 
 
@@ -52,49 +75,124 @@ def otp_code():
 
 
 @pytest.mark.asyncio
-async def test_verify_token_email_success(db_session, user: User, token):
-    # Mock the jwt.decode function to return a valid payload
-    with patch("user.dependencies.jwt.decode", return_value={"username": "testuser"}):
-        # Mock the database query to return a user
-        db_session.query.return_value.filter.return_value.first.return_value = user
+async def test_verify_email_success(db_session, token):
+    db_session.info = {}
+    # Mock the keyring.decode function to return a valid payload
+    with patch("user.dependencies.keyring.decode", return_value={"username": "testuser"}):
+        # The UPDATE ... RETURNING returns the username of the verified user
+        db_session.scalar.return_value = "testuser"
 
-        result = await verify_token_email(token, db_session)
+        result = await verify_email(token, db_session)
 
-        assert result['user'] == user
-        assert result['session'] == db_session
+        assert result == "testuser"
+        db_session.scalar.assert_awaited_once()
+        statement = str(db_session.scalar.call_args.args[0])
+        assert statement.startswith("UPDATE users SET is_verified")
+        assert "RETURNING users.username" in statement
+        # The cached user is dropped once the caller commits
+        assert db_session.info['written_usernames'] == {"testuser"}
 
 
 @pytest.mark.asyncio
-async def test_verify_token_email_invalid_token(db_session):
+async def test_verify_email_already_verified(db_session, token):
+    db_session.info = {}
+    with patch("user.dependencies.keyring.decode", return_value={"username": "testuser"}):
+        db_session.scalar.return_value = None
+
+        assert await verify_email(token, db_session) is None
+        assert 'written_usernames' not in db_session.info
+
+
+@pytest.mark.asyncio
+async def test_verify_email_invalid_token(db_session):
     token = "invalid_token"
 
-    # Mock the jwt.decode function to raise an exception
-    with patch("user.dependencies.jwt.decode", side_effect=Exception("Invalid token")):
+    # Mock the keyring.decode function to raise an exception
+    with patch("user.dependencies.keyring.decode", side_effect=jwt.InvalidTokenError("Invalid token")):
         with pytest.raises(HTTPException) as exc_info:
-            await verify_token_email(token, db_session)
+            await verify_email(token, db_session)
 
         assert exc_info.value.status_code == 401
         assert exc_info.value.detail == "Invalid token"
+        db_session.scalar.assert_not_called()
+
+
+def selected(db_session, row: tuple | None):
+    """Makes db_session.execute() return a result whose first row is `row`."""
+    db_session.execute.return_value = MagicMock(**{'first.return_value': row})
 
 
 @pytest.mark.asyncio
 async def test_get_user(db_session, user: User):
     """Test the function user.dependencies.get_user"""
     username = "Mart"
-    db_session.scalar.return_value = user
+    snapshot = UserSnapshot.from_orm(user)
+    selected(db_session, tuple(getattr(snapshot, column.name) for column in UserSnapshot.columns()))
     result = await get_user(db_session, username)
 
-    assert result == user
-    db_session.scalar.assert_called_once_with(ANY)
+    assert result == snapshot
+    db_session.execute.assert_awaited_once_with(ANY)
+
+
+@pytest.mark.asyncio
+async def test_get_user_cached(db_session, user: User):
+    """A second lookup of the same user is served by the cache"""
+    snapshot = UserSnapshot.from_orm(user)
+    selected(db_session, tuple(getattr(snapshot, column.name) for column in UserSnapshot.columns()))
+    hits = user_cache.hits
+    first = await get_user(db_session, "Mart")
+    second = await get_user(db_session, "Mart")
+
+    assert first is second
+    db_session.execute.assert_awaited_once_with(ANY)
+    assert user_cache.hits == hits + 1
+
+
+@pytest.mark.asyncio
+async def test_get_user_unknown_not_cached(db_session):
+    selected(db_session, None)
+
+    assert await get_user(db_session, "Nobody") is None
+    assert len(user_cache) == 0
+
+
+@pytest.mark.asyncio
+async def test_get_auth_record_selects_only_auth_columns(db_session):
+    selected(db_session, ("Mart", "user@example.com", "hashed_password", True))
+    first = await get_auth_record(db_session, "Mart")
+    second = await get_auth_record(db_session, "Mart")
+
+    assert first == AuthRecord("Mart", "user@example.com", "hashed_password", True)
+    assert first is second
+    statement = db_session.execute.await_args.args[0]
+    assert [column.name for column in statement.selected_columns] == ["username", "email", "password",
+                                                                       "is_verified"]
+    db_session.execute.assert_awaited_once_with(ANY)
+    assert len(user_cache) == 0
+
+
+@pytest.mark.asyncio
+async def test_get_auth_record_by_email(create_database):
+    """A login with an @ is an email, matched whatever its case; an email is registered once"""
+    engine = await create_database('users.db')
+    async with engine.begin() as conn:
+        await conn.execute(insert(User).values(seed_user("Mart", email="user@example.com")))
+    async with async_sessionmaker(engine)() as db:
+        assert (await get_auth_record_by_login(db, "User@Example.com")).username == "Mart"
+        assert await get_auth_record_by_login(db, "other@example.com") is None
+        assert (await get_auth_record_by_login(db, "Mart")).email == "user@example.com"
+
+        with pytest.raises(IntegrityError):
+            await db.execute(insert(User).values(seed_user("Germinal", email="USER@example.com")))
 
 
 @pytest.mark.asyncio
 async def test_authenticate_user_success(db_session, credentials):
     user = User(username="Mart", password="hashed_password")
 
-    # Mock the get_user function to return the user
-    with patch("user.dependencies.get_user", return_value=user):
-        result = await authenticate_user(credentials, db_session)
+    # Mock the get_auth_record function to return the user
+    with patch("user.dependencies.get_auth_record", return_value=user):
+        result = await verify_user_credentials(credentials, db_session)
 
         assert result == user
         credentials.verify_pwd.assert_called_once_with(user.password)
@@ -102,9 +200,9 @@ async def test_authenticate_user_success(db_session, credentials):
 
 @pytest.mark.asyncio
 async def test_authenticate_user_no_user(db_session, credentials):
-    # Mock the get_user function to return None
-    with patch("user.dependencies.get_user", return_value=None):
-        result = await authenticate_user(credentials, db_session)
+    # Mock the get_auth_record function to return None
+    with patch("user.dependencies.get_auth_record", return_value=None):
+        result = await verify_user_credentials(credentials, db_session)
 
         assert result is False
 
@@ -113,17 +211,46 @@ async def test_authenticate_user_no_user(db_session, credentials):
 async def test_authenticate_user_invalid_password(db_session, credentials):
     user = User(username="Mart", password="hashed_password")
 
-    # Mock the get_user function to return the user
-    with patch("user.dependencies.get_user", return_value=user):
+    # Mock the get_auth_record function to return the user
+    with patch("user.dependencies.get_auth_record", return_value=user):
         # Mock the verify_pwd method to return False
         credentials.verify_pwd.return_value = False
 
-        result = await authenticate_user(credentials, db_session)
+        result = await verify_user_credentials(credentials, db_session)
 
         assert result is False
         credentials.verify_pwd.assert_called_once_with(user.password)
 
 
+def test_decode_token_cached():
+    token = create_access_token({'username': "Mart"})
+
+    with patch("user.dependencies.keyring.decode", wraps=keyring.decode) as keyring_decode:
+        first = decode_token(token)
+        second = decode_token(token)
+
+    assert first['username'] == second['username'] == "Mart"
+    keyring_decode.assert_called_once()
+
+
+def test_decode_token_cache_dropped_on_key_rotation():
+    token = create_access_token({'username': "Mart"})
+    decode_token(token)
+
+    # The key which signed the token left the key set
+    with patch("user.dependencies.keyring", KeyRing([generate_key(0)], grace=0)):
+        with pytest.raises(jwt.PyJWTError):
+            decode_token(token)
+
+
+def test_decode_token_invalid_signature_not_cached():
+    token = jwt.encode({'username': "Mart"}, "another-key", config.TOKEN_ALGORITHM)
+
+    for _ in range(2):
+        with pytest.raises(jwt.PyJWTError):
+            decode_token(token)
+
+
 @pytest.fixture
 def otp_secret():
     # Set up a mock OTP secret
@@ -149,152 +276,156 @@ def test_otp_checker_invalid_otp(otp_secret):
     assert result is False
 
 
-@pytest.mark.asyncio
-async def test_get_current_user_success(db_session, token, otp_code, user: User):
-    payload = {"username": "testuser", "otp_secret": "secret"}
+def claims(token_type: str, minutes: int = 5, **extra) -> dict:
+    expiry = datetime.utcnow() + timedelta(minutes=minutes)
+    return {"username": "Mart", "token_type": token_type, "exp_time_token": expiry.isoformat(), **extra}
 
-    # Mock the jwt.decode function to return a valid payload
-    with patch("user.dependencies.jwt.decode", return_value=payload):
-        # Mock the get_user function to return the user
-        with patch("user.dependencies.get_user", return_value=user):
-            # Mock the otp_checker function to return True
-            with patch("user.dependencies.otp_checker", return_value=True):
-                result = await get_current_user(db_session, token, otp_code)
 
-                assert result == user
+@pytest.fixture
+def no_rate_limit():
+    with patch("user.dependencies.limit_username") as limit:
+        yield limit
 
 
-@pytest.mark.asyncio
-async def test_get_current_user_invalid_token(db_session, otp_code):
-    token = "invalid_token"
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+@pytest_asyncio.fixture
+async def otp_session(create_database, no_rate_limit):
+    engine = await create_database('otp.db')
+    async with engine.begin() as conn:
+        await conn.execute(insert(User).values(seed_user("Mart")))
+    async with async_sessionmaker(engine, expire_on_commit=False)() as db:
+        yield db
 
-    # Mock the jwt.decode function to raise an exception
-    with patch("user.dependencies.jwt.decode", side_effect=jwt.PyJWTError):
-        with pytest.raises(HTTPException) as exc_info:
-            await get_current_user(db_session, token, otp_code)
 
-        assert exc_info.value.status_code == credentials_exception.status_code
-        assert exc_info.value.detail == credentials_exception.detail
+async def challenge(db: AsyncSession) -> tuple[str, str]:
+    token, otp_code = await create_otp_challenge(db, "Mart")
+    await db.commit()
+    return token, otp_code
 
 
 @pytest.mark.asyncio
-async def test_get_current_user_no_user(db_session, token, otp_code):
-    payload = {"username": "Mart", "otp_secret": "secret"}
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+async def test_verify_otp_token_success(otp_session, no_rate_limit):
+    token, otp_code = await challenge(otp_session)
 
-    # Mock the jwt.decode function to return a valid payload
-    with patch("user.dependencies.jwt.decode", return_value=payload):
-        # Mock the get_user function to return None
-        with patch("user.dependencies.get_user", return_value=None):
-            with pytest.raises(HTTPException) as exc_info:
-                await get_current_user(db_session, token, otp_code)
-
-            assert exc_info.value.status_code == credentials_exception.status_code
-            assert exc_info.value.detail == credentials_exception.detail
+    # The secret is only on the server
+    assert 'otp_secret' not in keyring.decode(token)
+    assert (await verify_otp_token(otp_session, token, otp_code)).username == "Mart"
+    no_rate_limit.assert_awaited_once_with('otp', "Mart", ANY)
 
 
 @pytest.mark.asyncio
-async def test_get_current_user_invalid_otp(db_session, token, otp_code, user: User):
-    payload = {"username": "Mart", "otp_secret": "secret"}
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+async def test_verify_otp_token_is_single_use(otp_session):
+    token, otp_code = await challenge(otp_session)
+    await verify_otp_token(otp_session, token, otp_code)
+    await otp_session.commit()
 
-    # Mock the jwt.decode function to return a valid payload
-    with patch("user.dependencies.jwt.decode", return_value=payload):
-        # Mock the get_user function to return the user
-        with patch("user.dependencies.get_user", return_value=user):
-            # Mock the otp_checker function to return False
-            with patch("user.dependencies.otp_checker", return_value=False):
-                with pytest.raises(HTTPException) as exc_info:
-                    await get_current_user(db_session, token, otp_code)
+    with pytest.raises(HTTPException) as exc_info:
+        await verify_otp_token(otp_session, token, otp_code)
 
-                assert exc_info.value.status_code == credentials_exception.status_code
-                assert exc_info.value.detail == credentials_exception.detail
+    assert exc_info.value.status_code == status.HTTP_401_UNAUTHORIZED
+    assert await otp_session.scalar(select(OtpChallenge.id)) is None
 
 
 @pytest.mark.asyncio
-async def test_get_current_user_success(db_session, token, otp_code, user):
-    payload = {"username": "Mart", "otp_secret": "secret"}
+async def test_verify_otp_token_invalid_otp(otp_session):
+    token, otp_code = await challenge(otp_session)
 
-    # Mock the jwt.decode function to return a valid payload
-    with patch("user.dependencies.jwt.decode", return_value=payload):
-        # Mock the get_user function to return the user
-        with patch("user.dependencies.get_user", return_value=user):
-            # Mock the otp_checker function to return True
-            with patch("user.dependencies.otp_checker", return_value=True):
-                result = await get_current_user(db_session, token, otp_code)
+    with pytest.raises(HTTPException) as exc_info:
+        await verify_otp_token(otp_session, token, "000000" if otp_code != "000000" else "111111")
 
-                assert result == user
+    assert exc_info.value.status_code == status.HTTP_401_UNAUTHORIZED
+    assert exc_info.value.detail == "Could not validate credentials"
+    # A wrong code doesn't consume the challenge
+    assert (await verify_otp_token(otp_session, token, otp_code)).username == "Mart"
 
 
 @pytest.mark.asyncio
-async def test_get_current_user_invalid_token(db_session, otp_code):
+async def test_verify_otp_token_expired_challenge(otp_session):
+    token, otp_code = await challenge(otp_session)
+    await otp_session.execute(update(OtpChallenge).values(expires_at=datetime.utcnow() - timedelta(seconds=1)))
+
+    with pytest.raises(HTTPException):
+        await verify_otp_token(otp_session, token, otp_code)
+
+
+@pytest.mark.asyncio
+async def test_verify_otp_token_invalid_token(db_session, otp_code):
     token = "invalid_token"
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
 
-    # Mock the jwt.decode function to raise an exception
-    with patch("user.dependencies.jwt.decode", side_effect=jwt.PyJWTError):
+    # Mock the keyring.decode function to raise an exception
+    with patch("user.dependencies.keyring.decode", side_effect=jwt.PyJWTError):
         with pytest.raises(HTTPException) as exc_info:
-            await get_current_user(db_session, token, otp_code)
+            await verify_otp_token(db_session, token, otp_code)
 
-        assert exc_info.value.status_code == credentials_exception.status_code
-        assert exc_info.value.detail == credentials_exception.detail
+        assert exc_info.value.status_code == status.HTTP_401_UNAUTHORIZED
+        assert exc_info.value.detail == "Could not validate credentials"
 
 
 @pytest.mark.asyncio
-async def test_get_current_user_no_user(db_session, token, otp_code):
-    payload = {"username": "testuser", "otp_secret": "secret"}
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+async def test_verify_otp_token_rejects_session_token(db_session, token, otp_code):
+    with patch("user.dependencies.keyring.decode", return_value=claims(SESSION_TOKEN)):
+        with pytest.raises(HTTPException) as exc_info:
+            await verify_otp_token(db_session, token, otp_code)
+
+        assert exc_info.value.status_code == status.HTTP_401_UNAUTHORIZED
 
-    # Mock the jwt.decode function to return a valid payload
-    with patch("user.dependencies.jwt.decode", return_value=payload):
-        # Mock the get_user function to return None
-        with patch("user.dependencies.get_user", return_value=None):
-            with pytest.raises(HTTPException) as exc_info:
-                await get_current_user(db_session, token, otp_code)
 
-            assert exc_info.value.status_code == credentials_exception.status_code
-            assert exc_info.value.detail == credentials_exception.detail
+@pytest.mark.asyncio
+async def test_verify_otp_token_without_challenge_id(db_session, token, otp_code, no_rate_limit):
+    with patch("user.dependencies.keyring.decode", return_value=claims(OTP_TOKEN, otp_secret="secret")):
+        with pytest.raises(HTTPException):
+            await verify_otp_token(db_session, token, otp_code)
+
+    db_session.scalar.assert_not_called()
+
+
+def test_get_session_needs_no_otp_nor_database():
+    token = create_session_tokens("Mart")['access_token']
+
+    with patch("user.dependencies.otp_checker") as checker, patch("user.dependencies.get_user") as get_user_mock:
+        session = get_session(token)
+
+    assert session['username'] == "Mart"
+    checker.assert_not_called()
+    get_user_mock.assert_not_called()
+
+
+@pytest.mark.parametrize("payload", [
+    claims(OTP_TOKEN, otp_secret="secret"),
+    claims(REFRESH_TOKEN),
+    claims(SESSION_TOKEN, minutes=-1),
+    {"username": "Mart", "token_type": SESSION_TOKEN},
+])
+def test_get_session_rejects(payload, token):
+    with patch("user.dependencies.keyring.decode", return_value=payload):
+        with pytest.raises(HTTPException) as exc_info:
+            get_session(token)
+
+    assert exc_info.value.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+def test_get_admin_session():
+    with patch("user.dependencies.config.IMPORT_ADMIN_USERNAMES", {"Admin"}):
+        assert get_admin_session({"username": "Admin"}) == {"username": "Admin"}
+        with pytest.raises(HTTPException) as exc_info:
+            get_admin_session({"username": "Mart"})
+
+    assert exc_info.value.status_code == status.HTTP_403_FORBIDDEN
 
 
 @pytest.mark.asyncio
-async def test_get_current_user_invalid_otp(db_session, token, otp_code):
-    user = User(username="testuser")
-    payload = {"username": "testuser", "otp_secret": "secret"}
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+async def test_get_current_user(db_session, user: User):
+    with patch("user.dependencies.get_user", return_value=user) as get_user_mock:
+        assert await get_current_user(db_session, {"username": "Mart"}) == user
+
+    get_user_mock.assert_awaited_once_with(db_session, "Mart")
 
-    # Mock the jwt.decode function to return a valid payload
-    with patch("user.dependencies.jwt.decode", return_value=payload):
-        # Mock the get_user function to return the user
-        with patch("user.dependencies.get_user", return_value=user):
-            # Mock the otp_checker function to return False
-            with patch("user.dependencies.otp_checker", return_value=False):
-                with pytest.raises(HTTPException) as exc_info:
-                    await get_current_user(db_session, token, otp_code)
-
-                assert exc_info.value.status_code == credentials_exception.status_code
-                assert exc_info.value.detail == credentials_exception.detail
+
+@pytest.mark.asyncio
+async def test_verify_refresh_token(db_session, user: User):
+    tokens = create_session_tokens("Mart")
+
+    with patch("user.dependencies.get_auth_record", return_value=user):
+        assert await verify_refresh_token(db_session, RefreshToken(refresh_token=tokens['refresh_token'])) == user
+        # A session token can't be used to renew the session
+        with pytest.raises(HTTPException):
+            await verify_refresh_token(db_session, RefreshToken(refresh_token=tokens['access_token']))
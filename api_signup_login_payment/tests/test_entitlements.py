@@ -0,0 +1,131 @@
+import asyncio
+from datetime import date, datetime, timedelta
+from unittest.mock import patch
+import pytest
+import pytest_asyncio
+from fastapi import HTTPException
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
+from user.entitlements import Entitlement, EntitlementIndex, require_active_subscription
+from user.models import User, Subscription, SubscriptionType
+from tests.factories import user
+
+TODAY = date.today()
+
+
+@pytest_asyncio.fixture
+async def session_factory(create_database):
+    engine = await create_database('subscriptions.db')
+    async with engine.begin() as conn:
+        await conn.execute(SubscriptionType.__table__.insert().values(id=1, subscription_name="premium", price=10))
+        for username in ("Mart", "Germinal", "Forest"):
+            await conn.execute(User.__table__.insert().values(user(username)))
+        await conn.execute(Subscription.__table__.insert(), [
+            {"username": "Mart", "id_subscription_type": 1, "begin": TODAY - timedelta(days=10),
+             "end": TODAY + timedelta(days=20), "updated_at": datetime.utcnow()},
+            {"username": "Germinal", "id_subscription_type": 1, "begin": TODAY + timedelta(days=5),
+             "end": TODAY + timedelta(days=35), "updated_at": datetime.utcnow()},
+            {"username": "Forest", "id_subscription_type": 1, "begin": TODAY - timedelta(days=40),
+             "end": TODAY - timedelta(days=10), "updated_at": datetime.utcnow()},
+        ])
+    return async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+
+@pytest.mark.asyncio
+async def test_load_keeps_current_and_upcoming_subscriptions(session_factory):
+    index = EntitlementIndex(session_factory)
+    await index.load()
+
+    assert index.active_subscription("Mart") == Entitlement(1, "premium", TODAY - timedelta(days=10),
+                                                            TODAY + timedelta(days=20))
+    assert not index.has_active_subscription("Germinal")
+    assert index.has_active_subscription("Germinal", TODAY + timedelta(days=5))
+    # Expired subscriptions are not loaded
+    assert not index.has_active_subscription("Forest")
+    assert len(index) == 2
+
+
+@pytest.mark.asyncio
+async def test_refresh_picks_up_changed_subscriptions(session_factory):
+    index = EntitlementIndex(session_factory)
+    await index.load()
+
+    async with session_factory() as db:
+        await db.execute(update(Subscription).where(Subscription.username == "Forest")
+                         .values(end=TODAY + timedelta(days=30)))
+        await db.commit()
+    assert not index.has_active_subscription("Forest")
+
+    await index.refresh()
+    assert index.has_active_subscription("Forest")
+
+
+@pytest.mark.asyncio
+async def test_refresh_in_batches(session_factory):
+    index = EntitlementIndex(session_factory, batch_size=1)
+    await index.load()
+    async with session_factory() as db:
+        await db.execute(update(Subscription).values(end=TODAY + timedelta(days=60), updated_at=datetime.utcnow()))
+        await db.commit()
+
+    with patch.object(index, 'load', wraps=index.load) as load:
+        await index.refresh()
+    load.assert_not_called()
+    assert all(index.active_subscription(username).end == TODAY + timedelta(days=60) for username in ("Mart", "Forest"))
+
+
+@pytest.mark.asyncio
+async def test_large_refresh_reloads_everything(session_factory):
+    index = EntitlementIndex(session_factory, max_refresh=2)
+    await index.load()
+
+    with patch.object(index, 'load', wraps=index.load) as load:
+        await index.refresh(["Mart", "Germinal", "Forest"])
+    load.assert_awaited_once()
+    assert len(index) == 2
+
+
+@pytest.mark.asyncio
+async def test_start_is_bounded_by_the_timeout(session_factory):
+    index = EntitlementIndex(session_factory)
+
+    async def slow_load():
+        await asyncio.sleep(10)
+    with patch.object(index, 'load', side_effect=slow_load):
+        await asyncio.wait_for(index.start(timeout=0.01), 1)
+    try:
+        # Loaded later by the refresh task
+        assert index._task is not None and not index._task.done()
+        assert len(index) == 0
+    finally:
+        await index.stop()
+
+
+@pytest.mark.asyncio
+async def test_orm_writes_mark_users_stale_on_commit(session_factory, monkeypatch):
+    index = EntitlementIndex(session_factory)
+    await index.load()
+    monkeypatch.setattr("user.entitlements.entitlement_index", index)
+
+    async with session_factory() as db:
+        subscription = await db.get(Subscription, ("Mart", 1))
+        await db.delete(subscription)
+        await db.flush()
+        assert index._stale == set()
+        await db.commit()
+    assert index._stale == {"Mart"}
+
+    await index.refresh(index._stale)
+    assert not index.has_active_subscription("Mart")
+
+
+@pytest.mark.asyncio
+async def test_require_active_subscription(monkeypatch):
+    index = EntitlementIndex(session_factory=None)
+    index._entitlements = {"Mart": (Entitlement(1, "premium", TODAY, TODAY),)}
+    monkeypatch.setattr("user.entitlements.entitlement_index", index)
+
+    assert (await require_active_subscription({'username': "Mart"})).subscription_name == "premium"
+    with pytest.raises(HTTPException) as exc_info:
+        await require_active_subscription({'username': "Germinal"})
+    assert exc_info.value.status_code == 403
@@ -0,0 +1,63 @@
+import asyncio
+import pytest
+from fastapi import HTTPException
+from user.hashing import HashingExecutor, pwd_context
+
+
+@pytest.fixture
+def executor():
+    hashing = HashingExecutor(max_workers=2, max_pending=4)
+    yield hashing
+    hashing.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_hash_and_verify(executor):
+    hashed = await executor.hash("Stringst12@")
+
+    assert pwd_context.verify("Stringst12@", hashed)
+    assert await executor.verify("Stringst12@", hashed) is True
+    assert await executor.verify("Wrongpwd12@", hashed) is False
+    assert executor.pending == 0
+
+
+@pytest.mark.asyncio
+async def test_hash_many_keeps_order(executor):
+    passwords = [f"Stringst12@{i}" for i in range(5)]
+    hashed = await executor.hash_many(passwords)
+
+    assert len(hashed) == 5
+    assert all(pwd_context.verify(password, h) for password, h in zip(passwords, hashed))
+    assert await executor.hash_many([]) == []
+
+
+@pytest.mark.asyncio
+async def test_hash_many_keeps_workers_free(executor):
+    bulk = asyncio.create_task(executor.hash_many([f"Stringst12@{i}" for i in range(3)]))
+    await asyncio.sleep(0.1)
+
+    # A single bulk hash in flight, counted by the admission: a login still gets the other worker
+    assert executor.pending == 1
+    assert await executor.verify("Stringst12@", pwd_context.hash("Stringst12@")) is True
+    assert len(await bulk) == 3
+    assert executor.pending == 0
+
+
+@pytest.mark.asyncio
+async def test_rejects_when_queue_is_full(executor):
+    executor.max_pending = 1
+    first = asyncio.create_task(executor.hash("Stringst12@"))
+    await asyncio.sleep(0)
+
+    with pytest.raises(HTTPException) as exc_info:
+        await executor.hash("Stringst12@")
+
+    assert exc_info.value.status_code == 503
+    assert exc_info.value.headers == {"Retry-After": "1"}
+    assert pwd_context.verify("Stringst12@", await first)
+
+
+@pytest.mark.asyncio
+async def test_warm_up_starts_every_worker(executor):
+    assert await executor.warm_up() == 2
+    assert executor.pending == 0
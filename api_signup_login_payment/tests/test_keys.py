@@ -0,0 +1,117 @@
+import json
+import os
+import jwt
+import pytest
+from user.keys import KeyRing, SigningKey, create_keyring, generate_key, parse_keys, rotate
+
+OLD = SigningKey(kid="old", secret="old-secret", not_before=0)
+NEW = SigningKey(kid="new", secret="new-secret", not_before=1000)
+
+
+class FakeClock:
+    def __init__(self, now: float = 0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_tokens_carry_the_kid_of_the_active_key():
+    keyring = KeyRing([OLD], grace=60)
+    token = keyring.encode({'username': "Mart"})
+
+    assert jwt.get_unverified_header(token)['kid'] == "old"
+    assert keyring.decode(token) == {'username': "Mart"}
+
+
+def test_scheduled_key_is_accepted_before_it_signs():
+    clock = FakeClock(500)
+    keyring = KeyRing([OLD, NEW], grace=60, clock=clock)
+
+    assert keyring.active_key == OLD
+    assert keyring.decode(KeyRing([NEW], grace=60).encode({'username': "Mart"})) == {'username': "Mart"}
+
+    clock.now = 1000
+    assert keyring.active_key == NEW
+
+
+def test_replaced_key_accepted_during_grace_window():
+    clock = FakeClock(500)
+    keyring = KeyRing([OLD, NEW], grace=60, clock=clock)
+    token = keyring.encode({'username': "Mart"})
+    version = keyring.version
+
+    clock.now = 1059
+    assert keyring.decode(token) == {'username': "Mart"}
+    assert keyring.version == version
+
+    clock.now = 1060
+    with pytest.raises(jwt.InvalidTokenError):
+        keyring.decode(token)
+    assert keyring.version != version
+
+
+def test_unknown_kid_rejected():
+    token = jwt.encode({'username': "Mart"}, "old-secret", "HS256", headers={'kid': "other"})
+
+    with pytest.raises(jwt.InvalidTokenError):
+        KeyRing([OLD], grace=60).decode(token)
+
+
+def test_reload_picks_up_a_rotated_file(tmp_path):
+    path = str(tmp_path / "keys.json")
+    rotate(path, activate_in=0, grace=60)
+    keyring = KeyRing([], grace=60)
+    keyring.load_file(path)
+    first = keyring.active_key
+
+    new_key = rotate(path, activate_in=0, grace=60)
+    os.utime(path, (0, 0))
+    keyring.reload()
+
+    assert keyring.active_key == new_key
+    assert keyring.verification_secret(first.kid) == first.secret
+
+
+def test_reload_keeps_keys_when_file_is_broken(tmp_path):
+    path = tmp_path / "keys.json"
+    path.write_text(json.dumps({'keys': [OLD.to_dict()]}))
+    keyring = KeyRing([], grace=60)
+    keyring.load_file(str(path))
+
+    path.write_text("{not json")
+    os.utime(path, (0, 0))
+    keyring.reload()
+
+    assert keyring.active_key == OLD
+
+
+def test_rotate_drops_keys_out_of_grace(tmp_path):
+    path = str(tmp_path / "keys.json")
+    first = rotate(path, activate_in=0, grace=60, now=0)
+    second = rotate(path, activate_in=0, grace=60, now=100)
+    third = rotate(path, activate_in=600, grace=60, now=200)
+
+    with open(path) as f:
+        kids = [key.kid for key in parse_keys(f.read())]
+    # first was replaced at 100, its grace ended at 160
+    assert kids == [second.kid, third.kid]
+    assert first.kid not in kids
+
+
+def test_empty_keyring_fails_on_start():
+    with pytest.raises(RuntimeError):
+        KeyRing([], grace=60).start(30)
+
+
+def test_missing_keys_file_fails_at_startup(tmp_path, monkeypatch):
+    monkeypatch.setattr("user.keys.config.SIGNING_KEYS_FILE", str(tmp_path / "keys.json"))
+    with pytest.raises(FileNotFoundError):
+        create_keyring()
+
+    key = rotate(str(tmp_path / "keys.json"), activate_in=0, grace=60)
+    assert create_keyring().active_key == key
+
+
+def test_generated_keys_are_unique():
+    assert generate_key(0).kid != generate_key(0).kid
@@ -0,0 +1,53 @@
+import pytest
+from email import message_from_bytes
+from user.mail_templates import EmailTemplate, VERIFICATION_EMAIL, OTP_EMAIL
+
+
+@pytest.fixture
+def recipients():
+    return ["user@example.com"]
+
+
+def test_verification_email(recipients):
+    msg = message_from_bytes(VERIFICATION_EMAIL.render(recipients, "my.jwt.token"))
+
+    assert msg['Subject'] == "Account Verification"
+    assert msg['To'] == "user@example.com"
+    assert msg['Message-ID'] and msg['Date']
+    assert msg.get_content_type() == "multipart/alternative"
+    text, html = msg.get_payload()
+    assert text.get_content_type() == "text/plain"
+    assert html.get_content_type() == "text/html"
+    assert "http://localhost:8000/verification/?token=my.jwt.token" in text.get_payload()
+    assert 'href="http://localhost:8000/verification/?token=my.jwt.token"' in html.get_payload()
+
+
+def test_otp_email(recipients):
+    msg = message_from_bytes(OTP_EMAIL.render(recipients, "123456"))
+
+    assert msg['Subject'] == "Your OTP Verification Code"
+    text, html = msg.get_payload()
+    assert "123456" in text.get_payload()
+    assert "123456</h2>" in html.get_payload()
+
+
+def test_value_is_escaped_in_html_only(recipients):
+    msg = message_from_bytes(OTP_EMAIL.render(recipients, "<b>&"))
+
+    text, html = msg.get_payload()
+    assert "<b>&" in text.get_payload()
+    assert "&lt;b&gt;&amp;" in html.get_payload()
+
+
+def test_templates_are_compiled_once(recipients):
+    template = EmailTemplate('otp_email', "Your OTP Verification Code", slot='otp_code')
+    template.load()
+    chunks = template._chunks
+
+    template.render(recipients, "111111")
+    template.render(recipients, "222222")
+
+    assert template._chunks is chunks
+    # Every message gets its own identifier
+    assert message_from_bytes(template.render(recipients, "1"))['Message-ID'] != \
+        message_from_bytes(template.render(recipients, "1"))['Message-ID']
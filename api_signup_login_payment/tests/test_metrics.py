@@ -0,0 +1,81 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+import os
+from metrics import setup_metrics, instrument_queries, time_stage, stats_collector, REGISTRY
+from user.cache import TTLCache
+
+
+def sample(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    setup_metrics(app)
+
+    @app.get('/items/{item_id}')
+    def read_item(item_id: int):
+        return {'item_id': item_id}
+
+    return TestClient(app)
+
+
+def test_requests_are_counted_per_route_template(client):
+    before = sample('http_requests_total', method='GET', route='/items/{item_id}', status='200')
+    invalid = sample('http_requests_total', method='GET', route='/items/{item_id}', status='422')
+
+    client.get('/items/1')
+    client.get('/items/2')
+    client.get('/items/abc')
+
+    assert sample('http_requests_total', method='GET', route='/items/{item_id}', status='200') == before + 2
+    assert sample('http_requests_total', method='GET', route='/items/{item_id}', status='422') == invalid + 1
+
+
+def test_unmatched_routes_share_a_label(client):
+    before = sample('http_requests_total', method='GET', route='unmatched', status='404')
+
+    client.get('/nothing/here')
+
+    assert sample('http_requests_total', method='GET', route='unmatched', status='404') == before + 1
+
+
+def test_metrics_endpoint(client):
+    with time_stage('jwt_encode'):
+        pass
+    response = client.get('/metrics')
+
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain')
+    assert 'stage_duration_seconds_count{stage="jwt_encode"}' in response.text
+    assert 'http_request_duration_seconds_bucket' in response.text
+
+
+@pytest.mark.asyncio
+async def test_queries_are_timed():
+    engine = create_async_engine("sqlite+aiosqlite://")
+    instrument_queries(engine)
+    before = sample('stage_duration_seconds_count', stage='db_query')
+
+    async with engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+        with pytest.raises(Exception):
+            await conn.execute(text("SELECT * FROM missing_table"))
+    await engine.dispose()
+
+    assert sample('stage_duration_seconds_count', stage='db_query') == before + 2
+
+
+def test_component_stats_are_exported(client):
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.set("Mart", "user")
+    cache.get("Mart")
+    stats_collector.register('test_cache', cache.stats)
+
+    assert sample('test_cache_size', pid=str(os.getpid())) == 1
+    assert sample('test_cache_hits', pid=str(os.getpid())) == 1
+    assert 'test_cache_maxsize{pid=' in client.get('/metrics').text
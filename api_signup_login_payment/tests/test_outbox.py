@@ -0,0 +1,108 @@
+import pytest
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, AsyncMock, patch
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from user.models import EmailOutbox
+from user.outbox import OutboxWorker, queue_email, PENDING, SENT, FAILED
+from user.mail_templates import VERIFICATION_EMAIL, OTP_EMAIL
+
+
+@pytest.fixture
+def db_session():
+    session = MagicMock(spec=AsyncSession)
+    yield session
+
+
+@pytest.fixture
+def worker(db_session):
+    session_factory = MagicMock()
+    session_factory.return_value.__aenter__.return_value = db_session
+    return OutboxWorker(session_factory, batch_size=10, max_attempts=3, base_backoff=5.0)
+
+
+@pytest.fixture
+def outbox_row() -> EmailOutbox:
+    return EmailOutbox(id=1, recipients="user@example.com", template="verification_email", message_data="token",
+                       status=PENDING, attempts=1, next_attempt_at=datetime.utcnow())
+
+
+def test_queue_email(db_session):
+    row = queue_email(db_session, ["user@example.com"], OTP_EMAIL, "123456")
+
+    db_session.add.assert_called_once_with(row)
+    assert row.recipients == "user@example.com"
+    assert row.template == "otp_email"
+    assert row.message_data == "123456"
+    assert row.status == PENDING
+    db_session.commit.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_process_batch_delivered(worker, db_session, outbox_row):
+    with patch.object(worker, "claim_batch", AsyncMock(return_value=[outbox_row])):
+        with patch("user.outbox.deliver_email", AsyncMock()) as deliver_email:
+            processed = await worker.process_batch()
+
+    assert processed == 1
+    deliver_email.assert_awaited_once_with(["user@example.com"], VERIFICATION_EMAIL, "token")
+    assert outbox_row.status == SENT
+    assert outbox_row.sent_at is not None
+    # The token is not kept once delivered
+    assert outbox_row.message_data == ''
+    db_session.commit.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_process_batch_retried_with_backoff(worker, db_session, outbox_row):
+    with patch.object(worker, "claim_batch", AsyncMock(return_value=[outbox_row])):
+        with patch("user.outbox.deliver_email", AsyncMock(side_effect=Exception("SMTP down"))):
+            await worker.process_batch()
+
+    assert outbox_row.status == PENDING
+    assert outbox_row.last_error == "SMTP down"
+    assert outbox_row.message_data == "token"
+    assert outbox_row.next_attempt_at > datetime.utcnow() + timedelta(seconds=4)
+
+
+@pytest.mark.asyncio
+async def test_process_batch_gives_up_after_max_attempts(worker, db_session, outbox_row):
+    outbox_row.attempts = 3
+    with patch.object(worker, "claim_batch", AsyncMock(return_value=[outbox_row])):
+        with patch("user.outbox.deliver_email", AsyncMock(side_effect=Exception("SMTP down"))):
+            await worker.process_batch()
+
+    assert outbox_row.status == FAILED
+    assert outbox_row.message_data == ''
+
+
+@pytest.mark.asyncio
+async def test_process_batch_empty(worker, db_session):
+    with patch.object(worker, "claim_batch", AsyncMock(return_value=[])):
+        assert await worker.process_batch() == 0
+
+
+def test_backoff_is_capped(worker):
+    assert worker.backoff(1) == timedelta(seconds=5)
+    assert worker.backoff(3) == timedelta(seconds=20)
+    assert worker.backoff(30) == timedelta(seconds=worker.max_backoff)
+
+
+@pytest.mark.asyncio
+async def test_purge_deletes_old_delivered_rows(create_database):
+    session_factory = async_sessionmaker(await create_database('outbox.db'), class_=AsyncSession,
+                                         expire_on_commit=False)
+    old = datetime.utcnow() - timedelta(days=8)
+    async with session_factory() as db:
+        db.add_all([
+            EmailOutbox(recipients=recipient, template="otp_email", message_data="", status=status,
+                        created_at=created_at)
+            for recipient, status, created_at in [("a@example.com", SENT, old), ("b@example.com", FAILED, old),
+                                                  ("c@example.com", PENDING, old),
+                                                  ("d@example.com", SENT, datetime.utcnow())]
+        ])
+        await db.commit()
+
+    assert await OutboxWorker(session_factory, retention=timedelta(days=7)).purge() == 2
+    async with session_factory() as db:
+        assert set(await db.scalars(select(EmailOutbox.recipients))) == {"c@example.com", "d@example.com"}
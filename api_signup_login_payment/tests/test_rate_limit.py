@@ -0,0 +1,125 @@
+import asyncio
+import pytest
+import pytest_asyncio
+from fastapi import HTTPException
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
+from user.rate_limit import Limit, MemoryBackend, DatabaseBackend, RateLimiter, LoadShedder
+
+
+class FakeClock:
+    def __init__(self, now: float = 0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_limit_parse():
+    limit = Limit.parse("5/60")
+
+    assert limit == Limit(capacity=5, period=60)
+    assert limit.interval == 12
+
+
+@pytest.mark.asyncio
+async def test_memory_bucket_allows_burst_then_refills():
+    clock = FakeClock(100)
+    backend = MemoryBackend(max_keys=10, sweep_interval=60, clock=clock)
+    limit = Limit(capacity=3, period=30)
+
+    assert [await backend.take("ip:1", limit) for _ in range(3)] == [0, 0, 0]
+    assert await backend.take("ip:1", limit) == pytest.approx(10)
+    # Other keys have their own bucket
+    assert await backend.take("ip:2", limit) == 0
+
+    clock.now = 110
+    assert await backend.take("ip:1", limit) == 0
+    assert await backend.take("ip:1", limit) > 0
+
+
+@pytest.mark.asyncio
+async def test_memory_backend_is_bounded_and_swept():
+    clock = FakeClock(0)
+    backend = MemoryBackend(max_keys=2, sweep_interval=60, clock=clock)
+    limit = Limit(capacity=1, period=10)
+
+    for key in ("a", "b", "c"):
+        await backend.take(key, limit)
+    assert len(backend) == 2
+    # "a" was the least recently used: evicted, so its bucket is full again
+    assert await backend.take("a", limit) == 0
+
+    clock.now = 60
+    await backend.take("d", limit)
+    assert len(backend) == 1
+
+
+@pytest_asyncio.fixture
+async def session_factory(create_database):
+    return async_sessionmaker(await create_database('limits.db'), class_=AsyncSession)
+
+
+@pytest.mark.asyncio
+async def test_database_backend_shares_buckets(session_factory):
+    clock = FakeClock(1000)
+    # Two workers using the same database
+    first = DatabaseBackend(session_factory, sweep_interval=60, clock=clock)
+    second = DatabaseBackend(session_factory, sweep_interval=60, clock=clock)
+    limit = Limit(capacity=2, period=20)
+
+    assert await first.take("token:ip:1", limit) == 0
+    assert await second.take("token:ip:1", limit) == 0
+    assert await first.take("token:ip:1", limit) == 10
+
+    clock.now = 1010
+    assert await second.take("token:ip:1", limit) == 0
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_raises_429_with_retry_after():
+    limiter = RateLimiter(MemoryBackend(max_keys=10, sweep_interval=60, clock=FakeClock(0)))
+    limit = Limit(capacity=1, period=30)
+    await limiter.check("token:username:Mart", limit)
+
+    with pytest.raises(HTTPException) as exc_info:
+        await limiter.check("token:username:Mart", limit)
+    assert exc_info.value.status_code == 429
+    assert exc_info.value.headers == {"Retry-After": "30"}
+
+
+@pytest.mark.asyncio
+async def test_load_shedder_rejects_above_limit():
+    shedder = LoadShedder(max_limit=1, min_limit=1, target_latency=10)
+    entered = asyncio.Event()
+    release = asyncio.Event()
+
+    async def slow_request():
+        async with shedder.admit():
+            entered.set()
+            await release.wait()
+
+    task = asyncio.create_task(slow_request())
+    await entered.wait()
+    with pytest.raises(HTTPException) as exc_info:
+        async with shedder.admit():
+            pass
+    assert exc_info.value.status_code == 503
+    assert shedder.shed == 1
+
+    release.set()
+    await task
+    assert shedder.in_flight == 0
+
+
+def test_load_shedder_limit_adapts_to_latency():
+    shedder = LoadShedder(max_limit=10, min_limit=2, target_latency=1)
+
+    for _ in range(50):
+        shedder._adjust(5)
+    assert shedder.limit == 2
+
+    shedder._adjust(0.1)
+    assert shedder.limit == pytest.approx(2.5)
+    for _ in range(200):
+        shedder._adjust(0.1)
+    assert shedder.limit == 10
@@ -0,0 +1,124 @@
+from datetime import date, datetime, timedelta
+import pytest
+import pytest_asyncio
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
+from user.models import EmailOutbox, JobCheckpoint, Subscription, SubscriptionType, User
+from user.renewals import RenewalJob, JOB_NAME
+from tests.factories import user
+
+RUN_DATE = date(2026, 10, 1)
+
+
+def subscription(username: str, end: date, auto_renew: bool) -> dict:
+    return {"username": username, "id_subscription_type": 1, "begin": end - timedelta(days=29), "end": end,
+            "auto_renew": auto_renew, "notified_end": None, "updated_at": datetime.utcnow()}
+
+
+@pytest_asyncio.fixture
+async def engine(create_database):
+    # The cursor connection keeps reading while the batches commit
+    engine = await create_database('renewals.db', wal=True)
+    async with engine.begin() as conn:
+        await conn.execute(SubscriptionType.__table__.insert().values(id=1, subscription_name="premium", price=10,
+                                                                      duration_days=30))
+        await conn.execute(User.__table__.insert(), [user(f"user{i}") for i in range(5)])
+        await conn.execute(Subscription.__table__.insert(), [
+            subscription("user0", RUN_DATE + timedelta(days=3), auto_renew=True),
+            subscription("user1", RUN_DATE + timedelta(days=5), auto_renew=False),
+            subscription("user2", RUN_DATE + timedelta(days=20), auto_renew=True),  # outside the window
+            subscription("user3", RUN_DATE - timedelta(days=1), auto_renew=False),
+            subscription("user4", RUN_DATE + timedelta(days=7), auto_renew=True),
+        ])
+    return engine
+
+
+@pytest.fixture
+def session_factory(engine):
+    return async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+
+async def ends(session_factory) -> dict:
+    async with session_factory() as db:
+        return {row.username: (row.end, row.notified_end) for row in await db.scalars(select(Subscription))}
+
+
+async def outbox(session_factory) -> list[tuple[str, str, str]]:
+    async with session_factory() as db:
+        return [(row.recipients, row.template, row.message_data)
+                for row in await db.scalars(select(EmailOutbox).order_by(EmailOutbox.id))]
+
+
+@pytest.mark.asyncio
+async def test_renews_and_notifies_within_window(engine, session_factory):
+    report = await RenewalJob(engine, session_factory, window_days=7, batch_size=2).run(RUN_DATE)
+
+    assert (report.rows_read, report.renewed, report.notified, report.resumed) == (3, 2, 1, False)
+    assert await ends(session_factory) == {
+        "user0": (RUN_DATE + timedelta(days=33), None),
+        "user1": (RUN_DATE + timedelta(days=5), RUN_DATE + timedelta(days=5)),
+        "user2": (RUN_DATE + timedelta(days=20), None),
+        # Already ended: neither renewed nor notified
+        "user3": (RUN_DATE - timedelta(days=1), None),
+        "user4": (RUN_DATE + timedelta(days=37), None),
+    }
+    assert sorted(await outbox(session_factory)) == [
+        ("user0@example.com", "subscription_renewed", (RUN_DATE + timedelta(days=33)).isoformat()),
+        ("user1@example.com", "subscription_expiring", (RUN_DATE + timedelta(days=5)).isoformat()),
+        ("user4@example.com", "subscription_renewed", (RUN_DATE + timedelta(days=37)).isoformat()),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_long_expired_subscriptions_are_left_alone(engine, session_factory):
+    async with session_factory() as db:
+        await db.execute(insert(User).values(user("user5")))
+        await db.execute(insert(Subscription).values(subscription("user5", RUN_DATE - timedelta(days=90),
+                                                                  auto_renew=True)))
+        await db.commit()
+
+    for day in range(3):
+        await RenewalJob(engine, session_factory, window_days=7).run(RUN_DATE + timedelta(days=day))
+
+    assert (await ends(session_factory))["user5"] == (RUN_DATE - timedelta(days=90), None)
+    assert not [row for row in await outbox(session_factory) if row[0] == "user5@example.com"]
+
+
+@pytest.mark.asyncio
+async def test_second_run_sends_nothing_again(engine, session_factory):
+    job = RenewalJob(engine, session_factory, window_days=7, batch_size=2)
+    await job.run(RUN_DATE)
+    report = await job.run(RUN_DATE)
+
+    assert (report.rows_read, report.renewed, report.notified) == (0, 0, 0)
+    assert len(await outbox(session_factory)) == 3
+
+
+@pytest.mark.asyncio
+async def test_crashed_run_resumes_after_last_batch(engine, session_factory, monkeypatch):
+    job = RenewalJob(engine, session_factory, window_days=7, batch_size=2)
+    process = job._process
+    calls = 0
+
+    async def crash_on_second_batch(*args):
+        nonlocal calls
+        calls += 1
+        if calls == 2:
+            raise ConnectionError("database went away")
+        return await process(*args)
+
+    monkeypatch.setattr(job, '_process', crash_on_second_batch)
+    with pytest.raises(ConnectionError):
+        await job.run(RUN_DATE)
+    monkeypatch.undo()
+
+    # Resumed the next day: still computed for the date of the interrupted run
+    report = await job.run(RUN_DATE + timedelta(days=1))
+    assert report.resumed is True
+    assert report.run_date == RUN_DATE
+    assert (report.rows_read, report.renewed, report.notified) == (1, 1, 0)
+    assert len(await outbox(session_factory)) == 3
+    async with session_factory() as db:
+        checkpoint = await db.get(JobCheckpoint, JOB_NAME)
+        assert checkpoint.rows_processed == 3
+        assert checkpoint.finished_at is not None
@@ -0,0 +1,69 @@
+import pytest
+import pytest_asyncio
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
+from database import routing_session_class, USE_PRIMARY
+from user.models import User
+from tests.factories import user
+
+
+@pytest_asyncio.fixture
+async def databases(create_database):
+    # Two local databases: the replica holds a user the primary doesn't know, so reads show where they ran
+    primary = await create_database('primary.db')
+    replica = await create_database('replica.db')
+    for engine, username in ((primary, "on-primary"), (replica, "on-replica")):
+        async with engine.begin() as conn:
+            await conn.execute(User.__table__.insert().values(user(username)))
+    return primary, replica
+
+
+@pytest.fixture
+def session_factory(databases):
+    primary, replica = databases
+    return async_sessionmaker(primary, class_=AsyncSession, expire_on_commit=False,
+                              sync_session_class=routing_session_class(primary, [replica]))
+
+
+async def usernames(db: AsyncSession) -> list[str]:
+    return list(await db.scalars(select(User.username)))
+
+
+@pytest.mark.asyncio
+async def test_reads_go_to_the_replica(session_factory):
+    async with session_factory() as db:
+        assert await usernames(db) == ["on-replica"]
+
+
+@pytest.mark.asyncio
+async def test_reads_after_a_write_go_to_the_primary(session_factory):
+    async with session_factory() as db:
+        db.add(User(**user("created")))
+        await db.flush()
+
+        assert sorted(await usernames(db)) == ["created", "on-primary"]
+        await db.commit()
+        assert db.info[USE_PRIMARY] is True
+
+
+@pytest.mark.asyncio
+async def test_locking_reads_and_raw_sql_go_to_the_primary(session_factory):
+    async with session_factory() as db:
+        assert list(await db.scalars(select(User.username).with_for_update())) == ["on-primary"]
+    async with session_factory() as db:
+        assert list(await db.scalars(text("SELECT username FROM users"))) == ["on-primary"]
+
+
+@pytest.mark.asyncio
+async def test_pinned_session_reads_from_the_primary(session_factory):
+    async with session_factory() as db:
+        db.info[USE_PRIMARY] = True
+        assert await usernames(db) == ["on-primary"]
+
+
+@pytest.mark.asyncio
+async def test_without_replica_everything_goes_to_the_primary(databases):
+    primary, _ = databases
+    factory = async_sessionmaker(primary, class_=AsyncSession, sync_session_class=routing_session_class(primary, []))
+    async with factory() as db:
+        assert await usernames(db) == ["on-primary"]
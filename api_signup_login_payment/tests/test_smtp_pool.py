@@ -0,0 +1,84 @@
+import asyncio
+import pytest
+import aiosmtplib
+from email.message import EmailMessage
+from unittest.mock import MagicMock, AsyncMock, patch
+from user.smtp_pool import SMTPPool, _PooledConnection
+import config
+
+
+def fake_connection() -> _PooledConnection:
+    smtp = MagicMock(spec=aiosmtplib.SMTP)
+    smtp.is_connected = True
+    return _PooledConnection(smtp)
+
+
+@pytest.fixture
+def pool():
+    smtp_pool = SMTPPool(config.conf, max_size=2, max_messages=3)
+    with patch.object(smtp_pool, "_connect", AsyncMock(side_effect=lambda: fake_connection())):
+        yield smtp_pool
+
+
+@pytest.fixture
+def message() -> tuple[str, list[str], bytes]:
+    msg = EmailMessage()
+    msg['Subject'] = "Account Verification"
+    msg['To'] = "user@example.com"
+    return "noreply@example.com", ["user@example.com"], msg.as_bytes()
+
+
+@pytest.mark.asyncio
+async def test_connection_is_reused(pool, message):
+    for _ in range(3):
+        await pool.sendmail(*message)
+
+    stats = pool.stats()
+    assert stats['connections_opened'] == 1
+    assert stats['connections_reused'] == 2
+    assert stats['messages_sent'] == 3
+    assert stats['idle'] == 1
+
+
+@pytest.mark.asyncio
+async def test_connection_recycled_after_max_messages(pool, message):
+    for _ in range(4):
+        await pool.sendmail(*message)
+
+    assert pool.stats()['connections_opened'] == 2
+    assert pool.stats()['connections_closed'] == 1
+
+
+@pytest.mark.asyncio
+async def test_reconnects_when_server_dropped_connection(pool, message):
+    await pool.sendmail(*message)
+    pool._idle[0].smtp.sendmail.side_effect = aiosmtplib.SMTPServerDisconnected("bye")
+
+    await pool.sendmail(*message)
+
+    stats = pool.stats()
+    assert stats['reconnects'] == 1
+    assert stats['messages_sent'] == 2
+    assert stats['send_failures'] == 0
+
+
+@pytest.mark.asyncio
+async def test_failed_send_drops_connection(pool, message):
+    await pool.sendmail(*message)
+    pool._idle[0].smtp.sendmail.side_effect = aiosmtplib.SMTPRecipientsRefused([])
+
+    with pytest.raises(aiosmtplib.SMTPRecipientsRefused):
+        await pool.sendmail(*message)
+
+    stats = pool.stats()
+    assert stats['send_failures'] == 1
+    assert stats['idle'] == 0
+    assert stats['in_use'] == 0
+
+
+@pytest.mark.asyncio
+async def test_concurrent_connections_are_capped(pool, message):
+    await asyncio.gather(*(pool.sendmail(*message) for _ in range(6)))
+
+    assert pool.stats()['connections_opened'] <= pool.max_size
+    assert pool.stats()['messages_sent'] == 6
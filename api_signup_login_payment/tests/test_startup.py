@@ -0,0 +1,39 @@
+import pytest
+from sqlalchemy import inspect
+from sqlalchemy.ext.asyncio import create_async_engine
+from migrate import migrate, MIGRATIONS
+from startup import StartupReport
+
+
+@pytest.mark.asyncio
+async def test_new_database_is_created_at_latest_version(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'schema.db'}")
+    try:
+        assert await migrate(engine) == [name for name, _ in MIGRATIONS]
+        assert await migrate(engine) == []
+        async with engine.connect() as conn:
+            columns = await conn.run_sync(lambda sync_conn: [column['name'] for column in
+                                                             inspect(sync_conn).get_columns('subscription')])
+        assert {'updated_at', 'auto_renew', 'notified_end'} <= set(columns)
+    finally:
+        await engine.dispose()
+
+
+def test_startup_report_times_steps():
+    report = StartupReport()
+    with report.step('templates'):
+        pass
+    with report.optional_step('db_pool'):
+        raise ConnectionError("database is down")
+
+    assert set(report.steps) == {'templates', 'db_pool'}
+    assert report.failed == ['db_pool']
+    assert report.total >= sum(report.steps.values())
+
+
+def test_failing_required_step_raises():
+    report = StartupReport()
+    with pytest.raises(RuntimeError):
+        with report.step('signing_keys'):
+            raise RuntimeError("No signing key loaded")
+    assert 'signing_keys' in report.steps
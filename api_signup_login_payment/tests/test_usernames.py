@@ -0,0 +1,110 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+import pytest
+import pytest_asyncio
+from sqlalchemy import event, insert
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
+from user.models import User
+from user.usernames import BloomFilter, UsernameIndex, is_username_taken, mark_username_registered
+from tests.factories import user
+
+
+@pytest_asyncio.fixture
+async def session_factory(create_database):
+    engine = await create_database('usernames.db')
+    async with engine.begin() as conn:
+        await conn.execute(User.__table__.insert(), [user(f"user{i}") for i in range(50)])
+    return async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = BloomFilter(capacity=10000, error_rate=0.01)
+    for i in range(10000):
+        bloom.add(f"user{i}")
+
+    assert all(f"user{i}" in bloom for i in range(10000))
+    false_positives = sum(f"other{i}" in bloom for i in range(10000))
+    assert false_positives < 200
+    assert bloom.false_positive_rate() == pytest.approx(0.01, rel=0.2)
+    # About 9.6 bits per username at 1%
+    assert bloom.nbytes < 13000
+
+
+@pytest.mark.asyncio
+async def test_build_streams_every_username(session_factory):
+    index = UsernameIndex(session_factory, capacity=100, batch_size=7)
+    # Everything is "maybe taken" until the filter is built
+    assert index.might_exist("nobody")
+
+    await index.build()
+    assert all(index.might_exist(f"user{i}") for i in range(50))
+    assert index.stats()['usernames'] == 50
+    assert index.stats()['bytes'] > 0
+
+
+@pytest.mark.asyncio
+async def test_start_builds_in_the_background(session_factory):
+    index = UsernameIndex(session_factory, capacity=100)
+    index.start()
+    try:
+        # Not built yet when start returns
+        assert index._filter is None
+        for _ in range(100):
+            if index._filter is not None:
+                break
+            await asyncio.sleep(0.01)
+        assert index.stats()['usernames'] == 50
+    finally:
+        await index.stop()
+
+
+@pytest.mark.asyncio
+async def test_registered_usernames_are_added_on_commit(session_factory, monkeypatch):
+    index = UsernameIndex(session_factory, capacity=100)
+    await index.build()
+    monkeypatch.setattr("user.usernames.username_index", index)
+
+    async with session_factory() as db:
+        await db.execute(insert(User).values(user("Mart")))
+        mark_username_registered(db, "Mart")
+        await db.rollback()
+    assert index._filter is not None and "Mart" not in index._filter
+
+    async with session_factory() as db:
+        await db.execute(insert(User).values(user("Mart")))
+        mark_username_registered(db, "Mart")
+        await db.commit()
+    assert "Mart" in index._filter
+
+
+@pytest.mark.asyncio
+async def test_available_username_needs_no_query(session_factory, monkeypatch):
+    index = UsernameIndex(session_factory, capacity=100)
+    await index.build()
+    monkeypatch.setattr("user.usernames.username_index", index)
+    db = MagicMock(spec=AsyncSession)
+    db.scalar = AsyncMock(return_value="user1")
+
+    assert await is_username_taken(db, "Germinal") is False
+    db.scalar.assert_not_awaited()
+
+    assert await is_username_taken(db, "user1") is True
+    db.scalar.assert_awaited_once()
+    assert index.stats()['negatives'] == 1
+
+
+@pytest.mark.asyncio
+async def test_available_username_checks_out_no_connection(session_factory, monkeypatch):
+    index = UsernameIndex(session_factory, capacity=100)
+    await index.build()
+    monkeypatch.setattr("user.usernames.username_index", index)
+    checkouts = []
+    event.listen(session_factory.kw['bind'].sync_engine, 'checkout', lambda *args: checkouts.append(args))
+
+    async with session_factory() as db:
+        assert await is_username_taken(db, "Germinal") is False
+    assert checkouts == []
+
+    async with session_factory() as db:
+        assert await is_username_taken(db, "user1") is True
+    assert len(checkouts) == 1
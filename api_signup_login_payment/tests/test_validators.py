@@ -1,5 +1,6 @@
 import pytest
-from user.validators import UserValidation, Credentials
+from user.validators import UserValidation, Credentials, UserPublic
+from user.cache import UserSnapshot
 from datetime import date
 from pydantic import ValidationError
 
@@ -163,3 +164,17 @@ def test_phone_pattern() -> None:
             phone_number="677448877",
             address="Mvog-ada Yaounde"
         )
+
+
+def test_user_public_from_snapshot() -> None:
+    """The response schema leaves the password hash out and doesn't run the validators again."""
+    snapshot = UserSnapshot(username="Germinal", email="germinal@gmail.com", password="$2b$12$hash", name="Forest",
+                            firstname="Germs", date_of_birth=date(1998, 12, 4), phone_number="+237677448877",
+                            address="Mvog-ada Yaounde", is_verified=True)
+    user = UserPublic.from_row(snapshot)
+    assert user.model_dump() == {
+        "username": "Germinal", "email": "germinal@gmail.com", "name": "Forest", "firstname": "Germs",
+        "date_of_birth": date(1998, 12, 4), "phone_number": "+237677448877", "address": "Mvog-ada Yaounde",
+        "is_verified": True
+    }
+    assert not hasattr(user, "password")
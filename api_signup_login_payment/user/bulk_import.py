@@ -0,0 +1,207 @@
+import csv
+import json
+from typing import AsyncIterator, List
+from fastapi import HTTPException, status
+from pydantic import ValidationError
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from user.hashing import hashing_executor
+from user.mail_templates import VERIFICATION_EMAIL
+from user.models import User
+from user.outbox import queue_email
+from user.usernames import mark_username_registered
+from user.utils import create_access_token
+from user.validators import UserValidation
+import config
+
+NDJSON = 'application/x-ndjson'
+CSV = 'text/csv'
+
+
+#############################################################################
+#                       PARSING THE UPLOADED FILE                           #
+#############################################################################
+def line_too_long(line_number: int) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=f"Line {line_number} is longer than {config.IMPORT_MAX_LINE_BYTES} bytes"
+    )
+
+
+def decode_line(line: bytes, line_number: int) -> str:
+    try:
+        return line.decode().rstrip('\r')
+    except UnicodeDecodeError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Line {line_number} is not valid UTF-8"
+        )
+
+
+# Only the received chunk is split, the incomplete last line being kept for the next one
+async def iter_lines(body: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    pending = bytearray()
+    line_number = 0
+    async for chunk in body:
+        *lines, rest = chunk.split(b'\n')
+        for line in lines:
+            line_number += 1
+            if pending:
+                pending += line
+                line, pending = bytes(pending), bytearray()
+            if len(line) > config.IMPORT_MAX_LINE_BYTES:
+                raise line_too_long(line_number)
+            yield decode_line(line, line_number)
+        pending += rest
+        if len(pending) > config.IMPORT_MAX_LINE_BYTES:
+            raise line_too_long(line_number + 1)
+    if pending:
+        yield decode_line(bytes(pending), line_number + 1)
+
+
+# Yields (first line number, CSV record) pairs: a quoted field may span several lines, which are gathered until
+# its closing quote (quotes are doubled inside a quoted field, so a record ends on an even number of quotes)
+async def iter_csv_records(lines: AsyncIterator[str]) -> AsyncIterator[tuple[int, list[str]]]:
+    parts = []
+    quotes = 0
+    size = 0
+    line_number = 0
+    async for line in lines:
+        line_number += 1
+        if not parts and not line.strip():
+            continue
+        parts.append(line)
+        quotes += line.count('"')
+        size += len(line) + 1
+        if size > config.IMPORT_MAX_LINE_BYTES:
+            raise line_too_long(line_number - len(parts) + 1)
+        if quotes % 2 == 0:
+            yield line_number - len(parts) + 1, next(csv.reader(['\n'.join(parts)]))
+            parts, quotes, size = [], 0, 0
+    if parts:
+        # Unterminated quoted field, read up to the end of the file
+        yield line_number - len(parts) + 1, next(csv.reader(['\n'.join(parts)]))
+
+
+# Yields (line number, record) pairs; a record which could not even be parsed is yielded as an error message
+async def iter_records(body: AsyncIterator[bytes], content_type: str) -> AsyncIterator[tuple[int, dict | str]]:
+    if content_type == CSV:
+        header = None
+        async for line_number, values in iter_csv_records(iter_lines(body)):
+            if header is None:
+                header = values
+            elif len(values) != len(header):
+                yield line_number, f"Expected {len(header)} columns, got {len(values)}"
+            else:
+                yield line_number, dict(zip(header, values))
+        return
+    line_number = 0
+    async for line in iter_lines(body):
+        line_number += 1
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield line_number, f"Invalid JSON: {e}"
+            continue
+        yield line_number, record if isinstance(record, dict) else "Expected a JSON object"
+
+
+#############################################################################
+#                       IMPORTING A CHUNK OF USERS                          #
+#############################################################################
+def _result(line_number: int | None, username: str | None, status: str, detail: str | None = None) -> bytes:
+    return (json.dumps({'line': line_number, 'username': username, 'status': status, 'detail': detail}) + '\n').encode()
+
+
+async def import_chunk(session_factory: async_sessionmaker, chunk: List[tuple[int, dict | str]]) -> List[bytes]:
+    results = {}
+    valid: List[tuple[int, UserValidation]] = []
+    seen = set()
+    seen_emails = set()
+    for line_number, record in chunk:
+        if isinstance(record, str):
+            results[line_number] = _result(line_number, None, 'rejected', record)
+            continue
+        try:
+            user = UserValidation(**record)
+        except (ValidationError, TypeError) as e:
+            results[line_number] = _result(line_number, record.get('username'), 'rejected', str(e))
+            continue
+        if user.username in seen:
+            results[line_number] = _result(line_number, user.username, 'rejected', "Duplicated username in the file")
+            continue
+        if user.email.lower() in seen_emails:
+            results[line_number] = _result(line_number, user.username, 'rejected', "Duplicated email in the file")
+            continue
+        seen.add(user.username)
+        seen_emails.add(user.email.lower())
+        valid.append((line_number, user))
+
+    if valid:
+        try:
+            hashed_passwords = await hashing_executor.hash_many([user.password for _, user in valid])
+        except HTTPException as e:
+            # The hashing pool is full: the rows of the chunk can be uploaded again later
+            for line_number, user in valid:
+                results[line_number] = _result(line_number, user.username, 'rejected', e.detail)
+            return [results[line_number] for line_number, _ in chunk]
+        rows = [
+            {**user.model_dump(exclude={'password'}), 'password': hashed_password, 'is_verified': False}
+            for (_, user), hashed_password in zip(valid, hashed_passwords)
+        ]
+        async with session_factory() as db:
+            created = dict((await db.execute(
+                # Rows whose username or email (unique whatever its case) is already registered are skipped
+                insert(User).values(rows).on_conflict_do_nothing()
+                .returning(User.username, User.email)
+            )).all())
+            # Verification emails for the whole chunk are written to the outbox in the same transaction
+            for username, email in created.items():
+                queue_email(db, [email], VERIFICATION_EMAIL, create_access_token(data={'username': username}))
+                mark_username_registered(db, username)
+            await db.commit()
+        for line_number, user in valid:
+            if user.username in created:
+                results[line_number] = _result(line_number, user.username, 'created')
+            else:
+                results[line_number] = _result(line_number, user.username, 'rejected',
+                                               "Username or email already registered")
+
+    return [results[line_number] for line_number, _ in chunk]
+
+
+async def import_users(session_factory: async_sessionmaker, body: AsyncIterator[bytes],
+                       content_type: str) -> AsyncIterator[bytes]:
+    """Imports the users of a NDJSON or CSV stream, chunk by chunk, and yields one NDJSON result per row.
+
+    A line over IMPORT_MAX_LINE_BYTES (413) or which isn't UTF-8 (400) raises before the first result; once
+    results are streamed, it ends the import with an 'aborted' result instead.
+    """
+    chunk = []
+    streamed = False
+    try:
+        async for line_record in iter_records(body, content_type):
+            chunk.append(line_record)
+            if len(chunk) >= config.IMPORT_CHUNK_SIZE:
+                for result in await import_chunk(session_factory, chunk):
+                    streamed = True
+                    yield result
+                chunk = []
+    except HTTPException as e:
+        if not streamed:
+            raise
+        yield _result(None, None, 'aborted', e.detail)
+        return
+    if chunk:
+        for result in await import_chunk(session_factory, chunk):
+            yield result
+
+
+async def prepend(first: bytes | None, results: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    if first is not None:
+        yield first
+        async for result in results:
+            yield result
@@ -0,0 +1,179 @@
+import hashlib
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, fields
+from datetime import date, datetime
+from typing import Any, Callable, Hashable
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from user.models import User
+import config
+
+
+#############################################################################
+#                       TTL + LRU CACHE                                     #
+#############################################################################
+class TTLCache:
+    """Bounded mapping whose entries expire `ttl` seconds after being stored.
+
+    When full, storing a new key evicts the least recently used one. Not thread safe: it is meant
+    to be used from the event loop only.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, clock: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Any | None:
+        entry = self._data.get(key)
+        if entry is None or entry[0] <= self.clock():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None):
+        self._data[key] = (self.clock() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+
+#############################################################################
+#                       VERIFIED TOKENS CACHE                               #
+#############################################################################
+class VerifiedTokenCache:
+    """Claims of tokens whose signature was already checked, keyed by a SHA-256 digest of the token.
+
+    An entry lives until the `exp_time_token` claim of its token. The whole cache is dropped as soon
+    as it is queried with another version of the key set than the one its tokens were verified with.
+    """
+
+    def __init__(self, maxsize: int, clock: Callable[[], float] = time.monotonic):
+        self._cache = TTLCache(maxsize, ttl=0, clock=clock)
+        self._key_version: str | None = None
+
+    @staticmethod
+    def _digest(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def _check_key_version(self, key_version: str):
+        if key_version != self._key_version:
+            self._cache.clear()
+            self._key_version = key_version
+
+    def get(self, token: str, key_version: str) -> dict | None:
+        self._check_key_version(key_version)
+        return self._cache.get(self._digest(token))
+
+    def set(self, token: str, claims: dict, key_version: str):
+        # Tokens without a (valid) expiry date are never cached
+        try:
+            seconds_left = (datetime.fromisoformat(claims['exp_time_token']) - datetime.utcnow()).total_seconds()
+        except (KeyError, TypeError, ValueError):
+            return
+        if seconds_left > 0:
+            self._check_key_version(key_version)
+            self._cache.set(self._digest(token), claims, ttl=seconds_left)
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self) -> dict:
+        return self._cache.stats()
+
+
+token_cache = VerifiedTokenCache(config.TOKEN_CACHE_SIZE)
+
+
+#############################################################################
+#                       USER LOOKUP CACHE                                   #
+#############################################################################
+@dataclass(frozen=True, slots=True)
+class UserSnapshot:
+    """Read-only copy of a users row, safe to share between requests."""
+    username: str
+    email: str
+    password: str
+    name: str
+    firstname: str
+    date_of_birth: date
+    phone_number: str
+    address: str
+    is_verified: bool
+
+    @classmethod
+    def from_orm(cls, user: User) -> 'UserSnapshot':
+        return cls(**{field.name: getattr(user, field.name) for field in fields(cls)})
+
+    @classmethod
+    def columns(cls) -> tuple:
+        """The users columns of the snapshot, in order: a row selected with them is `cls(*row)`."""
+        return tuple(User.__table__.c[field.name] for field in fields(cls))
+
+
+@dataclass(frozen=True, slots=True)
+class AuthRecord:
+    """The part of a users row needed to authenticate: what /token, /otp and /refresh read."""
+    username: str
+    email: str
+    password: str
+    is_verified: bool
+
+    @classmethod
+    def columns(cls) -> tuple:
+        return tuple(User.__table__.c[field.name] for field in fields(cls))
+
+
+user_cache = TTLCache(config.USER_CACHE_SIZE, config.USER_CACHE_TTL)
+auth_cache = TTLCache(config.USER_CACHE_SIZE, config.USER_CACHE_TTL)
+
+
+# Any User inserted, updated or deleted through a session is dropped from the caches once the
+# transaction commits (dropping it at flush time would let a concurrent request cache the old row
+# again before the commit). Writes done with Core statements must call mark_user_written().
+def mark_user_written(session: Session | AsyncSession, username: str):
+    session.info.setdefault('written_usernames', set()).add(username)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_written_users(session: Session, flush_context):
+    for instance in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(instance, User):
+            mark_user_written(session, instance.username)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_written_users(session: Session):
+    for username in session.info.pop('written_usernames', ()):
+        user_cache.invalidate(username)
+        auth_cache.invalidate(username)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_written_users(session: Session):
+    session.info.pop('written_usernames', None)
@@ -1,14 +1,20 @@
+from datetime import datetime
 from typing import Annotated
 from fastapi import HTTPException, status, Depends
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy import select
-from sqlalchemy.orm import Session
+from sqlalchemy import delete, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 import jwt
 import pyotp
 
-from user.validators import Credentials
-from user.models import User
-from database import get_db
+from user.validators import Credentials, RefreshToken
+from user.models import User, OtpChallenge, email_matches
+from user.cache import user_cache, auth_cache, token_cache, UserSnapshot, AuthRecord, mark_user_written
+from user.keys import keyring
+from user.utils import OTP_TOKEN, SESSION_TOKEN, REFRESH_TOKEN
+from database import get_db, get_primary_db, release_connection
+from user.rate_limit import limit_username, TOKEN_USERNAME_LIMIT
+from metrics import time_stage
 import config
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl='token')
@@ -17,54 +23,174 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl='token')
 #############################################################################
 #           HELPERS FUNCTIONS FOR OUR ENDPOINTS                             #
 #############################################################################
-# This function checks if the user exist
-async def get_user(db: Annotated[Session, Depends(get_db)], username: str) -> User:
-    return db.scalar(select(User).where(User.username == username))
+# This function checks if the user exist, known users are served from the in-process cache. The columns are
+# selected with Core: no User entity is built nor added to the identity map of the session
+async def get_user(db: Annotated[AsyncSession, Depends(get_db)], username: str) -> UserSnapshot | None:
+    user = user_cache.get(username)
+    if user is None:
+        row = (await db.execute(select(*UserSnapshot.columns()).where(User.username == username))).first()
+        if row is None:
+            return None
+        user = UserSnapshot(*row)
+        user_cache.set(username, user)
+    return user
+
+
+# Same as get_user, for the authentication dependencies: only the four columns they read
+async def get_auth_record(db: Annotated[AsyncSession, Depends(get_db)], username: str) -> AuthRecord | None:
+    record = auth_cache.get(username)
+    if record is None:
+        row = (await db.execute(select(*AuthRecord.columns()).where(User.username == username))).first()
+        if row is None:
+            return None
+        record = AuthRecord(*row)
+        auth_cache.set(username, record)
+    return record
+
 
+# Login with a username or an email: a login with an @ is looked up by email first (not cached, a single probe of
+# the unique index on lower(email)), then as a username, for the users registered with an @ in their username
+async def get_auth_record_by_login(db: Annotated[AsyncSession, Depends(get_db)], login: str) -> AuthRecord | None:
+    if '@' in login:
+        row = (await db.execute(select(*AuthRecord.columns()).where(email_matches(login)))).first()
+        if row is not None:
+            return AuthRecord(*row)
+    return await get_auth_record(db, login)
 
-async def verify_user_credentials(credentials: Credentials, db_session: Annotated[Session, Depends(get_db)]) -> User or bool:
-    user = await get_user(db_session, credentials.username)
+
+async def verify_user_credentials(credentials: Credentials, db_session: Annotated[AsyncSession, Depends(get_db)]) -> AuthRecord or bool:
+    user = await get_auth_record_by_login(db_session, credentials.username)
     if not user:
         return False
-    if not credentials.verify_pwd(user.password):
+    await release_connection(db_session)
+    if not await credentials.verify_pwd(user.password):
         return False
     return user
 
 
+# Decodes a token, skipping the signature check for tokens already verified by this process
+def decode_token(token: str) -> dict:
+    payload = token_cache.get(token, keyring.version)
+    if payload is None:
+        with time_stage('jwt_decode'):
+            payload = keyring.decode(token)
+        token_cache.set(token, payload, keyring.version)
+    return payload
+
+
 def otp_checker(otp: str, otp_secret: str) -> bool:
     curr_otp = pyotp.TOTP(otp_secret, interval=300)
     return curr_otp.verify(otp)
 
 
-async def verify_token_email(token: str, db: Annotated[Session, Depends(get_db)]):
+# Verifies the user of an email verification token with a single UPDATE ... RETURNING, and returns its
+# username; None when the user is unknown or already verified. The caller commits.
+async def verify_email(token: str, db: Annotated[AsyncSession, Depends(get_db)]) -> str | None:
     try:
-        payload = jwt.decode(token, config.SECRET_TOKEN, algorithms=config.TOKEN_ALGORITHM)
-        user = db.query(User).filter(User.username == payload['username']).first()
-    except:
+        username = decode_token(token)['username']
+    except (jwt.PyJWTError, KeyError, TypeError):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid token"
         )
-    return {'user': user, 'session': db}
+    verified = await db.scalar(
+        update(User)
+        .where(User.username == username, User.is_verified.is_(False))
+        .values(is_verified=True)
+        .returning(User.username)
+        .execution_options(synchronize_session=False)
+    )
+    if verified is not None:
+        mark_user_written(db, verified)
+    return verified
 
 
-async def get_current_user(db: Annotated[Session, Depends(get_db)],
-                           token: Annotated[str, Depends(oauth2_scheme)], otp_code: str):
-    credentials_exception = HTTPException(
+# Claims of a valid and unexpired token of the given type, raises a jwt.PyJWTError otherwise
+def decode_typed_token(token: str, token_type: str) -> dict:
+    payload = decode_token(token)
+    if payload.get('token_type') != token_type:
+        raise jwt.InvalidTokenError(f"Expected a {token_type} token")
+    try:
+        expired = datetime.fromisoformat(payload['exp_time_token']) <= datetime.utcnow()
+    except (KeyError, TypeError, ValueError):
+        raise jwt.InvalidTokenError("Invalid expiry date")
+    if expired:
+        raise jwt.ExpiredSignatureError("Token expired")
+    return payload
+
+
+def credentials_exception() -> HTTPException:
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+
+# One-time exchange of the OTP token of /token, together with the emailed code, for session tokens. The codes
+# tried for a username are rate limited like the passwords of /token, and the challenge is deleted by the first
+# successful exchange: the same token and code can't be exchanged twice. Read from the primary, which has just
+# written the challenge. The caller commits.
+async def verify_otp_token(db: Annotated[AsyncSession, Depends(get_primary_db)],
+                           token: Annotated[str, Depends(oauth2_scheme)], otp_code: str) -> AuthRecord:
+    try:
+        payload = decode_typed_token(token, OTP_TOKEN)
+    except jwt.PyJWTError:
+        raise credentials_exception()
+    username, challenge_id = payload.get('username'), payload.get('jti')
+    if not username or not challenge_id:
+        raise credentials_exception()
+    await limit_username('otp', username, TOKEN_USERNAME_LIMIT)
+    otp_secret = await db.scalar(select(OtpChallenge.otp_secret)
+                                 .where(OtpChallenge.id == challenge_id, OtpChallenge.username == username,
+                                        OtpChallenge.expires_at > datetime.utcnow()))
+    if otp_secret is None or not otp_checker(otp_code, otp_secret):
+        raise credentials_exception()
+    # A concurrent exchange of the same challenge finds no row left
+    consumed = (await db.execute(delete(OtpChallenge).where(OtpChallenge.id == challenge_id)
+                                 .returning(OtpChallenge.id))).first()
+    if consumed is None:
+        raise credentials_exception()
+    user = await get_auth_record(db, username)
+    if not user:
+        raise credentials_exception()
+    return user
+
+
+async def verify_refresh_token(db: Annotated[AsyncSession, Depends(get_db)], body: RefreshToken) -> AuthRecord:
+    try:
+        payload = decode_typed_token(body.refresh_token, REFRESH_TOKEN)
+    except jwt.PyJWTError:
+        raise credentials_exception()
+    # A deleted user can't renew its session
+    user = await get_auth_record(db, payload['username'])
+    if not user:
+        raise credentials_exception()
+    return user
+
+
+# Protected routes: only the signature (or the verified-token cache) and the expiry of the session token are
+# checked, without any OTP work nor database query
+def get_session(token: Annotated[str, Depends(oauth2_scheme)]) -> dict:
     try:
-        payload = jwt.decode(token, config.SECRET_TOKEN, algorithms=config.TOKEN_ALGORITHM)
+        return decode_typed_token(token, SESSION_TOKEN)
     except jwt.PyJWTError:
-        raise credentials_exception
-    if not payload['username']:
-        raise credentials_exception
-    user = await get_user(db, payload['username'])
+        raise credentials_exception()
+
+
+# Administration routes: a session token of one of the IMPORT_ADMIN_USERNAMES, still without any database query
+def get_admin_session(session: Annotated[dict, Depends(get_session)]) -> dict:
+    if session['username'] not in config.IMPORT_ADMIN_USERNAMES:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Reserved to the administrators"
+        )
+    return session
+
+
+async def get_current_user(db: Annotated[AsyncSession, Depends(get_db)],
+                           session: Annotated[dict, Depends(get_session)]) -> UserSnapshot:
+    user = await get_user(db, session['username'])
     if not user:
-        raise credentials_exception
-    state = otp_checker(otp_code, payload['otp_secret'])
-    if state:
-        return user
-    raise credentials_exception
+        raise credentials_exception()
+    return user
@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from typing import Annotated, Iterable
+from fastapi import Depends, HTTPException, status
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import Session
+
+from database import PrimarySessionLocal
+from user.dependencies import get_session
+from user.models import Subscription, SubscriptionType
+import config
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True, slots=True)
+class Entitlement:
+    id_subscription_type: int
+    subscription_name: str
+    begin: date
+    end: date  # Included
+
+    def is_active(self, day: date) -> bool:
+        return self.begin <= day <= self.end
+
+
+#############################################################################
+#                       ENTITLEMENT INDEX                                   #
+#############################################################################
+class EntitlementIndex:
+    """In-process copy of the current and upcoming subscriptions of every user.
+
+    Loaded once at startup, then kept up to date incrementally: every `refresh_interval` seconds the
+    users whose subscriptions have a newer `updated_at` are reloaded, and so are, right after the commit,
+    the users whose subscriptions were written by this process. Rows deleted by other processes are only
+    noticed by the full reload done every `full_reload_interval` seconds.
+
+    The changed users are reloaded `batch_size` at a time (bounding the bind parameters of a query); past
+    `max_refresh` of them (e.g. after a renewal run), the whole index is reloaded instead.
+    """
+
+    # Margin for the clocks of the processes writing `updated_at`
+    LOOKBACK = timedelta(seconds=5)
+
+    def __init__(self, session_factory: async_sessionmaker[AsyncSession], refresh_interval: float = 10,
+                 full_reload_interval: float = 3600, batch_size: int = 1000, max_refresh: int = 20000):
+        self.session_factory = session_factory
+        self.refresh_interval = refresh_interval
+        self.full_reload_interval = full_reload_interval
+        self.batch_size = batch_size
+        self.max_refresh = max_refresh
+        self._entitlements: dict[str, tuple[Entitlement, ...]] = {}
+        self._since: datetime | None = None
+        self._stale: set[str] = set()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def __len__(self) -> int:
+        return len(self._entitlements)
+
+    def active_subscription(self, username: str, day: date | None = None) -> Entitlement | None:
+        day = day or date.today()
+        for entitlement in self._entitlements.get(username, ()):
+            if entitlement.is_active(day):
+                return entitlement
+        return None
+
+    def has_active_subscription(self, username: str, day: date | None = None) -> bool:
+        return self.active_subscription(username, day) is not None
+
+    def mark_stale(self, usernames: Iterable[str]):
+        self._stale.update(usernames)
+        self._wakeup.set()
+
+    @staticmethod
+    def _query(today: date):
+        # Served by the (username, begin, end) index for a given user
+        return (
+            select(Subscription.username, Subscription.id_subscription_type, SubscriptionType.subscription_name,
+                   Subscription.begin, Subscription.end)
+            .join(SubscriptionType, Subscription.id_subscription_type == SubscriptionType.id)
+            .where(Subscription.end >= today)
+            .order_by(Subscription.username, Subscription.begin)
+        )
+
+    @staticmethod
+    def _group(rows) -> dict[str, tuple[Entitlement, ...]]:
+        grouped: dict[str, list[Entitlement]] = {}
+        for username, *entitlement in rows:
+            grouped.setdefault(username, []).append(Entitlement(*entitlement))
+        return {username: tuple(entitlements) for username, entitlements in grouped.items()}
+
+    async def load(self):
+        started = datetime.utcnow()
+        async with self.session_factory() as db:
+            rows = (await db.execute(self._query(date.today()))).all()
+        self._entitlements = self._group(rows)
+        self._since = started - self.LOOKBACK
+        logger.info("Entitlement index loaded: %d users with a current or upcoming subscription", len(self))
+
+    async def refresh(self, usernames: Iterable[str] = ()):
+        """Reloads `usernames` and the users whose subscriptions changed since the previous refresh."""
+        started = datetime.utcnow()
+        changed = set(usernames)
+        async with self.session_factory() as db:
+            if self._since is not None:
+                changed.update(await db.scalars(
+                    select(Subscription.username).where(Subscription.updated_at > self._since).distinct()))
+            if len(changed) > self.max_refresh:
+                rows = None
+            else:
+                usernames = list(changed)
+                rows = []
+                for i in range(0, len(usernames), self.batch_size):
+                    batch = usernames[i:i + self.batch_size]
+                    rows += (await db.execute(self._query(date.today())
+                                              .where(Subscription.username.in_(batch)))).all()
+        if rows is None:
+            await self.load()
+            return
+        grouped = self._group(rows)
+        for username in changed:
+            if username in grouped:
+                self._entitlements[username] = grouped[username]
+            else:
+                self._entitlements.pop(username, None)
+        self._since = started - self.LOOKBACK
+
+    async def run(self):
+        next_full_reload = time.monotonic() + self.full_reload_interval
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.refresh_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            stale, self._stale = self._stale, set()
+            try:
+                if self._since is None or time.monotonic() >= next_full_reload:
+                    next_full_reload = time.monotonic() + self.full_reload_interval
+                    await self.load()
+                else:
+                    await self.refresh(stale)
+            except Exception:
+                # Served from the entries already loaded meanwhile
+                logger.exception("Could not refresh the entitlement index")
+                self._stale.update(stale)
+
+    async def start(self, timeout: float | None = None):
+        """Loads the index, for at most `timeout` seconds, then starts its refresh task."""
+        try:
+            await asyncio.wait_for(self.load(), timeout)
+        except Exception:
+            # The app starts anyway, nobody being entitled until the index is loaded by the refresh task
+            logger.exception("Could not load the entitlement index")
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+# The primary, so that a subscription is seen as soon as its transaction is committed
+entitlement_index = EntitlementIndex(PrimarySessionLocal, config.ENTITLEMENT_REFRESH_INTERVAL,
+                                     config.ENTITLEMENT_FULL_RELOAD_INTERVAL)
+
+
+def has_active_subscription(username: str) -> bool:
+    return entitlement_index.has_active_subscription(username)
+
+
+# The subscriptions inserted, updated or deleted through a session are reloaded once the transaction
+# commits. Writes done with Core statements must call mark_subscription_written().
+def mark_subscription_written(session: Session | AsyncSession, username: str):
+    session.info.setdefault('written_subscriptions', set()).add(username)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_written_subscriptions(session: Session, flush_context):
+    for instance in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(instance, Subscription):
+            mark_subscription_written(session, instance.username)
+
+
+@event.listens_for(Session, 'after_commit')
+def _reload_written_subscriptions(session: Session):
+    usernames = session.info.pop('written_subscriptions', None)
+    if usernames:
+        entitlement_index.mark_stale(usernames)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_written_subscriptions(session: Session):
+    session.info.pop('written_subscriptions', None)
+
+
+#############################################################################
+#                       ROUTE DEPENDENCIES                                  #
+#############################################################################
+# For the routes reserved to subscribers: checked from the session token and the index, without any query
+async def require_active_subscription(session: Annotated[dict, Depends(get_session)]) -> Entitlement:
+    entitlement = entitlement_index.active_subscription(session['username'])
+    if entitlement is None:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="An active subscription is required"
+        )
+    return entitlement
@@ -0,0 +1,109 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+from metrics import time_stage
+import config
+
+pwd_context = CryptContext(schemes=['bcrypt'], deprecated="auto")
+
+
+#############################################################################
+#           FUNCTIONS EXECUTED IN THE HASHING WORKER PROCESSES              #
+#############################################################################
+# They must stay top-level functions so that they can be pickled to the workers
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify(password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(password, hashed_password)
+
+
+def _load_backend() -> int:
+    pwd_context.handler('bcrypt').get_backend()
+    return os.getpid()
+
+
+#############################################################################
+#                       HASHING EXECUTOR                                    #
+#############################################################################
+class HashingExecutor:
+    """Runs bcrypt on a pool of worker processes, away from the event loop.
+
+    At most `max_workers` hashes run at the same time and at most `max_pending` operations
+    (running + waiting) are admitted; the next one is rejected right away with a 503. The bulk
+    hashes keep at most `max_bulk` of them in flight, leaving the other workers to the logins and
+    registrations.
+    """
+
+    def __init__(self, max_workers: int, max_pending: int, max_bulk: int = 1):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.max_bulk = max_bulk
+        self._pending = 0
+        self._bulk_slots = asyncio.Semaphore(max_bulk)
+        self._pool: ProcessPoolExecutor | None = None
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        # The pool is created on first use so that importing this module never spawns processes.
+        # "spawn" because forking a process which runs an event loop and its threads is not safe.
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers,
+                                             mp_context=multiprocessing.get_context('spawn'))
+        return self._pool
+
+    async def run(self, func, *args):
+        if self._pending >= self.max_pending:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server is busy, please retry later",
+                headers={"Retry-After": "1"}
+            )
+        self._pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._get_pool(), func, *args)
+        finally:
+            self._pending -= 1
+
+    # Timed from the event loop, so the time spent waiting for a free worker is included
+    async def hash(self, password: str) -> str:
+        with time_stage('bcrypt_hash'):
+            return await self.run(_hash, password)
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        with time_stage('bcrypt_verify'):
+            return await self.run(_verify, password, hashed_password)
+
+    # Bulk hashing: one hash per task, each one admitted like a single hash once a bulk slot is free
+    async def hash_many(self, passwords: list[str]) -> list[str]:
+        async def hash_one(password: str) -> str:
+            async with self._bulk_slots:
+                return await self.run(_hash, password)
+        return list(await asyncio.gather(*(hash_one(password) for password in passwords)))
+
+    async def warm_up(self) -> int:
+        """Starts the worker processes and loads bcrypt in them, instead of on the first requests.
+
+        Returns the number of workers started.
+        """
+        loop = asyncio.get_running_loop()
+        pool = self._get_pool()
+        # Submitted together: a task finding no idle worker starts a new one
+        pids = await asyncio.gather(*(loop.run_in_executor(pool, _load_backend) for _ in range(self.max_workers)))
+        return len(set(pids))
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+
+hashing_executor = HashingExecutor(config.HASH_POOL_WORKERS, config.HASH_POOL_MAX_PENDING, config.HASH_POOL_MAX_BULK)
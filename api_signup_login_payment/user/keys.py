@@ -0,0 +1,232 @@
+"""Signing keys of the tokens, shared by every worker process and node.
+
+The key set comes from a JSON file (SIGNING_KEYS_FILE) or from the SIGNING_KEYS setting:
+
+    {"keys": [{"kid": "k-20261018000000-1a2b", "secret": "<hex>", "not_before": "2026-10-18T00:00:00+00:00"}]}
+
+Tokens are signed with the active key (the most recent one whose `not_before` has passed) and carry its
+`kid` in their header. A key replaced by a newer one still verifies tokens for SIGNING_KEY_GRACE seconds.
+Keys published with a future `not_before` are accepted right away and used for signing once their time
+comes, so every process switches to a new key at the same moment without any coordination.
+
+Scheduled rotation (e.g. from cron), from the api_signup_login_payment directory; the first run creates the file:
+    ENV_PATH=.env python -m user.keys rotate [--activate-in 600]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import secrets
+import tempfile
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Callable, List
+import jwt
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True, slots=True)
+class SigningKey:
+    kid: str
+    secret: str
+    not_before: float  # Unix timestamp
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'SigningKey':
+        return cls(kid=data['kid'], secret=data['secret'],
+                   not_before=datetime.fromisoformat(data['not_before']).timestamp())
+
+    def to_dict(self) -> dict:
+        return {'kid': self.kid, 'secret': self.secret,
+                'not_before': datetime.fromtimestamp(self.not_before, timezone.utc).isoformat()}
+
+
+def generate_key(not_before: float) -> SigningKey:
+    not_before = float(int(not_before))  # Whole seconds survive the ISO 8601 round trip of the key file
+    stamp = datetime.fromtimestamp(not_before, timezone.utc).strftime('%Y%m%d%H%M%S')
+    return SigningKey(kid=f"k-{stamp}-{secrets.token_hex(2)}", secret=secrets.token_hex(32), not_before=not_before)
+
+
+def parse_keys(document: str) -> List[SigningKey]:
+    keys = [SigningKey.from_dict(key) for key in json.loads(document)['keys']]
+    if not keys:
+        raise ValueError("The signing key set is empty")
+    return keys
+
+
+def dump_keys(keys: List[SigningKey]) -> str:
+    return json.dumps({'keys': [key.to_dict() for key in keys]}, indent=2)
+
+
+class KeyRing:
+    """In-memory signing key set: signing and verification never touch the disk.
+
+    The active key and the accepted keys only change at known instants (a `not_before` reached, a grace
+    window over), so they are computed once per transition instead of on every token.
+    """
+
+    def __init__(self, keys: List[SigningKey], grace: float, clock: Callable[[], float] = time.time):
+        self.grace = grace
+        self.clock = clock
+        self.path: str | None = None
+        self._mtime: float | None = None
+        self._task: asyncio.Task | None = None
+        self.replace(keys)
+
+    def replace(self, keys: List[SigningKey]):
+        self._keys = sorted(keys, key=lambda key: key.not_before)
+        self._next_transition = float('-inf')
+
+    def _update(self):
+        now = self.clock()
+        if now < self._next_transition:
+            return
+        if not self._keys:
+            raise RuntimeError("No signing key loaded")
+        current = [key for key in self._keys if key.not_before <= now]
+        # Before the first activation, the oldest key signs
+        self._active = current[-1] if current else self._keys[0]
+        accepted = {key.kid: key.secret for key in self._keys if key.not_before > now}
+        accepted[self._active.kid] = self._active.secret
+        transitions = [key.not_before for key in self._keys if key.not_before > now]
+        # A key stops being accepted `grace` seconds after its successor becomes active
+        for key, successor in zip(current, current[1:]):
+            retired_until = successor.not_before + self.grace
+            if retired_until > now:
+                accepted[key.kid] = key.secret
+                transitions.append(retired_until)
+        self._accepted = accepted
+        self._version = ','.join(sorted(accepted))
+        self._next_transition = min(transitions, default=float('inf'))
+
+    @property
+    def active_key(self) -> SigningKey:
+        self._update()
+        return self._active
+
+    @property
+    def version(self) -> str:
+        """Changes whenever the set of accepted keys changes."""
+        self._update()
+        return self._version
+
+    def verification_secret(self, kid: str | None) -> str | None:
+        self._update()
+        return self._accepted.get(kid)
+
+    def encode(self, payload: dict) -> str:
+        key = self.active_key
+        return jwt.encode(payload, key.secret, config.TOKEN_ALGORITHM, headers={'kid': key.kid})
+
+    def decode(self, token: str) -> dict:
+        kid = jwt.get_unverified_header(token).get('kid')
+        secret = self.verification_secret(kid)
+        if secret is None:
+            raise jwt.InvalidTokenError(f"Unknown signing key: {kid}")
+        return jwt.decode(token, secret, algorithms=config.TOKEN_ALGORITHM)
+
+    #########################################################################
+    #                   RELOADING THE SHARED KEY FILE                       #
+    #########################################################################
+    def load_file(self, path: str):
+        self.path = path
+        self._mtime = os.stat(path).st_mtime
+        with open(path) as f:
+            self.replace(parse_keys(f.read()))
+
+    def reload(self):
+        if self.path is None:
+            return
+        try:
+            if os.stat(self.path).st_mtime != self._mtime:
+                self.load_file(self.path)
+                logger.info("Signing keys reloaded from %s", self.path)
+        except (OSError, ValueError, KeyError):
+            # The keys already in memory keep being used until the file is fixed
+            logger.exception("Could not reload the signing keys from %s", self.path)
+
+    async def run(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            self.reload()
+
+    def start(self, interval: float):
+        self._update()  # Fails at startup rather than on the first token when there is no key
+        if self._task is None and self.path is not None:
+            self._task = asyncio.create_task(self.run(interval))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+def create_keyring() -> KeyRing:
+    if config.SIGNING_KEYS_FILE:
+        keyring = KeyRing([], grace=config.SIGNING_KEY_GRACE)
+        # A missing file fails the startup (FileNotFoundError): create it with the `rotate` command first
+        keyring.load_file(config.SIGNING_KEYS_FILE)
+        return keyring
+    if config.SIGNING_KEYS:
+        return KeyRing(parse_keys(config.SIGNING_KEYS), grace=config.SIGNING_KEY_GRACE)
+    logger.warning("No SIGNING_KEYS_FILE nor SIGNING_KEYS configured: using a random key private to this process, "
+                   "tokens will not be accepted by other workers")
+    return KeyRing([generate_key(0)], grace=config.SIGNING_KEY_GRACE)
+
+
+keyring = create_keyring()
+
+
+#############################################################################
+#                       SCHEDULED ROTATION                                  #
+#############################################################################
+def rotate(path: str, activate_in: float, grace: float, now: float | None = None) -> SigningKey:
+    """Adds a key to the file, active in `activate_in` seconds, and drops the keys out of their grace window.
+
+    `activate_in` must exceed the reload interval, so that every process knows the key before it signs with it.
+    """
+    now = time.time() if now is None else now
+    try:
+        with open(path) as f:
+            keys = parse_keys(f.read())
+    except FileNotFoundError:
+        keys = []
+    new_key = generate_key(now + activate_in)
+    keys = sorted(keys + [new_key], key=lambda key: key.not_before)
+    kept = [key for key, successor in zip(keys, keys[1:]) if successor.not_before + grace > now]
+    kept.append(keys[-1])
+
+    # Written to a temporary file then renamed, so that readers never see a partial file
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as f:
+        f.write(dump_keys(kept))
+    os.chmod(f.name, 0o600)
+    os.replace(f.name, path)
+    return new_key
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Signing keys management")
+    commands = parser.add_subparsers(dest='command', required=True)
+    rotate_parser = commands.add_parser('rotate', help="schedule a new signing key in SIGNING_KEYS_FILE")
+    rotate_parser.add_argument('--activate-in', type=float, default=max(600.0, config.SIGNING_KEYS_RELOAD_INTERVAL * 2),
+                               help="seconds before the new key starts signing")
+    args = parser.parse_args()
+
+    if not config.SIGNING_KEYS_FILE:
+        parser.error("SIGNING_KEYS_FILE is not configured")
+    key = rotate(config.SIGNING_KEYS_FILE, args.activate_in, config.SIGNING_KEY_GRACE)
+    print(f"Key {key.kid} signs from {datetime.fromtimestamp(key.not_before, timezone.utc).isoformat()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,7 @@
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, Index, func
 from sqlalchemy.orm import mapped_column, Mapped
 from database import Base
-from datetime import date
+from datetime import date, datetime
 
 
 class User(Base):
@@ -21,11 +21,23 @@ class User(Base):
                f"name: {self.name}"
 
 
+# Emails identify users too (login by email, one account per address): the lookups compare lower(email) with
+# the lowercased address, which this index serves
+Index('uq_users_email_lower', func.lower(User.email), unique=True)
+
+
+def email_matches(email: str):
+    """Condition selecting the user of `email`, whatever its case, with a single probe of uq_users_email_lower."""
+    return func.lower(User.email) == func.lower(email)
+
+
 class SubscriptionType(Base):
     __tablename__ = 'subscription_type'
     id: Mapped[int] = mapped_column(primary_key=True, index=True, unique=True)
     subscription_name: Mapped[str]
     price: Mapped[int]
+    # Length of the period added by a renewal
+    duration_days: Mapped[int] = mapped_column(default=30, server_default='30')
 
 
 class Subscription(Base):
@@ -33,4 +45,59 @@ class Subscription(Base):
     username: Mapped[str] = mapped_column(ForeignKey("users.username"), primary_key=True)
     id_subscription_type: Mapped[int] = mapped_column(ForeignKey("subscription_type.id"), primary_key=True)
     begin: Mapped[date]
-    end: Mapped[date]
\ No newline at end of file
+    end: Mapped[date]
+    auto_renew: Mapped[bool] = mapped_column(default=False, server_default='false')
+    # End date whose expiry notice was sent, so that the renewal job notifies each expiry once
+    notified_end: Mapped[date | None]
+    # Polled by the entitlement index to pick up the subscriptions changed by other processes
+    updated_at: Mapped[datetime] = mapped_column(default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+
+    # "Is this user entitled today": equality on username, then a range on the dates
+    __table_args__ = (Index('ix_subscription_username_begin_end', 'username', 'begin', 'end'),)
+
+
+class EmailOutbox(Base):
+    """Emails waiting to be delivered by the outbox worker (see user/outbox.py)."""
+    __tablename__ = 'email_outbox'
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    recipients: Mapped[str]
+    template: Mapped[str]
+    message_data: Mapped[str]
+    status: Mapped[str] = mapped_column(default='pending')
+    attempts: Mapped[int] = mapped_column(default=0)
+    next_attempt_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+    last_error: Mapped[str | None]
+    created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+    sent_at: Mapped[datetime | None]
+
+    __table_args__ = (Index('ix_email_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),)
+
+
+class JobCheckpoint(Base):
+    """Progress of a batch job, committed with each of its batches so that a crashed run resumes after its last one."""
+    __tablename__ = 'job_checkpoint'
+    name: Mapped[str] = mapped_column(primary_key=True)
+    # Date the run is computed for, kept when it resumes on another day
+    run_date: Mapped[date]
+    last_key: Mapped[str | None]
+    rows_processed: Mapped[int] = mapped_column(default=0)
+    started_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+    finished_at: Mapped[datetime | None]
+
+
+class RateLimitBucket(Base):
+    """Token buckets shared by every worker when RATE_LIMIT_BACKEND is 'database' (see user/rate_limit.py)."""
+    __tablename__ = 'rate_limit_bucket'
+    key: Mapped[str] = mapped_column(primary_key=True)
+    # Theoretical arrival time (Unix timestamp): the bucket is full again once it is in the past
+    tat: Mapped[float] = mapped_column(index=True)
+
+
+class OtpChallenge(Base):
+    """OTP of a /token login, kept on the server until its first successful exchange on /otp."""
+    __tablename__ = 'otp_challenge'
+    # The `jti` claim of the OTP token
+    id: Mapped[str] = mapped_column(primary_key=True)
+    username: Mapped[str] = mapped_column(index=True)
+    otp_secret: Mapped[str]
+    expires_at: Mapped[datetime]
@@ -0,0 +1,207 @@
+"""Rate limiting and load shedding of the expensive routes (/token, /user_registration).
+
+Rate limits are token buckets, keyed by client IP and by username, written as "capacity/period": "5/60" lets
+a burst of 5 requests through, then one every 12 seconds. A bucket is stored as its theoretical arrival time
+(GCRA): a single timestamp per key, updated in one step, which a shared backend can apply in one statement.
+
+Backends (RATE_LIMIT_BACKEND):
+    memory   - per process, bounded to RATE_LIMIT_MAX_KEYS buckets, full buckets swept out periodically
+    database - one row per bucket in the primary database, shared by every worker and node
+
+The load shedder caps the requests doing bcrypt or SMTP work at the same time. Its limit adapts: it shrinks
+when requests get slower than the latency target and grows back slowly while they are fast again.
+"""
+import math
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Callable, Protocol
+from fastapi import HTTPException, Request, status
+from sqlalchemy import case, delete
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from database import PrimarySessionLocal
+from user.models import RateLimitBucket
+import config
+
+
+@dataclass(frozen=True, slots=True)
+class Limit:
+    capacity: int
+    period: float  # Seconds to refill the whole bucket
+
+    @classmethod
+    def parse(cls, spec: str) -> 'Limit':
+        capacity, period = spec.split('/')
+        return cls(capacity=int(capacity), period=float(period))
+
+    @property
+    def interval(self) -> float:
+        """Seconds for one token to come back."""
+        return self.period / self.capacity
+
+
+class RateLimitBackend(Protocol):
+    async def take(self, key: str, limit: Limit) -> float:
+        """Takes a token from the bucket; returns 0 when allowed, else the seconds until a token is back."""
+
+
+class MemoryBackend:
+    def __init__(self, max_keys: int, sweep_interval: float, clock: Callable[[], float] = time.time):
+        self.max_keys = max_keys
+        self.sweep_interval = sweep_interval
+        self.clock = clock
+        # Least recently used first, so that the oldest buckets are evicted first when full
+        self._buckets: OrderedDict[str, float] = OrderedDict()
+        self._next_sweep = clock() + sweep_interval
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def sweep(self, now: float):
+        # A bucket whose arrival time has passed is full: forgetting it changes nothing
+        for key in [key for key, tat in self._buckets.items() if tat <= now]:
+            del self._buckets[key]
+        self._next_sweep = now + self.sweep_interval
+
+    async def take(self, key: str, limit: Limit) -> float:
+        now = self.clock()
+        if now >= self._next_sweep:
+            self.sweep(now)
+        tat = max(self._buckets.get(key, now), now) + limit.interval
+        if tat - now > limit.period:
+            return tat - now - limit.period
+        self._buckets[key] = tat
+        self._buckets.move_to_end(key)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return 0.0
+
+
+class DatabaseBackend:
+    def __init__(self, session_factory: async_sessionmaker[AsyncSession], sweep_interval: float,
+                 clock: Callable[[], float] = time.time):
+        self.session_factory = session_factory
+        self.sweep_interval = sweep_interval
+        self.clock = clock
+        self._next_sweep = clock() + sweep_interval
+
+    async def take(self, key: str, limit: Limit) -> float:
+        now = self.clock()
+        tat = case((RateLimitBucket.tat > now, RateLimitBucket.tat), else_=now) + limit.interval
+        # The bucket is created or updated only when a token is available: no row back means refused.
+        # A single statement, so concurrent workers can't both take the last token.
+        statement = (
+            insert(RateLimitBucket)
+            .values(key=key, tat=now + limit.interval)
+            .on_conflict_do_update(index_elements=[RateLimitBucket.key], set_={'tat': tat},
+                                   where=tat - now <= limit.period)
+            .returning(RateLimitBucket.tat)
+        )
+        async with self.session_factory() as db:
+            allowed = (await db.execute(statement)).first() is not None
+            if now >= self._next_sweep:
+                self._next_sweep = now + self.sweep_interval
+                await db.execute(delete(RateLimitBucket).where(RateLimitBucket.tat <= now))
+            await db.commit()
+        return 0.0 if allowed else limit.interval
+
+
+class RateLimiter:
+    def __init__(self, backend: RateLimitBackend):
+        self.backend = backend
+
+    async def check(self, key: str, limit: Limit):
+        retry_after = await self.backend.take(key, limit)
+        if retry_after:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests, please retry later",
+                headers={"Retry-After": str(math.ceil(retry_after))}
+            )
+
+
+def client_ip(request: Request) -> str:
+    # Behind a reverse proxy, uvicorn --proxy-headers puts the forwarded client address here
+    return request.client.host if request.client else 'unknown'
+
+
+class LoadShedder:
+    """Admits at most `limit` expensive requests at the same time; the next one gets a 503 right away.
+
+    The limit starts at `max_limit`. Every request slower than `target_latency` multiplies it by 0.9
+    (down to `min_limit`), every faster one adds 1/limit, i.e. about +1 per limit requests.
+    """
+
+    def __init__(self, max_limit: int, min_limit: int, target_latency: float):
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit)
+        self.target_latency = target_latency
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.shed = 0
+
+    def _adjust(self, latency: float):
+        if latency > self.target_latency:
+            self.limit = max(self.min_limit, self.limit * 0.9)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    @asynccontextmanager
+    async def admit(self):
+        if self.in_flight >= int(self.limit):
+            self.shed += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server is busy, please retry later",
+                headers={"Retry-After": "1"}
+            )
+        self.in_flight += 1
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._adjust(time.perf_counter() - started)
+
+
+def create_backend() -> RateLimitBackend:
+    if config.RATE_LIMIT_BACKEND == 'database':
+        return DatabaseBackend(PrimarySessionLocal, config.RATE_LIMIT_SWEEP_INTERVAL)
+    if config.RATE_LIMIT_BACKEND != 'memory':
+        raise ValueError(f"Unknown RATE_LIMIT_BACKEND: {config.RATE_LIMIT_BACKEND}")
+    return MemoryBackend(config.RATE_LIMIT_MAX_KEYS, config.RATE_LIMIT_SWEEP_INTERVAL)
+
+
+rate_limiter = RateLimiter(create_backend())
+load_shedder = LoadShedder(config.SHED_MAX_CONCURRENCY, config.SHED_MIN_CONCURRENCY, config.SHED_TARGET_LATENCY)
+
+TOKEN_IP_LIMIT = Limit.parse(config.TOKEN_RATE_LIMIT_IP)
+TOKEN_USERNAME_LIMIT = Limit.parse(config.TOKEN_RATE_LIMIT_USERNAME)
+REGISTRATION_IP_LIMIT = Limit.parse(config.REGISTRATION_RATE_LIMIT_IP)
+REGISTRATION_USERNAME_LIMIT = Limit.parse(config.REGISTRATION_RATE_LIMIT_USERNAME)
+USERNAME_CHECK_IP_LIMIT = Limit.parse(config.USERNAME_CHECK_RATE_LIMIT_IP)
+IMPORT_IP_LIMIT = Limit.parse(config.IMPORT_RATE_LIMIT_IP)
+
+
+#############################################################################
+#                       ROUTE DEPENDENCIES                                  #
+#############################################################################
+# Listed in the `dependencies` of a route, these run before its database session is opened and its body is
+# read, so that a rejected request costs neither a pooled connection nor a bcrypt hash.
+def limit_client_ip(scope: str, limit: Limit):
+    async def check_client_ip(request: Request):
+        await rate_limiter.check(f"{scope}:ip:{client_ip(request)}", limit)
+    return check_client_ip
+
+
+async def shed_load():
+    async with load_shedder.admit():
+        yield
+
+
+# The username is only known from the body, so this one is called from the route itself
+async def limit_username(scope: str, username: str, limit: Limit):
+    await rate_limiter.check(f"{scope}:username:{username}", limit)
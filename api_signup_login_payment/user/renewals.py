@@ -0,0 +1,222 @@
+"""Subscription renewal job: renews the auto-renewed subscriptions ending within the window and notifies the others.
+
+The window runs from the run date to `window_days` later: the subscriptions which already ended are neither
+renewed nor notified.
+
+The subscriptions to handle are read from a server-side cursor, `batch_size` keys at a time. Each batch is
+renewed and marked notified with two set-based UPDATEs over its keys, its notices go to the email outbox and
+the job checkpoint moves past it, all in one transaction: a crashed run resumes after its last committed
+batch, with the same run date, and never sends a notice twice. Only the rows of the current batch are locked.
+
+Daily (e.g. from cron), from the api_signup_login_payment directory:
+    ENV_PATH=.env python -m user.renewals [--window-days 7] [--batch-size 1000]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import time
+from dataclasses import dataclass, asdict
+from datetime import date, datetime, timedelta
+from sqlalchemy import Date, or_, select, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+
+from database import engine, dispose_engines, PrimarySessionLocal
+from user.mail_templates import SUBSCRIPTION_RENEWED_EMAIL, SUBSCRIPTION_EXPIRING_EMAIL
+from user.models import JobCheckpoint, Subscription, SubscriptionType, User
+from user.outbox import queue_email
+import config
+
+logger = logging.getLogger(__name__)
+
+JOB_NAME = 'subscription_renewal'
+
+
+class add_days(FunctionElement):
+    """`date + days` in SQL, for PostgreSQL and for SQLite (the offline benchmarks and tests)."""
+    type = Date()
+    name = 'add_days'
+    inherit_cache = True
+
+
+@compiles(add_days)
+def _add_days(element, compiler, **kw):
+    day, days = element.clauses
+    return f"({compiler.process(day, **kw)} + {compiler.process(days, **kw)})"
+
+
+@compiles(add_days, 'sqlite')
+def _add_days_sqlite(element, compiler, **kw):
+    day, days = element.clauses
+    return f"date({compiler.process(day, **kw)}, '+' || {compiler.process(days, **kw)} || ' days')"
+
+
+@dataclass
+class RenewalReport:
+    run_date: date
+    resumed: bool = False
+    rows_read: int = 0
+    renewed: int = 0
+    notified: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows_read / self.elapsed if self.elapsed else 0.0
+
+
+def subscription_key():
+    return tuple_(Subscription.username, Subscription.id_subscription_type)
+
+
+# Subscriptions ending from the run date to the end of the window: those which already ended are left alone
+def ending_within(run_date: date, window_end: date):
+    return Subscription.end.between(run_date, window_end)
+
+
+class RenewalJob:
+    def __init__(self, read_engine: AsyncEngine, session_factory: async_sessionmaker[AsyncSession],
+                 window_days: int = 7, batch_size: int = 1000):
+        self.read_engine = read_engine
+        self.session_factory = session_factory
+        self.window = timedelta(days=window_days)
+        self.batch_size = batch_size
+
+    #########################################################################
+    #                       STATEMENTS                                      #
+    #########################################################################
+    @staticmethod
+    def candidates(run_date: date, window_end: date, after: list | None):
+        query = (
+            select(Subscription.username, Subscription.id_subscription_type, User.email)
+            .join(User, Subscription.username == User.username)
+            .where(ending_within(run_date, window_end),
+                   or_(Subscription.auto_renew, Subscription.notified_end.is_(None),
+                       Subscription.notified_end != Subscription.end))
+            .order_by(Subscription.username, Subscription.id_subscription_type)
+        )
+        if after is not None:
+            query = query.where(subscription_key() > tuple_(*after))
+        return query
+
+    @staticmethod
+    def renew(keys: list[tuple], run_date: date, window_end: date):
+        return (
+            update(Subscription)
+            .where(subscription_key().in_(keys), Subscription.auto_renew, ending_within(run_date, window_end),
+                   Subscription.id_subscription_type == SubscriptionType.id)
+            .values(end=add_days(Subscription.end, SubscriptionType.duration_days))
+            .returning(Subscription.username, Subscription.end)
+            .execution_options(synchronize_session=False)
+        )
+
+    @staticmethod
+    def notify_expiry(keys: list[tuple], run_date: date, window_end: date):
+        return (
+            update(Subscription)
+            .where(subscription_key().in_(keys), ~Subscription.auto_renew, ending_within(run_date, window_end),
+                   or_(Subscription.notified_end.is_(None), Subscription.notified_end != Subscription.end))
+            .values(notified_end=Subscription.end)
+            .returning(Subscription.username, Subscription.end)
+            .execution_options(synchronize_session=False)
+        )
+
+    #########################################################################
+    #                       RUN                                             #
+    #########################################################################
+    async def _begin(self, run_date: date) -> tuple[date, list | None, bool]:
+        """Returns the run date, the key to resume after and whether an interrupted run is resumed."""
+        async with self.session_factory() as db:
+            checkpoint = await db.get(JobCheckpoint, JOB_NAME)
+            if checkpoint is not None and checkpoint.finished_at is None:
+                last_key = json.loads(checkpoint.last_key) if checkpoint.last_key else None
+                return checkpoint.run_date, last_key, True
+            if checkpoint is None:
+                checkpoint = JobCheckpoint(name=JOB_NAME)
+                db.add(checkpoint)
+            checkpoint.run_date = run_date
+            checkpoint.last_key = None
+            checkpoint.rows_processed = 0
+            checkpoint.started_at = datetime.utcnow()
+            checkpoint.finished_at = None
+            await db.commit()
+        return run_date, None, False
+
+    async def _process(self, rows: list[tuple], run_date: date, window_end: date, previous_key: list | None,
+                       report: RenewalReport) -> list:
+        keys = [(username, id_subscription_type) for username, id_subscription_type, _ in rows]
+        # Read with the keys, so that the notices need no other query (RETURNING can't reach the users table
+        # on every database)
+        emails = {username: email for username, _, email in rows}
+        async with self.session_factory() as db:
+            # Locked for the transaction: a second run started by mistake stops instead of renewing twice
+            checkpoint = await db.get(JobCheckpoint, JOB_NAME, with_for_update=True)
+            if checkpoint.finished_at is not None or checkpoint.last_key != (json.dumps(previous_key)
+                                                                             if previous_key else None):
+                raise RuntimeError("The checkpoint was moved by another run of the job")
+
+            renewed = (await db.execute(self.renew(keys, run_date, window_end))).all()
+            notified = (await db.execute(self.notify_expiry(keys, run_date, window_end))).all()
+            for username, end in renewed:
+                queue_email(db, [emails[username]], SUBSCRIPTION_RENEWED_EMAIL, end.isoformat())
+            for username, end in notified:
+                queue_email(db, [emails[username]], SUBSCRIPTION_EXPIRING_EMAIL, end.isoformat())
+
+            last_key = list(keys[-1])
+            checkpoint.last_key = json.dumps(last_key)
+            checkpoint.rows_processed += len(keys)
+            await db.commit()
+        report.rows_read += len(keys)
+        report.renewed += len(renewed)
+        report.notified += len(notified)
+        return last_key
+
+    async def run(self, run_date: date | None = None) -> RenewalReport:
+        run_date, last_key, resumed = await self._begin(run_date or date.today())
+        report = RenewalReport(run_date=run_date, resumed=resumed)
+        window_end = run_date + self.window
+        started = time.perf_counter()
+
+        async with self.read_engine.connect() as conn:
+            result = await conn.stream(self.candidates(run_date, window_end, last_key)
+                                       .execution_options(yield_per=self.batch_size))
+            async for rows in result.partitions():
+                last_key = await self._process([tuple(row) for row in rows], run_date, window_end, last_key,
+                                              report)
+                report.elapsed = time.perf_counter() - started
+                logger.info("%d subscriptions handled (%d renewed, %d notified), %.0f rows/s",
+                            report.rows_read, report.renewed, report.notified, report.rows_per_second)
+
+        async with self.session_factory() as db:
+            checkpoint = await db.get(JobCheckpoint, JOB_NAME)
+            checkpoint.finished_at = datetime.utcnow()
+            await db.commit()
+        report.elapsed = time.perf_counter() - started
+        return report
+
+
+async def run_renewals(window_days: int, batch_size: int) -> RenewalReport:
+    try:
+        return await RenewalJob(engine, PrimarySessionLocal, window_days, batch_size).run()
+    finally:
+        await dispose_engines()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Subscription renewal job")
+    parser.add_argument('--window-days', type=int, default=config.SUBSCRIPTION_RENEWAL_WINDOW_DAYS,
+                        help="handle the subscriptions ending within this many days")
+    parser.add_argument('--batch-size', type=int, default=config.SUBSCRIPTION_RENEWAL_BATCH_SIZE,
+                        help="subscriptions per transaction")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    report = asyncio.run(run_renewals(args.window_days, args.batch_size))
+    print(', '.join(f"{key}: {value}" for key, value in asdict(report).items()),
+          f"rows/s: {report.rows_per_second:.0f}", sep=', ')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+import asyncio
+import hashlib
+import logging
+import math
+from datetime import datetime
+from typing import Annotated, Iterable
+from fastapi import Depends
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import Session
+
+from database import get_db, PrimarySessionLocal
+from user.cache import user_cache, auth_cache
+from user.models import User
+import config
+
+logger = logging.getLogger(__name__)
+
+
+#############################################################################
+#                       BLOOM FILTER                                        #
+#############################################################################
+class BloomFilter:
+    """Set of strings answering "certainly absent" or "maybe present", in about 1.2 bytes per item at 1%.
+
+    Sized for `capacity` items at `error_rate` false positives; adding more items raises the false positive
+    rate, never causes a false negative.
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = max(capacity, 1)
+        self.error_rate = error_rate
+        self.size = math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2)  # Bits
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str) -> Iterable[int]:
+        # Double hashing: the k positions are derived from the two halves of a single digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._bits)
+
+    def false_positive_rate(self) -> float:
+        """Expected rate for the items added so far."""
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+
+#############################################################################
+#                       USERNAME INDEX                                      #
+#############################################################################
+class UsernameIndex:
+    """Bloom filter of every username, for the availability checks of the signup form.
+
+    Built by streaming the users table and rebuilt every `rebuild_interval` seconds, sized for
+    twice the number of users found by the previous build. The usernames registered by this process are added
+    as soon as their transaction commits; those registered by the other workers are picked up by the next
+    rebuild. The first build runs in the background, not at startup: until it is done, every username is
+    "maybe taken".
+    """
+
+    def __init__(self, session_factory: async_sessionmaker[AsyncSession], capacity: int = 1000000,
+                 error_rate: float = 0.01, rebuild_interval: float = 600, batch_size: int = 10000):
+        self.session_factory = session_factory
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.rebuild_interval = rebuild_interval
+        self.batch_size = batch_size
+        self._filter: BloomFilter | None = None
+        self._added_while_building: set[str] | None = None
+        self._built_at: datetime | None = None
+        self._task: asyncio.Task | None = None
+        self.checks = 0
+        self.negatives = 0
+        self.false_positives = 0
+
+    def might_exist(self, username: str) -> bool:
+        self.checks += 1
+        if self._filter is not None and username not in self._filter:
+            self.negatives += 1
+            return False
+        return True
+
+    def add(self, usernames: Iterable[str]):
+        for username in usernames:
+            if self._filter is not None:
+                self._filter.add(username)
+            if self._added_while_building is not None:
+                self._added_while_building.add(username)
+
+    async def build(self):
+        capacity = max(self.capacity, 2 * (self._filter.count if self._filter is not None else 0))
+        bloom = BloomFilter(capacity, self.error_rate)
+        started = datetime.utcnow()
+        # The usernames committed while the table is streamed may be missed by the scan
+        self._added_while_building = set()
+        try:
+            async with self.session_factory() as db:
+                result = await db.stream_scalars(select(User.username).execution_options(yield_per=self.batch_size))
+                async for usernames in result.partitions():
+                    for username in usernames:
+                        bloom.add(username)
+            for username in self._added_while_building:
+                bloom.add(username)
+        finally:
+            self._added_while_building = None
+        if bloom.count > bloom.capacity:
+            logger.warning("Username filter over capacity (%d usernames for %d): its next rebuild is resized",
+                           bloom.count, bloom.capacity)
+        self._filter = bloom
+        self._built_at = started
+        logger.info("Username filter built: %d usernames, %d KiB, %.4f expected false positive rate",
+                    bloom.count, bloom.nbytes // 1024, bloom.false_positive_rate())
+
+    async def run(self):
+        delay = 0
+        while True:
+            await asyncio.sleep(delay)
+            delay = self.rebuild_interval
+            try:
+                await self.build()
+            except Exception:
+                # The previous filter (or, before the first build, the database) keeps answering meanwhile
+                logger.exception("Could not build the username filter")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        bloom = self._filter
+        return {
+            'usernames': bloom.count if bloom else 0,
+            'capacity': bloom.capacity if bloom else 0,
+            'bytes': bloom.nbytes if bloom else 0,
+            'hashes': bloom.hashes if bloom else 0,
+            'expected_false_positive_rate': bloom.false_positive_rate() if bloom else None,
+            'built_at': self._built_at.isoformat() if self._built_at else None,
+            'checks': self.checks,
+            'negatives': self.negatives,
+            'false_positives': self.false_positives,
+        }
+
+
+# Built from the primary: a replica lagging behind could miss usernames already added by this process, and
+# the rebuilt filter would then report them available
+username_index = UsernameIndex(PrimarySessionLocal, config.USERNAME_FILTER_CAPACITY,
+                               config.USERNAME_FILTER_ERROR_RATE, config.USERNAME_FILTER_REBUILD_INTERVAL)
+
+
+# Only a "maybe" of the filter costs a query, by primary key (on a replica: a username registered a moment ago
+# may still be reported available, and is then rejected by the registration). The request session checks out
+# its connection on that query only, never for a negative.
+async def is_username_taken(db: Annotated[AsyncSession, Depends(get_db)], username: str) -> bool:
+    if not username_index.might_exist(username):
+        return False
+    if user_cache.get(username) or auth_cache.get(username):
+        return True
+    taken = await db.scalar(select(User.username).where(User.username == username)) is not None
+    if not taken:
+        username_index.false_positives += 1
+    return taken
+
+
+# The usernames inserted through a session are added to the filter once the transaction commits. Users are
+# inserted with Core statements, which must call mark_username_registered().
+def mark_username_registered(session: Session | AsyncSession, username: str):
+    session.info.setdefault('registered_usernames', set()).add(username)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_registered_usernames(session: Session, flush_context):
+    for instance in session.new:
+        if isinstance(instance, User):
+            mark_username_registered(session, instance.username)
+
+
+@event.listens_for(Session, 'after_commit')
+def _add_registered_usernames(session: Session):
+    usernames = session.info.pop('registered_usernames', None)
+    if usernames:
+        username_index.add(usernames)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_registered_usernames(session: Session):
+    session.info.pop('registered_usernames', None)
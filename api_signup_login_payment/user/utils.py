@@ -1,9 +1,23 @@
-from fastapi import HTTPException
-from fastapi_mail import FastMail, MessageSchema, MessageType
 from typing import List
 from datetime import timedelta, datetime
+import secrets
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import AsyncSession
+import pyotp
 import config
-import jwt
+
+from user.mail_templates import EmailTemplate
+from user.smtp_pool import smtp_pool
+from user.keys import keyring
+from user.models import OtpChallenge
+from metrics import time_stage
+
+
+# Types of the tokens, in their `token_type` claim: the OTP token of /token is only good for the OTP exchange,
+# which issues the session token of the protected routes and the refresh token renewing it
+OTP_TOKEN = 'otp'
+SESSION_TOKEN = 'session'
+REFRESH_TOKEN = 'refresh'
 
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
@@ -13,22 +27,36 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     else:
         expire = datetime.utcnow() + timedelta(minutes=config.ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode.update({'exp_time_token': expire.isoformat()})
-    token = jwt.encode(to_encode, config.SECRET_TOKEN, config.TOKEN_ALGORITHM)
+    with time_stage('jwt_encode'):
+        token = keyring.encode(to_encode)
     return token
 
 
-async def send_email(email: List, body_msg: str, message_data: str, subject: str):
-    template = body_msg.format(message_data)
+# The OTP secret stays in the database: the token only carries the id (jti) of its challenge. The challenges
+# of the user left unexchanged are deleted once expired. The caller commits.
+async def create_otp_challenge(db: AsyncSession, username: str) -> tuple[str, str]:
+    """Returns the OTP token and the code to email."""
+    now = datetime.utcnow()
+    expires_delta = timedelta(minutes=config.ACCESS_TOKEN_EXPIRE_MINUTES)
+    await db.execute(delete(OtpChallenge).where(OtpChallenge.username == username, OtpChallenge.expires_at <= now))
+    challenge = OtpChallenge(id=secrets.token_urlsafe(16), username=username, otp_secret=pyotp.random_base32(),
+                             expires_at=now + expires_delta)
+    db.add(challenge)
+    token = create_access_token({'username': username, 'jti': challenge.id, 'token_type': OTP_TOKEN}, expires_delta)
+    return token, pyotp.TOTP(challenge.otp_secret, interval=300).now()
+
+
+def create_session_tokens(username: str) -> dict:
+    return {
+        'access_token': create_access_token({'username': username, 'token_type': SESSION_TOKEN},
+                                            timedelta(minutes=config.SESSION_TOKEN_EXPIRE_MINUTES)),
+        'refresh_token': create_access_token({'username': username, 'token_type': REFRESH_TOKEN},
+                                             timedelta(minutes=config.REFRESH_TOKEN_EXPIRE_MINUTES)),
+        'token_type': 'bearer',
+        'expires_in': config.SESSION_TOKEN_EXPIRE_MINUTES * 60
+    }
 
-    message = MessageSchema(
-        subject=subject,
-        recipients=email,
-        body=template,
-        subtype=MessageType.html
-    )
 
-    fm = FastMail(config.conf)
-    try:
-        await fm.send_message(message=message)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+async def deliver_email(email: List, template: EmailTemplate, message_data: str):
+    with time_stage('smtp_send'):
+        await smtp_pool.sendmail(config.conf.MAIL_FROM, email, template.render(email, message_data))
@@ -1,9 +1,7 @@
 import re
 from pydantic import BaseModel, EmailStr, Field, field_validator
 from datetime import date
-from passlib.context import CryptContext
-
-pwd_context = CryptContext(schemes=['bcrypt'], deprecated="auto")
+from user.hashing import hashing_executor
 
 
 class UserValidation(BaseModel):
@@ -17,8 +15,8 @@ class UserValidation(BaseModel):
     address: str
     is_verified: bool = False
 
-    def hashed_pwd(self) -> str:
-        return pwd_context.hash(self.password)
+    async def hashed_pwd(self) -> str:
+        return await hashing_executor.hash(self.password)
 
     @field_validator('password')
     def check_valid_pwd(cls, v):
@@ -38,7 +36,35 @@ class Credentials(BaseModel):
     username: str
     password: str
 
-    def verify_pwd(self, hashed_password) -> bool:
-        return pwd_context.verify(self.password, hashed_password)
+    async def verify_pwd(self, hashed_password) -> bool:
+        return await hashing_executor.verify(self.password, hashed_password)
+
+
+class RefreshToken(BaseModel):
+    refresh_token: str
+
+
+#############################################################################
+#                       RESPONSE SCHEMAS                                    #
+#############################################################################
+# Read-only: built from data already validated when it was stored, so model_construct() skips the validators.
+# The password hash is never part of a response.
+class UserPublic(BaseModel):
+    username: str
+    email: EmailStr
+    name: str
+    firstname: str
+    date_of_birth: date
+    phone_number: str
+    address: str
+    is_verified: bool
+
+    @classmethod
+    def from_row(cls, row) -> 'UserPublic':
+        """From a users row, a User or a UserSnapshot."""
+        return cls.model_construct(**{name: getattr(row, name) for name in cls.model_fields})
 
 
+class RegistrationResponse(BaseModel):
+    token: str
+    user: UserPublic
@@ -1,19 +1,16 @@
-from passlib.context import CryptContext
-import jwt
-import config
 from models import User
 from fastapi import HTTPException, status
+from courriel.hashing import hashing_executor
+from courriel.keys import keyring
 
-pwd_context = CryptContext(schemes=['bcrypt'], deprecated="auto")
 
-
-def get_hashed_password(password):
-    return pwd_context.hash(password)
+async def get_hashed_password(password):
+    return await hashing_executor.hash(password)
 
 
 async def verify_token(token: str):
     try:
-        payload = jwt.decode(token, config.SECRET_TOKEN, config.TOKEN_ALGORITHM)
+        payload = keyring.decode(token)
         user = await User.get(username=payload.get("username"))
     except:
         raise HTTPException(
@@ -0,0 +1,181 @@
+import asyncio
+import hmac
+import logging
+import multiprocessing
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable
+from fastapi import HTTPException, status
+from sqlalchemy import delete, insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from captchas.render import render_batch
+from db.database import SessionLocal
+from models_validators.models import Captcha
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class CaptchaPool:
+    """Captchas rendered ahead of time, so that handing one out costs no CPU.
+
+    A refill thread keeps an in-memory buffer of up to `size` captchas: whenever it falls under
+    `refill_threshold`, batches are rendered on `workers` processes and their answers are inserted into the
+    captcha table with one statement per batch. Issuing pops the oldest captcha of the buffer; verifying
+    deletes its row by primary key, so that a captcha is answered once, by any worker. Captchas which are
+    never answered are removed from the table in batch every `sweep_interval` seconds.
+    """
+
+    def __init__(self, session_factory: async_sessionmaker[AsyncSession], size: int = 200,
+                 refill_threshold: int = 50, batch_size: int = 25, workers: int = 1, length: int = 6,
+                 ttl: float = 600, answer_time: float = 120, sweep_interval: float = 60,
+                 renderer: Callable[[int, int], list[tuple[str, bytes]]] = render_batch):
+        self.session_factory = session_factory
+        self.size = size
+        self.refill_threshold = refill_threshold
+        self.batch_size = batch_size
+        self.workers = workers
+        self.length = length
+        self.ttl = timedelta(seconds=ttl)
+        # A captcha is only handed out while the user still has this long to answer it
+        self.answer_time = timedelta(seconds=answer_time)
+        self.sweep_interval = sweep_interval
+        self.renderer = renderer
+        self._buffer: deque[tuple[int, bytes, datetime]] = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._pool: ProcessPoolExecutor | None = None
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    #########################################################################
+    #                       REQUEST SIDE (EVENT LOOP)                       #
+    #########################################################################
+    def issue(self) -> tuple[int, bytes]:
+        deadline = datetime.utcnow() + self.answer_time
+        with self._lock:
+            while self._buffer:
+                captcha_id, image, expired_at = self._buffer.popleft()
+                if expired_at >= deadline:
+                    break
+            else:
+                captcha_id = None
+        if len(self._buffer) < self.refill_threshold:
+            self._wakeup.set()
+        if captcha_id is None:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="No captcha available, please retry later",
+                headers={"Retry-After": "1"}
+            )
+        return captcha_id, image
+
+    @staticmethod
+    async def verify(db: AsyncSession, captcha_id: int, answer: str) -> bool:
+        """Consumes the captcha whatever the answer, so that each one can only be guessed once."""
+        captcha_text = (await db.execute(
+            delete(Captcha)
+            .where(Captcha.captcha_id == captcha_id, Captcha.expired_at > datetime.utcnow())
+            .returning(Captcha.captcha_text)
+        )).scalar()
+        return captcha_text is not None and hmac.compare_digest(captcha_text.encode(),
+                                                                answer.strip().upper().encode())
+
+    #########################################################################
+    #                       REFILL THREAD                                   #
+    #########################################################################
+    def _call(self, coroutine):
+        # The database is only used from the event loop, the thread waits for the result
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    async def _store(self, rendered: list[tuple[str, bytes]], created_at: datetime) -> list[int]:
+        rows = [{'captcha_text': text, 'captcha_image': image, 'created_at': created_at,
+                 'expired_at': created_at + self.ttl} for text, image in rendered]
+        async with self.session_factory() as db:
+            ids = list(await db.scalars(
+                insert(Captcha).returning(Captcha.captcha_id, sort_by_parameter_order=True), rows))
+            await db.commit()
+        return ids
+
+    async def _delete_expired(self) -> int:
+        async with self.session_factory() as db:
+            result = await db.execute(delete(Captcha).where(Captcha.expired_at <= datetime.utcnow()))
+            await db.commit()
+        return result.rowcount
+
+    def _drop_stale(self):
+        deadline = datetime.utcnow() + self.answer_time
+        with self._lock:
+            while self._buffer and self._buffer[0][2] < deadline:
+                self._buffer.popleft()
+
+    def _refill(self):
+        while len(self._buffer) < self.size and not self._stopping.is_set():
+            count = min(self.batch_size, self.size - len(self._buffer))
+            rendered = self._pool.submit(self.renderer, count, self.length).result()
+            created_at = datetime.utcnow()
+            ids = self._call(self._store(rendered, created_at))
+            expired_at = created_at + self.ttl
+            with self._lock:
+                self._buffer.extend((captcha_id, image, expired_at)
+                                    for captcha_id, (_, image) in zip(ids, rendered))
+
+    def _run(self):
+        next_sweep = time.monotonic()
+        while not self._stopping.is_set():
+            # Cleared before looking at the buffer, so that a wakeup sent meanwhile isn't lost
+            self._wakeup.clear()
+            try:
+                self._drop_stale()
+                if len(self._buffer) < self.refill_threshold:
+                    self._refill()
+                if time.monotonic() >= next_sweep:
+                    next_sweep = time.monotonic() + self.sweep_interval
+                    deleted = self._call(self._delete_expired())
+                    if deleted:
+                        logger.info("%d expired captchas deleted", deleted)
+            except Exception:
+                if self._stopping.is_set():
+                    break
+                logger.exception("Captcha refill failed")
+                self._stopping.wait(1)
+            self._wakeup.wait(self.sweep_interval)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        # "spawn" because forking a process which runs an event loop and its threads is not safe
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='captcha-refill', daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._wakeup.set()
+        # Joined from another thread: the refill thread may be waiting for the event loop
+        await asyncio.to_thread(self._thread.join)
+        self._thread = None
+        self._pool.shutdown(cancel_futures=True)
+        self._pool = None
+
+
+def create_captcha_pool() -> CaptchaPool:
+    return CaptchaPool(SessionLocal, size=config.CAPTCHA_POOL_SIZE, refill_threshold=config.CAPTCHA_REFILL_THRESHOLD,
+                       batch_size=config.CAPTCHA_BATCH_SIZE, workers=config.CAPTCHA_RENDER_WORKERS,
+                       length=config.CAPTCHA_LENGTH, ttl=config.CAPTCHA_TTL, answer_time=config.CAPTCHA_ANSWER_TIME,
+                       sweep_interval=config.CAPTCHA_SWEEP_INTERVAL)
+
+
+captcha_pool = create_captcha_pool()
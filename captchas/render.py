@@ -0,0 +1,54 @@
+import io
+import random
+import secrets
+
+# Without the characters easily mistaken for one another (0/O, 1/I)
+ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"
+FONT_SIZE = 36
+HEIGHT = 70
+
+
+def random_text(length: int) -> str:
+    return ''.join(secrets.choice(ALPHABET) for _ in range(length))
+
+
+def render_captcha(text: str) -> bytes:
+    """PNG image of `text`: every character rotated and coloured on its own, over noise lines and dots."""
+    # Only the render workers import Pillow
+    from PIL import Image, ImageDraw, ImageFilter, ImageFont
+
+    font = ImageFont.load_default(size=FONT_SIZE)
+    image = Image.new('RGB', (len(text) * (FONT_SIZE + 4) + 20, HEIGHT), 'white')
+    draw = ImageDraw.Draw(image)
+    for _ in range(len(text) * 2):
+        draw.line([(random.randrange(image.width), random.randrange(HEIGHT)) for _ in range(2)],
+                  fill=random_color(120, 200), width=2)
+
+    x = 10
+    for char in text:
+        glyph = Image.new('L', (FONT_SIZE + 8, FONT_SIZE + 12))
+        ImageDraw.Draw(glyph).text((4, 2), char, font=font, fill=255)
+        glyph = glyph.rotate(random.uniform(-30, 30), resample=Image.Resampling.BICUBIC, expand=True)
+        y = random.randint(0, max(0, HEIGHT - glyph.height))
+        image.paste(random_color(0, 100), (x, y, x + glyph.width, y + glyph.height), glyph)
+        x += FONT_SIZE + 4 - random.randint(0, 8)
+
+    for _ in range(image.width * HEIGHT // 20):
+        draw.point((random.randrange(image.width), random.randrange(HEIGHT)), fill=random_color(0, 255))
+
+    output = io.BytesIO()
+    image.filter(ImageFilter.SMOOTH).save(output, format='PNG')
+    return output.getvalue()
+
+
+def random_color(low: int, high: int) -> tuple[int, int, int]:
+    return random.randint(low, high), random.randint(low, high), random.randint(low, high)
+
+
+# Runs in the render worker processes: a top-level function, so that it can be pickled to them
+def render_batch(count: int, length: int) -> list[tuple[str, bytes]]:
+    captchas = []
+    for _ in range(count):
+        text = random_text(length)
+        captchas.append((text, render_captcha(text)))
+    return captchas
@@ -1,26 +1,32 @@
-from passlib.context import CryptContext
 import jwt
-import config
 from models_validators.models import User
 from fastapi import HTTPException, status
-from db.database import SessionLocal
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession
+from courriel.hashing import hashing_executor
+from courriel.keys import keyring
+from metrics import time_stage
 
 
-pwd_context = CryptContext(schemes=['bcrypt'], deprecated="auto")
+async def get_hashed_password(password: str) -> str:
+    return await hashing_executor.hash(password)
 
 
-def get_hashed_password(password: str) -> str:
-    return pwd_context.hash(password)
-
-
-async def verify_token(token: str):
-    db = SessionLocal()
+# Verifies the user of an email verification token with a single UPDATE ... RETURNING, in the session of the
+# request, and returns its username; None when the user is unknown or already verified. The caller commits.
+async def verify_email(token: str, db: AsyncSession) -> str | None:
     try:
-        payload = jwt.decode(token, config.SECRET_TOKEN, algorithms=config.TOKEN_ALGORITHM)
-        user = db.query(User).filter(User.username == payload['username']).first()
-    except:
+        with time_stage('jwt_decode'):
+            username = keyring.decode(token)['username']
+    except (jwt.PyJWTError, KeyError, TypeError):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid token"
         )
-    return {'user': user, 'session': db}
+    return await db.scalar(
+        update(User)
+        .where(User.username == username, User.is_verified.is_(False))
+        .values(is_verified=True)
+        .returning(User.username)
+        .execution_options(synchronize_session=False)
+    )
@@ -0,0 +1,114 @@
+import os
+from functools import cache
+from email.header import Header
+from email.utils import formatdate, make_msgid
+from secrets import token_hex
+from socket import getfqdn
+from typing import List
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, select_autoescape
+from markupsafe import escape
+
+import config
+
+_environment: Environment | None = None
+
+
+# make_msgid() resolves the host name on every call when no domain is given
+@cache
+def msgid_domain() -> str:
+    return getfqdn()
+
+
+def get_environment() -> Environment:
+    global _environment
+    if _environment is None:
+        os.makedirs(config.TEMPLATE_BYTECODE_CACHE_DIR, exist_ok=True)
+        _environment = Environment(
+            loader=FileSystemLoader(config.TEMPLATES_DIRECTORY),
+            bytecode_cache=FileSystemBytecodeCache(config.TEMPLATE_BYTECODE_CACHE_DIR),
+            autoescape=select_autoescape(['html']),
+            auto_reload=False
+        )
+    return _environment
+
+
+# Web pages (the confirmation page of the verification link) share the environment: compiled once, kept in memory
+def render_page(name: str, **context) -> str:
+    return get_environment().get_template(name).render(context)
+
+
+def get_sender() -> str:
+    if config.conf.MAIL_FROM_NAME is not None:
+        return f"{config.conf.MAIL_FROM_NAME} <{config.conf.MAIL_FROM}>"
+    return config.conf.MAIL_FROM
+
+
+class EmailTemplate:
+    """Transactional email whose only per-message value is `slot` (the token, the OTP code...).
+
+    The Jinja2 templates `<name>.txt` and `<name>.html` are compiled and rendered once with a marker in
+    place of the slot. The result is kept as static byte chunks, together with the static headers and
+    MIME part headers of a multipart/alternative message: building an email is a bytes join.
+    """
+
+    def __init__(self, name: str, subject: str, slot: str):
+        self.name = name
+        self.subject = subject
+        self.slot = slot
+        self._chunks: tuple[list[bytes], list[bytes]] | None = None
+        self._headers = b''
+        self._parts: tuple[bytes, bytes, bytes] = (b'', b'', b'')
+
+    def _render_chunks(self, template_name: str, marker: str) -> list[bytes]:
+        rendered = get_environment().get_template(template_name).render({self.slot: marker})
+        return [chunk.encode() for chunk in rendered.split(marker)]
+
+    def load(self):
+        if self._chunks is not None:
+            return
+        # Only letters and digits: autoescaping leaves the marker untouched in the html version
+        marker = f"SLOT{token_hex(16)}"
+        boundary = f"==============={token_hex(16)}=="
+        self._chunks = (self._render_chunks(f"{self.name}.txt", marker),
+                        self._render_chunks(f"{self.name}.html", marker))
+        subject = self.subject if self.subject.isascii() else Header(self.subject, 'utf-8').encode()
+        self._headers = (
+            f"From: {get_sender()}\r\n"
+            f"Subject: {subject}\r\n"
+            f"MIME-Version: 1.0\r\n"
+            f"Content-Type: multipart/alternative; boundary=\"{boundary}\"\r\n"
+        ).encode()
+        part_headers = "Content-Type: text/{}; charset=\"utf-8\"\r\nContent-Transfer-Encoding: 8bit\r\n\r\n"
+        self._parts = (f"\r\n--{boundary}\r\n{part_headers.format('plain')}".encode(),
+                       f"\r\n--{boundary}\r\n{part_headers.format('html')}".encode(),
+                       f"\r\n--{boundary}--\r\n".encode())
+
+    def render(self, recipients: List[str], value: str) -> bytes:
+        self.load()
+        text_chunks, html_chunks = self._chunks
+        text_open, html_open, closing = self._parts
+        per_message_headers = (f"To: {', '.join(recipients)}\r\n"
+                               f"Date: {formatdate(localtime=True)}\r\n"
+                               f"Message-ID: {make_msgid(domain=msgid_domain())}\r\n").encode()
+        return b''.join((
+            self._headers, per_message_headers,
+            text_open, value.encode().join(text_chunks),
+            html_open, str(escape(value)).encode().join(html_chunks),
+            closing
+        ))
+
+
+VERIFICATION_EMAIL = EmailTemplate('verification_email', config.VERIFICATION_EMAIL_SUBJECT, slot='token')
+
+EMAIL_TEMPLATES = {template.name: template for template in (VERIFICATION_EMAIL,)}
+
+
+def load_email_templates():
+    for template in EMAIL_TEMPLATES.values():
+        template.load()
+
+
+# Compiles (or loads from the bytecode cache) every template before the first request needs one
+def warm_up_templates():
+    load_email_templates()
+    get_environment().get_template("email_verification.html")
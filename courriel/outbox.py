@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import List
+from sqlalchemy import delete, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from models_validators.models import EmailOutbox
+from courriel.email_view import deliver_email
+from courriel.mail_templates import EmailTemplate, EMAIL_TEMPLATES
+import config
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+SENT = 'sent'
+FAILED = 'failed'
+
+
+#############################################################################
+#                       WRITING TO THE OUTBOX                               #
+#############################################################################
+# The row is only added to the session: it is committed together with the caller's own changes
+def queue_email(db: AsyncSession, email: List, template: EmailTemplate, message_data: str) -> EmailOutbox:
+    outbox_row = EmailOutbox(
+        recipients=','.join(email),
+        template=template.name,
+        message_data=message_data,
+        status=PENDING,
+        attempts=0,
+        next_attempt_at=datetime.utcnow()
+    )
+    db.add(outbox_row)
+    return outbox_row
+
+
+#############################################################################
+#                       DELIVERY WORKER                                     #
+#############################################################################
+class OutboxWorker:
+    """Background task delivering the pending rows of the email outbox.
+
+    Rows are claimed in batches with `SELECT ... FOR UPDATE SKIP LOCKED`, so several workers
+    (one per uvicorn worker) never pick the same email. Claiming pushes `next_attempt_at` by
+    `lease`: if the process dies while sending, the row becomes due again once the lease is over.
+    A failed delivery is retried with an exponential backoff until `max_attempts` is reached.
+
+    The message data (tokens, OTP codes) is cleared as soon as the row is sent or given up on, and the
+    sent and failed rows are deleted `retention` after their creation, checked every `purge_interval`.
+    """
+
+    def __init__(self, session_factory: async_sessionmaker, batch_size: int = 50, poll_interval: float = 1.0,
+                 max_attempts: int = 8, base_backoff: float = 5.0, max_backoff: float = 3600.0,
+                 lease: float = 300.0, retention: timedelta = timedelta(days=7), purge_interval: float = 3600.0):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.lease = lease
+        self.retention = retention
+        self.purge_interval = purge_interval
+        self._purged_at: float | None = None
+        self._task: asyncio.Task | None = None
+
+    def backoff(self, attempts: int) -> timedelta:
+        return timedelta(seconds=min(self.base_backoff * 2 ** (attempts - 1), self.max_backoff))
+
+    async def claim_batch(self, db: AsyncSession) -> List[EmailOutbox]:
+        now = datetime.utcnow()
+        rows = (await db.scalars(
+            select(EmailOutbox)
+            .where(EmailOutbox.status == PENDING, EmailOutbox.next_attempt_at <= now)
+            .order_by(EmailOutbox.next_attempt_at)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+        )).all()
+        for row in rows:
+            row.attempts += 1
+            row.next_attempt_at = now + timedelta(seconds=self.lease)
+        await db.commit()
+        return rows
+
+    async def deliver(self, row: EmailOutbox):
+        try:
+            await deliver_email(row.recipients.split(','), EMAIL_TEMPLATES[row.template], row.message_data)
+        except Exception as e:
+            row.last_error = str(e)
+            if row.attempts >= self.max_attempts:
+                row.status = FAILED
+                row.message_data = ''
+                logger.error("Giving up on outbox email %s after %s attempts: %s", row.id, row.attempts, e)
+            else:
+                row.next_attempt_at = datetime.utcnow() + self.backoff(row.attempts)
+        else:
+            row.status = SENT
+            row.sent_at = datetime.utcnow()
+            row.last_error = None
+            row.message_data = ''
+
+    # Returns the number of rows processed, 0 when the outbox had nothing due
+    async def process_batch(self) -> int:
+        async with self.session_factory() as db:
+            rows = await self.claim_batch(db)
+            if not rows:
+                return 0
+            await asyncio.gather(*(self.deliver(row) for row in rows))
+            await db.commit()
+            return len(rows)
+
+    # Returns the number of rows deleted
+    async def purge(self) -> int:
+        async with self.session_factory() as db:
+            deleted = (await db.execute(
+                delete(EmailOutbox)
+                .where(EmailOutbox.status.in_((SENT, FAILED)),
+                       EmailOutbox.created_at < datetime.utcnow() - self.retention)
+            )).rowcount
+            await db.commit()
+            return deleted
+
+    async def run(self):
+        while True:
+            try:
+                if self._purged_at is None or time.monotonic() - self._purged_at >= self.purge_interval:
+                    self._purged_at = time.monotonic()
+                    await self.purge()
+                processed = await self.process_batch()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Email outbox batch failed")
+                processed = 0
+            if processed < self.batch_size:
+                await asyncio.sleep(self.poll_interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+def create_outbox_worker(session_factory: async_sessionmaker) -> OutboxWorker:
+    return OutboxWorker(session_factory, batch_size=config.OUTBOX_BATCH_SIZE,
+                        poll_interval=config.OUTBOX_POLL_INTERVAL, max_attempts=config.OUTBOX_MAX_ATTEMPTS,
+                        retention=timedelta(days=config.OUTBOX_RETENTION_DAYS),
+                        purge_interval=config.OUTBOX_PURGE_INTERVAL)
@@ -0,0 +1,143 @@
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable, List
+import aiosmtplib
+from fastapi_mail import ConnectionConfig
+
+import config
+
+# Errors after which the connection can't be trusted anymore: it is dropped and the send retried on a fresh one
+CONNECTION_ERRORS = (aiosmtplib.SMTPServerDisconnected, aiosmtplib.SMTPConnectError,
+                     aiosmtplib.SMTPTimeoutError, ConnectionError)
+
+
+class _PooledConnection:
+    __slots__ = ('smtp', 'created_at', 'last_used_at', 'messages_sent')
+
+    def __init__(self, smtp: aiosmtplib.SMTP):
+        self.smtp = smtp
+        self.created_at = self.last_used_at = time.monotonic()
+        self.messages_sent = 0
+
+
+class SMTPPool:
+    """Pool of authenticated SMTP connections shared by the whole app.
+
+    Connections are kept open between messages and reused (most recently used first) until they
+    have sent `max_messages` messages or stayed idle for `max_idle` seconds. At most `max_size`
+    connections exist at the same time, further senders wait for one to be released.
+    """
+
+    def __init__(self, settings: ConnectionConfig, max_size: int = 4, max_messages: int = 100,
+                 max_idle: float = 60.0):
+        self.settings = settings
+        self.max_size = max_size
+        self.max_messages = max_messages
+        self.max_idle = max_idle
+        self._idle: deque[_PooledConnection] = deque()
+        self._semaphore: asyncio.Semaphore | None = None
+        self._in_use = 0
+        self._waiting = 0
+        self._counters = {'connections_opened': 0, 'connections_closed': 0, 'connections_reused': 0,
+                          'reconnects': 0, 'messages_sent': 0, 'send_failures': 0}
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_size)
+        return self._semaphore
+
+    async def _connect(self) -> _PooledConnection:
+        smtp = aiosmtplib.SMTP(
+            hostname=self.settings.MAIL_SERVER,
+            port=self.settings.MAIL_PORT,
+            timeout=self.settings.TIMEOUT,
+            use_tls=self.settings.MAIL_SSL_TLS,
+            start_tls=self.settings.MAIL_STARTTLS,
+            validate_certs=self.settings.VALIDATE_CERTS,
+        )
+        await smtp.connect()
+        if self.settings.USE_CREDENTIALS:
+            await smtp.login(self.settings.MAIL_USERNAME, self.settings.MAIL_PASSWORD)
+        return _PooledConnection(smtp)
+
+    async def _open(self) -> _PooledConnection:
+        conn = await self._connect()
+        self._counters['connections_opened'] += 1
+        return conn
+
+    async def _close(self, conn: _PooledConnection):
+        self._counters['connections_closed'] += 1
+        try:
+            if conn.smtp.is_connected:
+                await conn.smtp.quit()
+        except Exception:
+            conn.smtp.close()
+
+    def _is_reusable(self, conn: _PooledConnection) -> bool:
+        return (conn.smtp.is_connected and conn.messages_sent < self.max_messages
+                and time.monotonic() - conn.last_used_at < self.max_idle)
+
+    async def _acquire(self) -> _PooledConnection:
+        while self._idle:
+            conn = self._idle.pop()
+            if self._is_reusable(conn):
+                self._counters['connections_reused'] += 1
+                return conn
+            await self._close(conn)
+        return await self._open()
+
+    def _release(self, conn: _PooledConnection):
+        conn.last_used_at = time.monotonic()
+        self._idle.append(conn)
+
+    # For messages which are already serialized (see courriel/mail_templates.py)
+    async def sendmail(self, sender: str, recipients: List[str], data: bytes):
+        await self._send(lambda smtp: smtp.sendmail(sender, recipients, data))
+
+    async def _send(self, send: Callable[[aiosmtplib.SMTP], Awaitable]):
+        if self.settings.SUPPRESS_SEND:
+            return
+        semaphore = self._get_semaphore()
+        self._waiting += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            self._waiting -= 1
+        self._in_use += 1
+        conn = None
+        try:
+            conn = await self._acquire()
+            try:
+                await send(conn.smtp)
+            except CONNECTION_ERRORS:
+                # The server dropped an idle connection under our feet: one more try on a new one
+                await self._close(conn)
+                conn = None
+                self._counters['reconnects'] += 1
+                conn = await self._open()
+                await send(conn.smtp)
+        except Exception:
+            # Whatever happened, the SMTP transaction may be half done: never hand this connection out again
+            self._counters['send_failures'] += 1
+            if conn is not None:
+                await self._close(conn)
+            raise
+        else:
+            conn.messages_sent += 1
+            self._counters['messages_sent'] += 1
+            self._release(conn)
+        finally:
+            self._in_use -= 1
+            semaphore.release()
+
+    async def close(self):
+        while self._idle:
+            await self._close(self._idle.pop())
+
+    def stats(self) -> dict:
+        return {'max_size': self.max_size, 'in_use': self._in_use, 'idle': len(self._idle),
+                'waiting': self._waiting, **self._counters}
+
+
+smtp_pool = SMTPPool(config.conf, config.SMTP_POOL_SIZE, config.SMTP_POOL_MAX_MESSAGES, config.SMTP_POOL_MAX_IDLE)
@@ -0,0 +1,119 @@
+import logging
+import time
+from contextvars import ContextVar
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+# Seconds
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+HOLD_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+LIFETIME_BUCKETS = (1.0, 10.0, 60.0, 300.0, 900.0, 1800.0, 3600.0, 7200.0, 21600.0, 86400.0)
+
+# Labelled with the pool ('primary', 'replica0', ...) and, for the holds, the route template
+OPEN_CONNECTIONS = Gauge('db_pool_open_connections', "Connections opened by the pool", ['pool'],
+                         multiprocess_mode='livesum')
+CHECKED_OUT = Gauge('db_pool_checked_out_connections', "Connections currently checked out of the pool", ['pool'],
+                    multiprocess_mode='livesum')
+CHECKOUTS = Counter('db_pool_checkouts', "Connections checked out of the pool", ['pool'])
+CHECKOUT_WAIT = Histogram('db_pool_checkout_wait_seconds', "Time spent waiting for a pooled connection", ['pool'],
+                          buckets=WAIT_BUCKETS)
+CONNECTION_HOLD = Histogram('db_connection_hold_seconds', "Time a request kept a connection checked out",
+                            ['route'], buckets=HOLD_BUCKETS)
+LONG_HELD_CONNECTIONS = Counter('db_long_held_connections', "Connections held longer than DB_SESSION_HOLD_WARNING",
+                                ['route'])
+CONNECTION_LIFETIME = Histogram('db_connection_lifetime_seconds', "Lifetime of the closed connections", ['pool'],
+                                buckets=LIFETIME_BUCKETS)
+
+
+# Route template of the request served by the current task, set by the request sessions: the checkouts made
+# for a request are timed and labelled with it
+current_route: ContextVar[str | None] = ContextVar('current_route', default=None)
+# When the session running in the current task asked for a connection it doesn't hold yet
+_checkout_requested_at: ContextVar[float | None] = ContextVar('checkout_requested_at', default=None)
+CONNECTED_BINDS = 'connected_binds'
+
+
+class CheckoutTiming:
+    """Session mixin marking when a connection is requested, for the checkout wait measured by the pool events.
+
+    The pool has no event before a checkout: get_bind() is called right before the session connects, and only
+    marks the binds the session holds no connection to yet.
+    """
+
+    def get_bind(self, *args, **kwargs):
+        bind = super().get_bind(*args, **kwargs)
+        if bind not in self.info.get(CONNECTED_BINDS, ()):
+            _checkout_requested_at.set(time.perf_counter())
+        return bind
+
+
+class CheckoutTimingSession(CheckoutTiming, Session):
+    pass
+
+
+@event.listens_for(Session, 'after_begin')
+def _remember_connected_bind(session: Session, transaction, connection):
+    session.info.setdefault(CONNECTED_BINDS, set()).add(connection.engine)
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _forget_connected_binds(session: Session, transaction):
+    # The connections go back to the pool with the outermost transaction
+    if transaction.parent is None:
+        session.info.pop(CONNECTED_BINDS, None)
+
+
+class PoolMetrics:
+    """Connection pool instrumentation, exported on /metrics, fed by SQLAlchemy pool events.
+
+    The connections checked out for a request (see current_route) are timed from the request of the session to
+    the checkout (waiting for the pool, and pinging the connection with DB_POOL_PRE_PING), and held until checkin.
+    """
+
+    def __init__(self, hold_warning: float):
+        self.hold_warning = hold_warning
+
+    def instrument(self, engine: AsyncEngine, pool: str = 'primary'):
+        def on_connect(dbapi_connection, connection_record):
+            connection_record.info['connected_at'] = time.monotonic()
+            OPEN_CONNECTIONS.labels(pool).inc()
+
+        def on_close(dbapi_connection, connection_record):
+            connected_at = connection_record.info.pop('connected_at', None)
+            if connected_at is not None:
+                OPEN_CONNECTIONS.labels(pool).dec()
+                CONNECTION_LIFETIME.labels(pool).observe(time.monotonic() - connected_at)
+
+        def on_checkout(dbapi_connection, connection_record, connection_proxy):
+            now = time.perf_counter()
+            CHECKED_OUT.labels(pool).inc()
+            CHECKOUTS.labels(pool).inc()
+            requested_at = _checkout_requested_at.get()
+            if requested_at is not None:
+                _checkout_requested_at.set(None)
+                CHECKOUT_WAIT.labels(pool).observe(now - requested_at)
+            route = current_route.get()
+            if route is not None:
+                connection_record.info['held_since'] = (now, route)
+
+        def on_checkin(dbapi_connection, connection_record):
+            CHECKED_OUT.labels(pool).dec()
+            held_since = connection_record.info.pop('held_since', None)
+            if held_since is not None:
+                self.observe_connection_hold(time.perf_counter() - held_since[0], held_since[1])
+
+        event.listen(engine.sync_engine, 'connect', on_connect)
+        event.listen(engine.sync_engine, 'close', on_close)
+        event.listen(engine.sync_engine, 'checkout', on_checkout)
+        event.listen(engine.sync_engine, 'checkin', on_checkin)
+
+    def observe_connection_hold(self, seconds: float, route: str):
+        CONNECTION_HOLD.labels(route).observe(seconds)
+        if seconds > self.hold_warning:
+            LONG_HELD_CONNECTIONS.labels(route).inc()
+            logger.warning("Database connection held for %.3fs by %s (threshold %.3fs)", seconds, route,
+                           self.hold_warning)
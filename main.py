@@ -1,52 +1,104 @@
-from fastapi import FastAPI, HTTPException, status, Request, Depends
-from fastapi.responses import HTMLResponse
-from models_validators.models import User
-from models_validators.validators import UserValidation
-from courriel.email_auth import get_hashed_password, verify_token
-
-from courriel.email_view import send_email
-from db.database import SessionLocal, engine, Base
+import time
+
+# Measured for the startup report: importing the app is a good part of a worker boot
+IMPORTS_STARTED = time.perf_counter()
+
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, APIRouter, HTTPException, status, Request, Depends
+from fastapi.responses import HTMLResponse, Response, ORJSONResponse
+from models_validators.models import User, email_matches
+from models_validators.validators import UserValidation, CaptchaAnswer
+from courriel.email_auth import get_hashed_password, verify_email
+from courriel.hashing import hashing_executor
+from courriel.keys import keyring
+
+from courriel.email_view import verification_token
+from courriel.mail_templates import VERIFICATION_EMAIL, render_page, warm_up_templates
+from courriel.outbox import queue_email, create_outbox_worker
+from courriel.smtp_pool import smtp_pool
+from captchas.pool import captcha_pool
+from db.database import SessionLocal, engine, warm_up_pool, release_connection
+from db.metrics import current_route
+from metrics import setup_metrics, stats_collector, route_template
+from startup import StartupReport
+import config
 from typing import Annotated
-from sqlalchemy.orm import Session
 from sqlalchemy import select
-# templates
-from fastapi.templating import Jinja2Templates
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.dialects.postgresql import insert
+
+IMPORTS_ENDED = time.perf_counter()
+
+
+async def warm_up(report: StartupReport):
+    async def timed(name: str, coroutine):
+        with report.optional_step(name):
+            await asyncio.wait_for(coroutine, config.STARTUP_WARMUP_TIMEOUT)
+
+    with report.optional_step('templates'):
+        warm_up_templates()
+    # Independent: the database round trips and the worker processes boot at the same time
+    await asyncio.gather(timed('db_pool', warm_up_pool(config.DB_WARMUP_CONNECTIONS)),
+                         timed('hashing_workers', hashing_executor.warm_up()))
+
+
+# No schema change here: run migrate.py before starting the workers
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    report = StartupReport(started=IMPORTS_STARTED)
+    report.record('imports', IMPORTS_STARTED, IMPORTS_ENDED)
+    with report.step('signing_keys'):
+        keyring.start(config.SIGNING_KEYS_RELOAD_INTERVAL)
+    await warm_up(report)
+    outbox_worker = create_outbox_worker(SessionLocal)
+    outbox_worker.start()
+    captcha_pool.start()
+    app.state.startup_report = report
+    report.log()
+    yield
+    await captcha_pool.stop()
+    await outbox_worker.stop()
+    await keyring.stop()
+    await smtp_pool.close()
+    hashing_executor.shutdown()
+    await engine.dispose()
 
-app = FastAPI()
-Base.metadata.create_all(bind=engine)
 
+router = APIRouter()
 
-def get_db():
-    db = SessionLocal()
-    try:
+
+async def get_db(request: Request):
+    # The connection is checked out by the first statement, not when the session opens. Its checkout wait and
+    # hold are measured by the pool events, for the route.
+    current_route.set(route_template(request))
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
-db_dependency = Annotated[Session, Depends(get_db)]
+db_dependency = Annotated[AsyncSession, Depends(get_db)]
 
 
-# This function checks if the user exist
-async def user_exit(user: UserValidation, db: db_dependency) -> bool:
-    if db.scalar(select(User).where(User.username == user.username)):
+# Route to register a user.
+@router.post('/registration')
+async def create_user(user: UserValidation, db: db_dependency):
+    # Emails already registered, whatever their case, are rejected before hashing the password: a single probe
+    # of the unique index on lower(email)
+    if await db.scalar(select(User.username).where(email_matches(user.email))) is not None:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"User with username: {user.username} already exists."
+            detail="A user with this email already exists."
         )
-    return True
+    await release_connection(db)
 
-
-# Route to register a user.
-@app.post('/registration')
-async def create_user(user: UserValidation, db: db_dependency):
-    # Check if the user exist
-    if await user_exit(user, db):
-        # Creation of an unverified user in the database
-        user_obj = User(
+    # Creation of an unverified user in the database, in a single statement: no row is returned when the
+    # username or the email is already taken, even when two registrations for them race each other
+    created = (await db.execute(
+        insert(User)
+        .values(
             username=user.username,
             email=user.email,
-            password=get_hashed_password(user.password),
+            password=await get_hashed_password(user.password),
             name=user.name,
             firstname=user.firstname,
             date_of_birth=user.date_of_birth,
@@ -54,28 +106,67 @@ async def create_user(user: UserValidation, db: db_dependency):
             address=user.address,
             is_verified=False
         )
-        db.add(user_obj)
-        db.commit()
-    
-        # Send confirmation email
-        await send_email([user_obj.email], user_obj)
-    
-        return {
-            "status": "Ok",
-            "data": f"Hello {user_obj.username}, thanks for choosing our services. Please check your email inbox and "
-                    f"click on the link to confirm your email"
-        }
-
-
-template = Jinja2Templates(directory="templates")
-
-
-@app.get('/verification', response_class=HTMLResponse)
-async def email_verification(request: Request, token: str):
-    result = await verify_token(token)
-
-    if result['user'] and not result['user'].is_verified:
-        result['user'].is_verified = True
-        result['session'].commit()
-        return template.TemplateResponse("email_verification.html",
-                                         {"request": request, "username": result['user'].username})
+        .on_conflict_do_nothing()
+        .returning(User.username, User.email, User.name)
+    )).first()
+    if created is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"User with username: {user.username} or with this email already exists."
+        )
+
+    # The confirmation email goes to the outbox in the same transaction as the user
+    queue_email(db, [created.email], VERIFICATION_EMAIL, verification_token(created))
+    await db.commit()
+
+    return {
+        "status": "Ok",
+        "data": f"Hello {created.username}, thanks for choosing our services. Please check your email inbox and "
+                f"click on the link to confirm your email"
+    }
+
+
+@router.get('/verification', response_class=HTMLResponse)
+async def email_verification(token: str, db: db_dependency):
+    username = await verify_email(token, db)
+
+    if username is not None:
+        await db.commit()
+        return render_page("email_verification.html", username=username)
+
+
+# Captcha image to show before a signup, identified by the X-Captcha-Id response header
+@router.get('/captcha', response_class=Response)
+async def issue_captcha():
+    captcha_id, image = captcha_pool.issue()
+    return Response(content=image, media_type='image/png',
+                    headers={'X-Captcha-Id': str(captcha_id), 'Cache-Control': 'no-store'})
+
+
+@router.post('/captcha/verify')
+async def verify_captcha(captcha: CaptchaAnswer, db: db_dependency):
+    valid = await captcha_pool.verify(db, captcha.captcha_id, captcha.answer)
+    await db.commit()
+    if not valid:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid or expired captcha"
+        )
+    return {"status": "Ok"}
+
+
+def create_app() -> FastAPI:
+    """Builds the app: connections, worker processes and templates are set up by the lifespan.
+
+    The settings (read from ENV_PATH) and the engines (which connect on first use) are not created here but
+    when config and the database module are imported, with the rest of the modules: the app below is built
+    at import too. Served with `uvicorn main:create_app --factory` (or `uvicorn main:app`).
+    """
+    app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+    setup_metrics(app)
+    stats_collector.register('smtp_pool', smtp_pool.stats)
+    app.include_router(router)
+    return app
+
+
+app = create_app()
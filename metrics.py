@@ -0,0 +1,121 @@
+import os
+import time
+from fastapi import FastAPI, Request, Response
+from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client import multiprocess
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector
+from sqlalchemy import event
+from typing import Callable, Iterable
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+# Seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REQUESTS = Counter('http_requests_total', "HTTP requests handled", ['method', 'route', 'status'])
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', "HTTP request latency", ['method', 'route'],
+                            buckets=LATENCY_BUCKETS)
+# Internal stages: bcrypt_hash, bcrypt_verify, jwt_encode, jwt_decode, db_query, smtp_send
+STAGE_LATENCY = Histogram('stage_duration_seconds', "Time spent in the internal stages of a request", ['stage'],
+                          buckets=LATENCY_BUCKETS)
+
+
+def time_stage(stage: str):
+    """Context manager (or decorator) recording the duration of an internal stage."""
+    return STAGE_LATENCY.labels(stage).time()
+
+
+#############################################################################
+#                       DATABASE QUERIES TIMING                             #
+#############################################################################
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started_at', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    STAGE_LATENCY.labels('db_query').observe(time.perf_counter() - conn.info['query_started_at'].pop())
+
+
+def _handle_error(exception_context):
+    started = exception_context.connection.info.get('query_started_at') if exception_context.connection else None
+    if started:
+        STAGE_LATENCY.labels('db_query').observe(time.perf_counter() - started.pop())
+
+
+def instrument_queries(engine: AsyncEngine):
+    event.listen(engine.sync_engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine.sync_engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine.sync_engine, 'handle_error', _handle_error)
+
+
+#############################################################################
+#                       IN-PROCESS COMPONENTS STATS                         #
+#############################################################################
+class StatsCollector(Collector):
+    """Exports the stats() of the in-process components (caches, pools, filters) as gauges, read at scrape time.
+
+    A source `name` returning {'hits': 3} is exported as `name_hits`; non numeric values are skipped. The values
+    belong to the process answering the scrape, hence the pid label.
+    """
+
+    def __init__(self):
+        self._sources: dict[str, Callable[[], dict]] = {}
+
+    def register(self, name: str, stats: Callable[[], dict]):
+        self._sources[name] = stats
+
+    def collect(self) -> Iterable[GaugeMetricFamily]:
+        pid = str(os.getpid())
+        for name, stats in self._sources.items():
+            for key, value in stats().items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                gauge = GaugeMetricFamily(f'{name}_{key}', f"{key} of the {name.replace('_', ' ')}", labels=['pid'])
+                gauge.add_metric([pid], value)
+                yield gauge
+
+
+stats_collector = StatsCollector()
+REGISTRY.register(stats_collector)
+
+
+#############################################################################
+#                       MIDDLEWARE AND ENDPOINT                             #
+#############################################################################
+def get_registry() -> CollectorRegistry:
+    # With several uvicorn workers, every process writes its samples to PROMETHEUS_MULTIPROC_DIR
+    # (which must be set, and emptied, before the workers start) and a scrape aggregates all of them.
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(stats_collector)
+        return registry
+    return REGISTRY
+
+
+def route_template(request: Request) -> str:
+    # The route template (/users/{id}, not /users/42) keeps the number of series bounded
+    route = request.scope.get('route')
+    return route.path if route is not None else 'unmatched'
+
+
+async def metrics_middleware(request: Request, call_next):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        path = route_template(request)
+        REQUEST_LATENCY.labels(request.method, path).observe(time.perf_counter() - started)
+        REQUESTS.labels(request.method, path, str(status)).inc()
+
+
+def metrics_endpoint() -> Response:
+    return Response(generate_latest(get_registry()), media_type=CONTENT_TYPE_LATEST)
+
+
+def setup_metrics(app: FastAPI):
+    app.middleware('http')(metrics_middleware)
+    app.add_api_route('/metrics', metrics_endpoint, methods=['GET'], include_in_schema=False)
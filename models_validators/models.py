@@ -1,4 +1,4 @@
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, Index, func
 from sqlalchemy.orm import mapped_column, Mapped
 from db.database import Base
 from datetime import date, datetime
@@ -21,11 +21,23 @@ class User(Base):
                f"name: {self.name}"
 
 
+# One account per address, whatever its case: the lookups compare lower(email) with the lowercased address,
+# which this index serves
+Index('uq_users_email_lower', func.lower(User.email), unique=True)
+
+
+def email_matches(email: str):
+    """Condition selecting the user of `email`, whatever its case, with a single probe of uq_users_email_lower."""
+    return func.lower(User.email) == func.lower(email)
+
+
 class SubscriptionType(Base):
     __tablename__ = 'subscription_type'
     id: Mapped[int] = mapped_column(primary_key=True, index=True, unique=True)
     subscription_name: Mapped[str]
     price: Mapped[int]
+    # Length of the period added by a renewal
+    duration_days: Mapped[int] = mapped_column(default=30, server_default='30')
 
 
 class Subscription(Base):
@@ -34,6 +46,14 @@ class Subscription(Base):
     id_subscription_type: Mapped[int] = mapped_column(ForeignKey("subscription_type.id"), primary_key=True)
     begin: Mapped[date]
     end: Mapped[date]
+    auto_renew: Mapped[bool] = mapped_column(default=False, server_default='false')
+    # End date whose expiry notice was sent, so that the renewal job notifies each expiry once
+    notified_end: Mapped[date | None]
+    # Polled by the entitlement index to pick up the subscriptions changed by other processes
+    updated_at: Mapped[datetime] = mapped_column(default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+
+    # "Is this user entitled today": equality on username, then a range on the dates
+    __table_args__ = (Index('ix_subscription_username_begin_end', 'username', 'begin', 'end'),)
 
 
 class Captcha(Base):
@@ -42,4 +62,21 @@ class Captcha(Base):
     captcha_text: Mapped[str] = mapped_column(nullable=False)
     captcha_image: Mapped[bytes]
     created_at: Mapped[datetime]
-    expired_at: Mapped[datetime]
+    expired_at: Mapped[datetime] = mapped_column(index=True)
+
+
+class EmailOutbox(Base):
+    """Emails waiting to be delivered by the outbox worker (see courriel/outbox.py)."""
+    __tablename__ = 'email_outbox'
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    recipients: Mapped[str]
+    template: Mapped[str]
+    message_data: Mapped[str]
+    status: Mapped[str] = mapped_column(default='pending')
+    attempts: Mapped[int] = mapped_column(default=0)
+    next_attempt_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+    last_error: Mapped[str | None]
+    created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+    sent_at: Mapped[datetime | None]
+
+    __table_args__ = (Index('ix_email_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),)
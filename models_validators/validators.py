@@ -34,3 +34,8 @@ class Captcha(BaseModel):
     captcha_image: bytes
     created_at: datetime
     expired_at: datetime
+
+
+class CaptchaAnswer(BaseModel):
+    captcha_id: int
+    answer: str = Field(max_length=32)
@@ -0,0 +1,120 @@
+import asyncio
+from datetime import datetime, timedelta
+import pytest
+import pytest_asyncio
+from fastapi import HTTPException
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from captchas.pool import CaptchaPool
+from captchas.render import ALPHABET, random_text, render_batch
+from db.database import Base
+from models_validators.models import Captcha
+
+
+# Stands for render_batch without Pillow; top-level so that it can be pickled to the render workers
+def fake_render(count: int, length: int) -> list[tuple[str, bytes]]:
+    return [(random_text(length), b'png') for _ in range(count)]
+
+
+@pytest_asyncio.fixture
+async def session_factory(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'captchas.db'}")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    yield async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    await engine.dispose()
+
+
+@pytest.fixture
+def pool(session_factory):
+    return CaptchaPool(session_factory, size=10, refill_threshold=4, batch_size=4, answer_time=60,
+                       renderer=fake_render)
+
+
+def fill(pool: CaptchaPool, count: int, expired_at: datetime | None = None):
+    expired_at = expired_at or datetime.utcnow() + timedelta(seconds=600)
+    pool._buffer.extend((captcha_id, b'png', expired_at) for captcha_id in range(len(pool), len(pool) + count))
+
+
+async def wait_for(condition, timeout: float = 30):
+    async with asyncio.timeout(timeout):
+        while not condition():
+            await asyncio.sleep(0.05)
+
+
+def test_issue_takes_the_oldest(pool):
+    fill(pool, 6)
+
+    assert [pool.issue()[0] for _ in range(2)] == [0, 1]
+    assert len(pool) == 4
+    # Still above the low watermark: the refill thread is left asleep
+    assert not pool._wakeup.is_set()
+
+
+def test_issue_under_low_watermark_wakes_the_refill(pool):
+    fill(pool, 4)
+
+    assert pool.issue()[0] == 0
+    assert pool._wakeup.is_set()
+
+
+def test_issue_skips_captchas_expiring_too_soon(pool):
+    fill(pool, 2, expired_at=datetime.utcnow() + timedelta(seconds=30))
+    fill(pool, 1)
+
+    assert pool.issue()[0] == 2
+    assert len(pool) == 0
+
+
+def test_empty_pool_rejects(pool):
+    with pytest.raises(HTTPException) as exc_info:
+        pool.issue()
+
+    assert exc_info.value.status_code == 503
+    assert exc_info.value.headers == {"Retry-After": "1"}
+    assert pool._wakeup.is_set()
+
+
+@pytest.mark.asyncio
+async def test_refill_store_and_shutdown(pool, session_factory):
+    pool.start()
+    try:
+        await wait_for(lambda: len(pool) == pool.size)
+        async with session_factory() as db:
+            assert await db.scalar(select(func.count()).select_from(Captcha)) == pool.size
+
+        # Taken under the low watermark, the buffer is filled again
+        issued = [pool.issue() for _ in range(7)]
+        await wait_for(lambda: len(pool) == pool.size)
+    finally:
+        await pool.stop()
+
+    assert pool._thread is None and pool._pool is None
+    captcha_id, image = issued[0]
+    assert image == b'png'
+    async with session_factory() as db:
+        answer = await db.scalar(select(Captcha.captcha_text).where(Captcha.captcha_id == captcha_id))
+        assert await CaptchaPool.verify(db, captcha_id, answer.lower()) is True
+        # Answered once only
+        assert await CaptchaPool.verify(db, captcha_id, answer) is False
+
+
+@pytest.mark.asyncio
+async def test_stop_without_start(pool):
+    await pool.stop()
+    assert pool._thread is None
+
+
+def test_random_text():
+    text = random_text(6)
+
+    assert len(text) == 6
+    assert set(text) <= set(ALPHABET)
+
+
+def test_render_batch():
+    pytest.importorskip("PIL")
+    rendered = render_batch(2, 5)
+
+    assert [len(text) for text, _ in rendered] == [5, 5]
+    assert all(image.startswith(b'\x89PNG') for _, image in rendered)